@@ -47,6 +47,14 @@ def list_files():
         print(f"❌ Error listing files: {e}")
         return []
 
+def download_file(dropbox_filename, local_save_path):
+    """Downloads a file from Dropbox and leaves it in place."""
+    try:
+        dbx.files_download_to_file(local_save_path, "/" + dropbox_filename)
+        print(f"✅ Downloaded '{dropbox_filename}' to '{local_save_path}'.")
+    except Exception as e:
+        print(f"❌ Error downloading file: {e}")
+
 def download_and_delete_file(dropbox_filename, local_save_path):
     """Downloads a file from Dropbox and deletes it after successful download."""
     try:
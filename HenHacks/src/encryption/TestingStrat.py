@@ -7,15 +7,23 @@ and includes examples of unit tests.
 
 import unittest
 import os
+import io
+import sys
 import tempfile
 import shutil
 import json
 import time
+import hashlib
 from base64 import b64encode, b64decode
 import sqlite3
 
 # Import directly from the encryption module - adjust import path as needed
-from encryption import KeyManager, EncryptionEngine, MetadataHandler, SegmentEncryptor
+from encryption import (
+    get_connection_manager, MasterKeyCache,
+    KeyManager, EncryptionEngine, MetadataHandler, SegmentContainer, SegmentEncryptor,
+    BinaryMetadataCodec
+)
+from unittest import mock
 
 class TestKeyManager(unittest.TestCase):
     """Test cases for the KeyManager class"""
@@ -28,6 +36,9 @@ class TestKeyManager(unittest.TestCase):
     
     def tearDown(self):
         """Clean up temporary files after tests"""
+        # Release pooled connections to the test database
+        get_connection_manager(self.db_path).close_all()
+        
         # Ensure all connections are closed
         try:
             conn = sqlite3.connect(self.db_path)
@@ -70,6 +81,53 @@ class TestKeyManager(unittest.TestCase):
             self.key_manager.verify_master_key(wrong_key, verification_hash)
         )
     
+    def test_derive_master_key_with_stored_params(self):
+        """Test that derivation honours explicit KDF parameters"""
+        password = "test-password-params"
+        params = {"algorithm": "sha256", "iterations": 1000, "length": 32}
+        
+        master_key, salt, kdf_type, kdf_params, _ = self.key_manager.derive_master_key(
+            password, use_argon2=False, kdf_params=params
+        )
+        self.assertEqual(kdf_type, "pbkdf2")
+        self.assertEqual(json.loads(kdf_params)["iterations"], 1000)
+        
+        # Re-deriving from the stored JSON gives the same key; defaults do not
+        same_key, _, _, _, _ = self.key_manager.derive_master_key(
+            password, salt, use_argon2=False, kdf_params=kdf_params
+        )
+        default_key, _, _, _, _ = self.key_manager.derive_master_key(
+            password, salt, use_argon2=False
+        )
+        self.assertEqual(master_key, same_key)
+        self.assertNotEqual(master_key, default_key)
+    
+    def test_calibrate_kdf_profile(self):
+        """Test that calibration stores a host profile used for new keys"""
+        target_ms = 200
+        profile = self.key_manager.calibrate_kdf(target_ms=target_ms, max_memory_cost=65536)
+        
+        self.assertIn(profile["kdf_type"], ("argon2id", "pbkdf2"))
+        self.assertGreater(profile["measured_ms"], 0)
+        
+        # The profile fits the target (with slack for timing noise) unless even
+        # the minimum parameters are slower than that on this host
+        params = profile["kdf_params"]
+        at_minimum = profile["kdf_type"] == "argon2id" and \
+            params["time_cost"] == self.key_manager.MIN_ARGON2_TIME_COST and \
+            params["memory_cost"] == self.key_manager.MIN_ARGON2_MEMORY_COST
+        if not at_minimum:
+            self.assertLessEqual(profile["measured_ms"], target_ms * 1.5)
+        self.assertEqual(self.key_manager.get_host_profile("kdf"), profile)
+        self.assertEqual(
+            self.key_manager.get_kdf_profile(profile["kdf_type"]), profile["kdf_params"]
+        )
+        
+        _, _, _, kdf_params, _ = self.key_manager.derive_master_key(
+            "test-password", use_argon2=(profile["kdf_type"] == "argon2id")
+        )
+        self.assertEqual(json.loads(kdf_params), profile["kdf_params"])
+    
     def test_derive_segment_key(self):
         """Test segment key derivation"""
         master_key = os.urandom(32)  # Random 256-bit key
@@ -98,6 +156,48 @@ class TestKeyManager(unittest.TestCase):
         )
         self.assertEqual(segment_key1, segment_key1_repeat)
     
+    def test_derive_segment_keys_batch(self):
+        """Test bulk segment key derivation against the single-segment HKDF"""
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        
+        master_key = os.urandom(32)
+        file_id = "test-file-batch"
+        segment_ids = [f"{file_id}_{i}" for i in range(10)]
+        
+        keys = self.key_manager.derive_segment_keys(master_key, segment_ids, file_id)
+        
+        self.assertEqual(len(keys), len(segment_ids))
+        self.assertEqual(len(set(keys)), len(segment_ids))
+        for segment_id, segment_key in zip(segment_ids, keys):
+            reference = HKDF(
+                algorithm=hashes.SHA256(), length=32, salt=None,
+                info=f"{file_id}:{segment_id}".encode('utf-8'),
+            ).derive(master_key)
+            self.assertEqual(segment_key, reference)
+            self.assertEqual(
+                self.key_manager.derive_segment_key(master_key, segment_id, file_id),
+                reference
+            )
+    
+    def test_segment_key_cache_bounds(self):
+        """Test that the segment key cache is bounded and tied to the master key"""
+        key_manager = KeyManager(self.db_path, segment_key_cache_size=5)
+        master_key = os.urandom(32)
+        other_master_key = os.urandom(32)
+        file_id = "test-file-cache"
+        segment_ids = [f"{file_id}_{i}" for i in range(8)]
+        
+        keys = key_manager.derive_segment_keys(master_key, segment_ids, file_id)
+        self.assertEqual(len(key_manager._segment_key_cache), 5)
+        
+        # A different master key must never be served a cached key
+        other_keys = key_manager.derive_segment_keys(other_master_key, segment_ids[-2:], file_id)
+        self.assertNotEqual(other_keys, keys[-2:])
+        
+        key_manager.forget_segment_keys(file_id)
+        self.assertEqual(len(key_manager._segment_key_cache), 0)
+    
     def test_store_and_retrieve_key_info(self):
         """Test storing and retrieving key information"""
         file_id = "test-file-id-storage"
@@ -143,6 +243,113 @@ class TestKeyManager(unittest.TestCase):
         self.assertEqual(segment_info["encryption_algorithm"], algorithm)
         self.assertEqual(segment_info["nonce"], nonce)
         self.assertEqual(segment_info["tag"], tag)
+        self.assertIsNone(segment_info["compression"])
+    
+    def test_compression_column_added_to_old_database(self):
+        """Test that databases without the compression column are migrated"""
+        old_db_path = os.path.join(self.test_dir, "old_schema.db")
+        conn = sqlite3.connect(old_db_path)
+        conn.execute("""
+            CREATE TABLE segment_keys_info (
+                segment_id TEXT PRIMARY KEY, file_id TEXT NOT NULL,
+                segment_index INTEGER NOT NULL, encryption_algorithm TEXT NOT NULL,
+                nonce BLOB NOT NULL, tag BLOB
+            )
+        """)
+        conn.commit()
+        conn.close()
+        
+        key_manager = KeyManager(old_db_path)
+        try:
+            key_manager.store_segment_key_info(
+                "seg", "file", 0, "AES-256-GCM", os.urandom(12), os.urandom(16), "zlib"
+            )
+            self.assertEqual(key_manager.get_segment_key_info("seg")["compression"], "zlib")
+        finally:
+            key_manager.close()
+    
+    def test_dedup_blob_refcounts(self):
+        """Test that dedup blobs are counted per referencing segment and released at zero"""
+        self.key_manager.store_dedup_blob(
+            "blob", "AES-256-GCM", os.urandom(12), os.urandom(16), 100, 100
+        )
+        self.assertEqual(self.key_manager.get_dedup_blob("blob")["refcount"], 0)
+        
+        for segment_id, file_id in (("a_0", "a"), ("a_1", "a"), ("b_0", "b")):
+            self.key_manager.store_segment_key_info(
+                segment_id, file_id, 0, "AES-256-GCM", os.urandom(12), os.urandom(16),
+                content_id="blob", wrapped_key=os.urandom(60)
+            )
+        self.assertEqual(self.key_manager.get_dedup_blob("blob")["refcount"], 3)
+        
+        # A referenced blob's encryption info is never replaced
+        blob_info = self.key_manager.get_dedup_blob("blob")
+        self.key_manager.store_dedup_blob(
+            "blob", "ChaCha20-Poly1305", os.urandom(12), os.urandom(16), 100, 100
+        )
+        self.assertEqual(self.key_manager.get_dedup_blob("blob"), blob_info)
+        
+        self.assertEqual(self.key_manager.release_dedup_blobs(["blob", "blob"]), [])
+        self.assertEqual(self.key_manager.get_dedup_blob("blob")["refcount"], 1)
+        self.assertEqual(self.key_manager.release_dedup_blobs(["blob"]), ["blob"])
+        self.assertIsNone(self.key_manager.get_dedup_blob("blob"))
+    
+    def test_user_secret_is_stable(self):
+        """Test that a per-user secret is generated once and then reused"""
+        secret = self.key_manager.get_user_secret("dedup")
+        self.assertEqual(len(secret), 32)
+        self.assertEqual(self.key_manager.get_user_secret("dedup"), secret)
+        self.assertNotEqual(self.key_manager.get_user_secret("other"), secret)
+
+
+class TestConnectionManager(unittest.TestCase):
+    """Test cases for the pooled SQLite ConnectionManager"""
+    
+    def setUp(self):
+        """Set up a temporary database for testing"""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_dir, "test_connections.db")
+        self.db = get_connection_manager(self.db_path)
+        with self.db.transaction() as cursor:
+            cursor.execute("CREATE TABLE items (value INTEGER)")
+    
+    def tearDown(self):
+        """Clean up temporary files after tests"""
+        # Release pooled connections to the test database
+        self.db.close_all()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_pooled_wal_connection(self):
+        """Test that connections are reused per thread and run in WAL mode"""
+        self.assertIs(self.db.connection(), self.db.connection())
+        self.assertIs(get_connection_manager(self.db_path), self.db)
+        
+        journal_mode = self.db.cursor().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(journal_mode.lower(), "wal")
+        
+        other = []
+        import threading
+        thread = threading.Thread(target=lambda: other.append(self.db.connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], self.db.connection())
+    
+    def test_nested_transaction_rollback(self):
+        """Test that nested blocks join the outer transaction"""
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction() as cursor:
+                cursor.execute("INSERT INTO items VALUES (1)")
+                with self.db.transaction() as inner:
+                    inner.execute("INSERT INTO items VALUES (2)")
+                raise RuntimeError("abort")
+        
+        count = self.db.cursor().execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        self.assertEqual(count, 0)
+        
+        with self.db.transaction() as cursor:
+            cursor.executemany("INSERT INTO items VALUES (?)", [(1,), (2,), (3,)])
+        count = self.db.cursor().execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        self.assertEqual(count, 3)
 
 
 class TestEncryptionEngine(unittest.TestCase):
@@ -157,6 +364,9 @@ class TestEncryptionEngine(unittest.TestCase):
     
     def tearDown(self):
         """Clean up temporary files after tests"""
+        # Release pooled connections to the test database
+        get_connection_manager(self.db_path).close_all()
+        
         time.sleep(0.1)  # Give time for file handles to be released
         try:
             shutil.rmtree(self.test_dir)
@@ -234,7 +444,108 @@ class TestEncryptionEngine(unittest.TestCase):
         engine = EncryptionEngine(self.key_manager)
         with self.assertRaises(ValueError):
             engine.encrypt_segment(b"data", os.urandom(32), "InvalidAlgorithm")
+    
+    def test_auto_algorithm_benchmarks_once_per_host(self):
+        """Test that "auto" picks the faster cipher and caches the choice"""
+        throughput = {"AES-256-GCM": 100.0, "ChaCha20-Poly1305": 400.0}
+        with mock.patch.object(
+            EncryptionEngine, "benchmark_algorithms", return_value=throughput
+        ) as benchmark:
+            engine = EncryptionEngine(self.key_manager, "auto")
+            self.assertEqual(engine.default_algorithm, "ChaCha20-Poly1305")
+            
+            # A second engine on the same host reuses the stored profile
+            engine = EncryptionEngine(self.key_manager, "auto")
+            self.assertEqual(engine.default_algorithm, "ChaCha20-Poly1305")
+            benchmark.assert_called_once()
+        
+        profile = self.key_manager.get_host_profile("aead")
+        self.assertEqual(profile["throughput_mb_s"], throughput)
+        
+        # A real benchmark returns a figure for every algorithm
+        measured = self.encryption_engine.benchmark_algorithms(sample_size=4096, rounds=1)
+        self.assertEqual(set(measured), set(EncryptionEngine.ALGORITHMS))
+    
+    def test_seal_open_keeps_tag_adjacent(self):
+        """Test the ciphertext||tag layout with and without preallocated buffers"""
+        segment_key = os.urandom(32)
+        plaintext = os.urandom(4096)
+        
+        for algorithm in ("AES-256-GCM", "ChaCha20-Poly1305"):
+            result = self.encryption_engine.seal_segment(plaintext, segment_key, algorithm)
+            sealed = result["sealed"]
+            self.assertEqual(len(sealed), len(plaintext) + 16)
+            self.assertEqual(bytes(sealed[-16:]), result["tag"])
+            
+            # The same bytes work with the legacy split API
+            decrypted = self.encryption_engine.decrypt_segment(
+                bytes(sealed[:-16]), result["nonce"], result["tag"], algorithm, segment_key
+            )
+            self.assertEqual(decrypted, plaintext)
+            
+            # Oversized caller buffers are used through a view of the exact size
+            out = bytearray(len(plaintext) + 64)
+            decrypted = self.encryption_engine.open_segment(
+                memoryview(sealed), result["nonce"], algorithm, segment_key, out=out
+            )
+            self.assertEqual(bytes(decrypted), plaintext)
+    
+    def test_seal_open_without_aead_into(self):
+        """Test the fallback for cryptography releases without encrypt_into"""
+        segment_key = os.urandom(32)
+        plaintext = b"fallback path data"
+        
+        engine_module = sys.modules[EncryptionEngine.__module__]
+        with mock.patch.object(engine_module, "AEAD_INTO_AVAILABLE", False):
+            result = self.encryption_engine.seal_segment(plaintext, segment_key)
+            decrypted = self.encryption_engine.open_segment(
+                result["sealed"], result["nonce"], result["algorithm"], segment_key
+            )
+        self.assertEqual(decrypted, plaintext)
 
+    
+    def test_stream_roundtrip(self):
+        """Test the chunked streaming format at and around chunk boundaries"""
+        segment_key = os.urandom(32)
+        chunk_size = 64
+        
+        for size in (0, 1, 63, 64, 65, 128, 1000):
+            plaintext = os.urandom(size)
+            encrypted = io.BytesIO()
+            result = self.encryption_engine.encrypt_stream(
+                io.BytesIO(plaintext), encrypted, segment_key, chunk_size=chunk_size
+            )
+            self.assertEqual(result["plaintext_size"], size)
+            self.assertEqual(len(encrypted.getvalue()), size + 16 * result["chunk_count"])
+            
+            decrypted = io.BytesIO()
+            written = self.encryption_engine.decrypt_stream(
+                io.BytesIO(encrypted.getvalue()), decrypted, result["nonce"],
+                result["algorithm"], segment_key, chunk_size
+            )
+            self.assertEqual(written, size)
+            self.assertEqual(decrypted.getvalue(), plaintext)
+    
+    def test_stream_detects_truncation_and_reordering(self):
+        """Test that dropping or swapping whole chunks fails authentication"""
+        segment_key = os.urandom(32)
+        chunk_size = 32
+        stored = chunk_size + 16
+        
+        encrypted = io.BytesIO()
+        result = self.encryption_engine.encrypt_stream(
+            io.BytesIO(os.urandom(chunk_size * 3)), encrypted, segment_key, chunk_size=chunk_size
+        )
+        data = encrypted.getvalue()
+        
+        truncated = data[:stored * 2]
+        swapped = data[stored:stored * 2] + data[:stored] + data[stored * 2:]
+        for tampered in (truncated, swapped):
+            with self.assertRaises(Exception):
+                self.encryption_engine.decrypt_stream(
+                    io.BytesIO(tampered), io.BytesIO(), result["nonce"],
+                    result["algorithm"], segment_key, chunk_size
+                )
 
 class TestMetadataHandler(unittest.TestCase):
     """Test cases for the MetadataHandler class"""
@@ -296,6 +607,75 @@ class TestMetadataHandler(unittest.TestCase):
         # The nonce and tag should be bytes after deserialization
         self.assertEqual(deserialized["nonce"], nonce)
         self.assertEqual(deserialized["tag"], tag)
+    
+    def _full_metadata(self):
+        """Metadata using every optional field"""
+        file_id = "0f8fad5b-d9cb-469f-a165-70867728950e"
+        return self.metadata_handler.generate_segment_metadata(
+            f"{file_id}_7", file_id, 7, "ChaCha20-Poly1305", os.urandom(12), os.urandom(16), 4096,
+            sealed=True, chunk_size=65536, plaintext_size=8000, compression="zstd",
+            content_id=os.urandom(32).hex(), wrapped_key=os.urandom(60),
+            segment_hash=os.urandom(32).hex()
+        )
+    
+    def test_binary_codec_roundtrip(self):
+        """Test that both codecs decode to the same metadata"""
+        binary_handler = MetadataHandler("binary")
+        for metadata in (self._full_metadata(), self.metadata_handler.generate_segment_metadata(
+                "0f8fad5b-d9cb-469f-a165-70867728950e_0", "0f8fad5b-d9cb-469f-a165-70867728950e",
+                0, "AES-256-GCM", os.urandom(12), os.urandom(16), 10)):
+            from_json = self.metadata_handler.deserialize_metadata(
+                self.metadata_handler.serialize_metadata(metadata)
+            )
+            packed = binary_handler.serialize_metadata(metadata)
+            self.assertEqual(len(packed), BinaryMetadataCodec.RECORD.size)
+            self.assertEqual(binary_handler.deserialize_metadata(packed), from_json)
+            # Either handler reads either format
+            self.assertEqual(self.metadata_handler.deserialize_metadata(packed), from_json)
+    
+    def test_read_identity(self):
+        """Test reading file_id and segment_index without decoding the rest"""
+        metadata = self._full_metadata()
+        expected = (metadata["file_id"], 7)
+        
+        packed = MetadataHandler("binary").serialize_metadata(metadata)
+        self.assertEqual(self.metadata_handler.read_identity(packed[:BinaryMetadataCodec.IDENTITY.size]), expected)
+        self.assertEqual(
+            self.metadata_handler.read_identity(self.metadata_handler.serialize_metadata(metadata)), expected
+        )
+        with self.assertRaises(ValueError):
+            BinaryMetadataCodec().read_identity(b"XXXX" + packed[4:])
+    
+    def test_binary_codec_segment_range(self):
+        """Test both codecs across the segment index range and that binary records are smaller"""
+        file_id = "0f8fad5b-d9cb-469f-a165-70867728950e"
+        binary_handler = MetadataHandler("binary")
+        for segment_index in list(range(0, 2 ** 32, 2 ** 24)) + [2 ** 32 - 1]:
+            metadata = self.metadata_handler.generate_segment_metadata(
+                f"{file_id}_{segment_index}", file_id, segment_index, "AES-256-GCM",
+                os.urandom(12), os.urandom(16), 4096,
+                sealed=True, plaintext_size=4096, segment_hash=os.urandom(32).hex()
+            )
+            encoded_json = self.metadata_handler.serialize_metadata(metadata)
+            packed = binary_handler.serialize_metadata(metadata)
+            
+            self.assertLess(len(packed), len(encoded_json))
+            self.assertEqual(binary_handler.deserialize_metadata(packed),
+                             binary_handler.deserialize_metadata(encoded_json))
+            self.assertEqual(
+                self.metadata_handler.read_identity(packed[:BinaryMetadataCodec.IDENTITY.size]),
+                (file_id, segment_index)
+            )
+    
+    def test_codec_validation(self):
+        """Test that unknown codecs and non-UUID file_ids are rejected"""
+        with self.assertRaises(ValueError):
+            MetadataHandler("xml")
+        
+        metadata = self._full_metadata()
+        metadata["file_id"] = "test-file"
+        with self.assertRaises(ValueError):
+            MetadataHandler("binary").serialize_metadata(metadata)
 
 
 class TestSegmentEncryptor(unittest.TestCase):
@@ -309,6 +689,9 @@ class TestSegmentEncryptor(unittest.TestCase):
     
     def tearDown(self):
         """Clean up temporary files after tests"""
+        # Release pooled connections to the test database
+        get_connection_manager(self.db_path).close_all()
+        
         # Close any open connections to the database
         try:
             conn = sqlite3.connect(self.db_path)
@@ -435,6 +818,524 @@ class TestSegmentEncryptor(unittest.TestCase):
         self.assertEqual(decrypted, large_segment)
 
 
+    def test_password_unlock_derives_once_per_file(self):
+        """Test that decrypting many segments by password runs the KDF once"""
+        password = "test-password-cache"
+        file_id, master_key = self.encryptor.setup_encryption(password)
+        
+        encrypted = [
+            self.encryptor.encrypt_file_segment(file_id, master_key, f"segment {i}".encode(), i)
+            for i in range(5)
+        ]
+        
+        derive = self.encryptor.key_manager.derive_master_key
+        with mock.patch.object(self.encryptor.key_manager, "derive_master_key",
+                               side_effect=derive) as derive_mock:
+            for i, (ciphertext, _, serialized_metadata) in enumerate(encrypted):
+                decrypted = self.encryptor.decrypt_file_segment(
+                    ciphertext, serialized_metadata, password=password
+                )
+                self.assertEqual(decrypted, f"segment {i}".encode())
+        
+        self.assertEqual(derive_mock.call_count, 1)
+    
+    def test_cached_key_requires_same_password(self):
+        """Test that a cached master key is not handed out for a wrong password"""
+        password = "test-password-cache-wrong"
+        file_id, master_key = self.encryptor.setup_encryption(password)
+        ciphertext, _, serialized_metadata = self.encryptor.encrypt_file_segment(
+            file_id, master_key, b"cached segment", 0
+        )
+        
+        self.encryptor.unlock_master_key(file_id, password)
+        with self.assertRaises(ValueError):
+            self.encryptor.decrypt_file_segment(
+                ciphertext, serialized_metadata, password="not-the-password"
+            )
+
+
+    def test_password_unlock_uses_stored_kdf_params(self):
+        """Test that password decryption uses the parameters stored with the file"""
+        password = "test-password-stored-params"
+        file_id, master_key = self.encryptor.setup_encryption(password)
+        ciphertext, _, serialized_metadata = self.encryptor.encrypt_file_segment(
+            file_id, master_key, b"stored params segment", 0
+        )
+        
+        # A later calibration must not affect files created before it
+        kdf_type = self.encryptor.key_manager.get_master_key_info(file_id)["kdf_type"]
+        if kdf_type == "argon2id":
+            kdf_params = {"time_cost": 2, "memory_cost": 19456, "parallelism": 1, "hash_len": 32}
+        else:
+            kdf_params = {"algorithm": "sha256", "iterations": 600001, "length": 32}
+        self.encryptor.key_manager.store_host_profile(
+            "kdf", {"kdf_type": kdf_type, "kdf_params": kdf_params}
+        )
+        
+        decrypted = self.encryptor.decrypt_file_segment(
+            ciphertext, serialized_metadata, password=password
+        )
+        self.assertEqual(decrypted, b"stored params segment")
+
+
+    def test_bulk_encrypt_single_transaction(self):
+        """Test that bulk encryption registers all segments with one commit"""
+        password = "test-password-bulk"
+        file_id, master_key = self.encryptor.setup_encryption(password)
+        segments = [f"bulk segment {i}".encode() for i in range(50)]
+        
+        statements = []
+        self.encryptor.key_manager.db.connection().set_trace_callback(statements.append)
+        try:
+            results = self.encryptor.encrypt_file_segments(file_id, master_key, segments)
+        finally:
+            self.encryptor.key_manager.db.connection().set_trace_callback(None)
+        
+        self.assertEqual(statements.count("COMMIT"), 1)
+        self.assertEqual(len(results), len(segments))
+        
+        for i, (ciphertext, metadata, serialized_metadata) in enumerate(results):
+            self.assertEqual(metadata["segment_index"], i)
+            stored = self.encryptor.key_manager.get_segment_key_info(metadata["segment_id"])
+            self.assertEqual(stored["nonce"], b64decode(metadata["nonce"]))
+            self.assertEqual(
+                self.encryptor.decrypt_file_segment(
+                    ciphertext, serialized_metadata, master_key=master_key
+                ),
+                segments[i]
+            )
+
+
+    def test_async_setup_and_unlock(self):
+        """Test that background setup and unlock match the synchronous calls"""
+        password = "test-password-async"
+        file_id, master_key = self.encryptor.setup_encryption_async(password).result()
+        self.assertIsNotNone(self.encryptor.key_manager.get_master_key_info(file_id))
+        
+        self.encryptor.lock_master_key(file_id)
+        unlocked = self.encryptor.unlock_master_key_async(file_id, password).result()
+        self.assertEqual(unlocked, master_key)
+        
+        with self.assertRaises(ValueError):
+            self.encryptor.unlock_master_key_async(file_id, "wrong-password").result()
+    
+    def test_segment_keys_leave_with_master_key(self):
+        """Test that a file's cached segment keys are dropped on lock and on master key expiry"""
+        encryptor = SegmentEncryptor(self.db_path, key_cache_ttl=0.05)
+        key_manager = encryptor.key_manager
+        password = "test-password-expiry"
+        file_id, _ = encryptor.setup_encryption(password)
+        
+        def cached_segment_keys():
+            return [cache_key for cache_key in key_manager._segment_key_cache if cache_key[0] == file_id]
+        
+        encryptor.prepare_segment_keys(file_id, encryptor.unlock_master_key(file_id, password), range(3))
+        self.assertEqual(len(cached_segment_keys()), 3)
+        time.sleep(0.1)
+        self.assertEqual(len(encryptor.key_cache), 0)
+        self.assertEqual(cached_segment_keys(), [])
+        
+        encryptor.key_cache.ttl = 60
+        encryptor.prepare_segment_keys(file_id, encryptor.unlock_master_key(file_id, password), range(3))
+        self.assertEqual(len(cached_segment_keys()), 3)
+        encryptor.lock_master_key(file_id)
+        self.assertEqual(cached_segment_keys(), [])
+
+
+    def test_vault_mode_unlocks_many_files_with_one_kdf(self):
+        """Test that files in a vault share one key derivation per session"""
+        password = "vault-password"
+        files = []
+        for i in range(3):
+            file_id, master_key = self.encryptor.setup_encryption(password, vault_id="default")
+            encrypted_data, _, metadata = self.encryptor.encrypt_file_segment(
+                file_id, master_key, f"vault data {i}".encode(), 0
+            )
+            files.append((file_id, master_key, encrypted_data, metadata))
+        
+        # Master keys are random and stored wrapped, never derived per file
+        self.assertEqual(len({master_key for _, master_key, _, _ in files}), 3)
+        key_info = self.encryptor.key_manager.get_master_key_info(files[0][0])
+        self.assertIsNotNone(key_info["encrypted_key"])
+        self.assertEqual(json.loads(key_info["encryption_info"])["vault_id"], "default")
+        
+        self.encryptor.lock_master_key()
+        with mock.patch.object(
+            self.encryptor.key_manager, "derive_master_key",
+            wraps=self.encryptor.key_manager.derive_master_key
+        ) as derive:
+            for i, (file_id, master_key, encrypted_data, metadata) in enumerate(files):
+                self.assertEqual(self.encryptor.unlock_master_key(file_id, password), master_key)
+                decrypted = self.encryptor.decrypt_file_segment(
+                    encrypted_data, metadata, password=password
+                )
+                self.assertEqual(decrypted, f"vault data {i}".encode())
+            self.assertEqual(derive.call_count, 1)
+        
+        self.encryptor.lock_master_key()
+        with self.assertRaises(ValueError):
+            self.encryptor.unlock_master_key(files[0][0], "wrong-password")
+
+
+    def test_legacy_metadata_without_sealed_flag(self):
+        """Test that segments stored without their tag still decrypt"""
+        password = "test-password-legacy"
+        file_id, master_key = self.encryptor.setup_encryption(password)
+        segment_id = f"{file_id}_0"
+        segment_key = self.encryptor.key_manager.derive_segment_key(master_key, segment_id, file_id)
+        
+        # Old layout: tag only in metadata, ciphertext on its own
+        result = self.encryptor.encryption_engine.encrypt_segment(b"legacy segment", segment_key)
+        metadata = self.encryptor.metadata_handler.generate_segment_metadata(
+            segment_id, file_id, 0, result["algorithm"], result["nonce"],
+            result["tag"], len(result["ciphertext"])
+        )
+        self.assertNotIn("sealed", metadata)
+        
+        decrypted = self.encryptor.decrypt_file_segment(
+            result["ciphertext"], json.dumps(metadata), master_key=master_key
+        )
+        self.assertEqual(decrypted, b"legacy segment")
+        
+        # New segments are sealed
+        _, new_metadata, _ = self.encryptor.encrypt_file_segment(file_id, master_key, b"new", 1)
+        self.assertTrue(new_metadata["sealed"])
+        self.assertEqual(new_metadata["plaintext_size"], 3)
+
+
+    def test_stream_segment_roundtrip(self):
+        """Test encrypting and decrypting a segment through file objects"""
+        password = "test-password-stream"
+        file_id, master_key = self.encryptor.setup_encryption(password)
+        plaintext = os.urandom(5000)
+        
+        encrypted = io.BytesIO()
+        metadata, serialized_metadata = self.encryptor.encrypt_file_segment_stream(
+            file_id, master_key, io.BytesIO(plaintext), encrypted, 0, chunk_size=1024
+        )
+        self.assertEqual(metadata["chunk_size"], 1024)
+        self.assertEqual(metadata["plaintext_size"], len(plaintext))
+        self.assertIsNotNone(self.encryptor.key_manager.get_segment_key_info(f"{file_id}_0"))
+        
+        decrypted = io.BytesIO()
+        self.encryptor.decrypt_file_segment_stream(
+            io.BytesIO(encrypted.getvalue()), decrypted, serialized_metadata, password=password
+        )
+        self.assertEqual(decrypted.getvalue(), plaintext)
+
+
+    def test_compressed_segment_roundtrip(self):
+        """Test that compressible segments are compressed and recorded"""
+        password = "test-password-compress"
+        file_id, master_key = self.encryptor.setup_encryption(password)
+        text = b"".join(b"2024-01-01 INFO request %d served in 12ms\n" % i for i in range(2000))
+        
+        for index, codec in enumerate(self.encryptor.compressor.available_codecs()):
+            encrypted, metadata, serialized_metadata = self.encryptor.encrypt_file_segment(
+                file_id, master_key, text, index, compression=codec
+            )
+            self.assertEqual(metadata["compression"], codec)
+            self.assertEqual(metadata["plaintext_size"], len(text))
+            self.assertLess(len(encrypted), len(text) // 4)
+            
+            segment_info = self.encryptor.key_manager.get_segment_key_info(f"{file_id}_{index}")
+            self.assertEqual(segment_info["compression"], codec)
+            
+            decrypted = self.encryptor.decrypt_file_segment(
+                encrypted, serialized_metadata, master_key=master_key
+            )
+            self.assertEqual(bytes(decrypted), text)
+        
+        # Random data fails the sample check and is stored as-is
+        noise = os.urandom(20000)
+        _, metadata, _ = self.encryptor.encrypt_file_segment(
+            file_id, master_key, noise, 10, compression="zlib"
+        )
+        self.assertNotIn("compression", metadata)
+    
+    def test_compressed_stream_segment_roundtrip(self):
+        """Test compression combined with the streaming format"""
+        password = "test-password-compress-stream"
+        file_id, master_key = self.encryptor.setup_encryption(password)
+        text = b"".join(b"line %d of a long log file\n" % i for i in range(20000))
+        
+        encrypted = io.BytesIO()
+        metadata, serialized_metadata = self.encryptor.encrypt_file_segment_stream(
+            file_id, master_key, io.BytesIO(text), encrypted, 0,
+            chunk_size=4096, compression="zlib"
+        )
+        self.assertEqual(metadata["compression"], "zlib")
+        self.assertEqual(metadata["plaintext_size"], len(text))
+        self.assertLess(len(encrypted.getvalue()), len(text) // 2)
+        
+        decrypted = io.BytesIO()
+        written = self.encryptor.decrypt_file_segment_stream(
+            io.BytesIO(encrypted.getvalue()), decrypted, serialized_metadata, master_key=master_key
+        )
+        self.assertEqual(written, len(text))
+        self.assertEqual(decrypted.getvalue(), text)
+    
+    def test_dedup_blob_recreated_unchanged(self):
+        """Test that encrypting an indexed dedup blob again reproduces the stored ciphertext"""
+        data = b"shared segment " * 2000
+        digest = hashlib.sha256(data).digest()
+        sealed, blob_info = self.encryptor.encrypt_dedup_blob(digest, data, compression="zlib")
+        
+        again, again_info = self.encryptor.encrypt_dedup_blob(digest, data)
+        self.assertEqual(bytes(again), bytes(sealed))
+        self.assertEqual(again_info, blob_info)
+        
+        data = os.urandom(20000)
+        digest = hashlib.sha256(data).digest()
+        first = io.BytesIO()
+        blob_info = self.encryptor.encrypt_dedup_blob_stream(digest, io.BytesIO(data), first, chunk_size=4096)
+        second = io.BytesIO()
+        again_info = self.encryptor.encrypt_dedup_blob_stream(digest, io.BytesIO(data), second)
+        self.assertEqual(second.getvalue(), first.getvalue())
+        self.assertEqual(again_info, blob_info)
+        
+        # Different data under an indexed blob's content ID is refused
+        with self.assertRaises(ValueError):
+            self.encryptor.encrypt_dedup_blob(digest, data[:-1] + b"x")
+    
+    def test_dedup_blob_shared_across_files(self):
+        """Test that two files reference one blob, each through its own password"""
+        data = os.urandom(50000)
+        digest = hashlib.sha256(data).digest()
+        content_id = self.encryptor.dedup_content_id(digest)
+        
+        # The content ID is keyed, not the bare plaintext hash
+        self.assertNotEqual(content_id, digest.hex())
+        
+        sealed, blob_info = self.encryptor.encrypt_dedup_blob(digest, data)
+        self.assertEqual(blob_info["content_id"], content_id)
+        self.assertEqual(blob_info["refcount"], 0)
+        
+        files = []
+        for password in ("password-one", "password-two"):
+            file_id, master_key = self.encryptor.setup_encryption(password)
+            metadata, serialized_metadata = self.encryptor.reference_dedup_blob(
+                file_id, master_key, 0, digest, blob_info
+            )
+            self.assertEqual(metadata["content_id"], content_id)
+            files.append((file_id, password, serialized_metadata))
+        
+        self.assertEqual(self.encryptor.key_manager.get_dedup_blob(content_id)["refcount"], 2)
+        
+        for file_id, password, serialized_metadata in files:
+            decrypted = self.encryptor.decrypt_file_segment(
+                sealed, serialized_metadata, password=password
+            )
+            self.assertEqual(bytes(decrypted), data)
+        
+        # One file's key cannot unwrap the data key held by the other
+        other_key = self.encryptor.unlock_master_key(files[0][0], files[0][1])
+        with self.assertRaises(ValueError):
+            self.encryptor.decrypt_file_segment(sealed, files[1][2], master_key=other_key)
+    
+    def test_segment_hash_recorded(self):
+        """Test that the keyed segment hash is stored for update comparisons"""
+        file_id, master_key = self.encryptor.setup_encryption("password-hash")
+        data = os.urandom(1000)
+        segment_hash = self.encryptor.dedup_content_id(hashlib.sha256(data).digest())
+        
+        _, metadata, _ = self.encryptor.encrypt_file_segment(
+            file_id, master_key, data, 0, segment_hash=segment_hash
+        )
+        self.assertEqual(metadata["segment_hash"], segment_hash)
+        segment_info = self.encryptor.key_manager.get_segment_key_info(f"{file_id}_0")
+        self.assertEqual(segment_info["segment_hash"], segment_hash)
+        
+        # Identical content hashes the same; different content doesn't
+        self.assertEqual(
+            self.encryptor.dedup_content_id(hashlib.sha256(bytes(data)).digest()), segment_hash
+        )
+        self.assertNotEqual(
+            self.encryptor.dedup_content_id(hashlib.sha256(data + b"x").digest()), segment_hash
+        )
+    
+    def test_stream_segment_hash(self):
+        """Test that a streamed segment can hash its plaintext while it is encrypted"""
+        file_id, master_key = self.encryptor.setup_encryption("password-stream-hash")
+        for segment_index, (data, compression) in enumerate([
+            (os.urandom(30000), None),
+            (b"compressible " * 5000, "zlib"),
+        ]):
+            segment_hash = self.encryptor.dedup_content_id(hashlib.sha256(data).digest())
+            metadata, _ = self.encryptor.encrypt_file_segment_stream(
+                file_id, master_key, io.BytesIO(data), io.BytesIO(), segment_index,
+                chunk_size=4096, compression=compression, hash_plaintext=True
+            )
+            self.assertEqual(metadata.get("compression"), compression)
+            self.assertEqual(metadata["segment_hash"], segment_hash)
+            segment_info = self.encryptor.key_manager.get_segment_key_info(f"{file_id}_{segment_index}")
+            self.assertEqual(segment_info["segment_hash"], segment_hash)
+    
+    def test_dedup_stream_blob_roundtrip(self):
+        """Test dedup blobs in the streaming chunked format"""
+        data = os.urandom(30000)
+        digest = hashlib.sha256(data).digest()
+        blob = io.BytesIO()
+        blob_info = self.encryptor.encrypt_dedup_blob_stream(
+            digest, io.BytesIO(data), blob, chunk_size=4096
+        )
+        
+        file_id, master_key = self.encryptor.setup_encryption("password-stream")
+        metadata, serialized_metadata = self.encryptor.reference_dedup_blob(
+            file_id, master_key, 0, digest, blob_info
+        )
+        self.assertEqual(metadata["chunk_size"], 4096)
+        
+        decrypted = io.BytesIO()
+        self.encryptor.decrypt_file_segment_stream(
+            io.BytesIO(blob.getvalue()), decrypted, serialized_metadata, master_key=master_key
+        )
+        self.assertEqual(decrypted.getvalue(), data)
+    
+    def test_segment_container_roundtrip(self):
+        """Test that a container holds the metadata and ciphertext of a segment in one file"""
+        container = SegmentContainer()
+        file_id, master_key = self.encryptor.setup_encryption("password-container")
+        data = os.urandom(5000)
+        segment_hash = self.encryptor.dedup_content_id(hashlib.sha256(data).digest())
+        
+        sealed, metadata, serialized_metadata = self.encryptor.encrypt_file_segment(
+            file_id, master_key, data, 3, compression="zlib", segment_hash=segment_hash
+        )
+        stored = container.pack_header(metadata, len(sealed)) + bytes(sealed)
+        
+        reader = io.BytesIO(stored)
+        header_metadata, body_length = container.read_header(reader)
+        self.assertEqual(body_length, len(sealed))
+        self.assertEqual(
+            header_metadata, self.encryptor.metadata_handler.deserialize_metadata(serialized_metadata)
+        )
+        
+        decrypted = self.encryptor.decrypt_file_segment(
+            reader.read(), header_metadata, master_key=master_key
+        )
+        self.assertEqual(bytes(decrypted), data)
+    
+    def test_segment_container_stream_and_dedup(self):
+        """Test containers for streamed segments and header-only dedup references"""
+        container = SegmentContainer()
+        file_id, master_key = self.encryptor.setup_encryption("password-container")
+        data = os.urandom(20000)
+        
+        writer = io.BytesIO()
+        writer.write(bytes(container.HEADER_SIZE))
+        metadata, _ = self.encryptor.encrypt_file_segment_stream(
+            file_id, master_key, io.BytesIO(data), writer, 0, chunk_size=4096
+        )
+        writer.seek(0)
+        writer.write(container.pack_header(metadata, len(writer.getvalue()) - container.HEADER_SIZE))
+        
+        reader = io.BytesIO(writer.getvalue())
+        header_metadata, _ = container.read_header(reader)
+        self.assertEqual(header_metadata["chunk_size"], 4096)
+        decrypted = io.BytesIO()
+        self.encryptor.decrypt_file_segment_stream(
+            reader, decrypted, header_metadata, master_key=master_key
+        )
+        self.assertEqual(decrypted.getvalue(), data)
+        
+        # A dedup reference carries the wrapped data key and no body
+        digest = hashlib.sha256(data).digest()
+        sealed, blob_info = self.encryptor.encrypt_dedup_blob(digest, data)
+        metadata, _ = self.encryptor.reference_dedup_blob(file_id, master_key, 1, digest, blob_info)
+        header_metadata, body_length = container.unpack_header(container.pack_header(metadata, 0))
+        self.assertEqual(body_length, 0)
+        self.assertEqual(header_metadata["content_id"], blob_info["content_id"])
+        decrypted = self.encryptor.decrypt_file_segment(
+            sealed, header_metadata, master_key=master_key
+        )
+        self.assertEqual(bytes(decrypted), data)
+    
+    def test_segment_container_rejects_bad_header(self):
+        """Test that other data and unknown versions are not read as containers"""
+        container = SegmentContainer()
+        file_id, master_key = self.encryptor.setup_encryption("password-container")
+        _, metadata, _ = self.encryptor.encrypt_file_segment(file_id, master_key, b"data", 0)
+        header = bytearray(container.pack_header(metadata, 20))
+        
+        self.assertTrue(container.is_container(header))
+        self.assertFalse(container.is_container(b"\x00" * 8))
+        with self.assertRaises(ValueError):
+            container.unpack_header(header[:-1])
+        
+        header[4] = 99
+        with self.assertRaises(ValueError):
+            container.unpack_header(header)
+
+
+class TestMasterKeyCache(unittest.TestCase):
+    """Test cases for the MasterKeyCache class"""
+    
+    def test_ttl_expiry(self):
+        """Test that entries expire after the TTL"""
+        cache = MasterKeyCache(ttl=0.05, max_entries=4)
+        cache.put("file-1", "pw", b"k" * 32)
+        self.assertEqual(cache.get("file-1", "pw"), b"k" * 32)
+        
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("file-1", "pw"))
+        self.assertEqual(len(cache), 0)
+    
+    def test_size_eviction_zeroes_key(self):
+        """Test that the least recently used key is evicted and zeroed"""
+        cache = MasterKeyCache(ttl=60, max_entries=2)
+        cache.put("file-1", "pw", b"\x01" * 32)
+        evicted_buffer = cache._entries["file-1"][0]
+        
+        cache.put("file-2", "pw", b"\x02" * 32)
+        cache.put("file-3", "pw", b"\x03" * 32)
+        
+        self.assertIsNone(cache.get("file-1", "pw"))
+        self.assertEqual(bytes(evicted_buffer), b"\x00" * 32)
+        self.assertEqual(cache.get("file-3", "pw"), b"\x03" * 32)
+    
+    def test_evict_and_clear(self):
+        """Test explicit eviction of one key and of all keys"""
+        cache = MasterKeyCache()
+        cache.put("file-1", "pw", os.urandom(32))
+        cache.put("file-2", "pw", os.urandom(32))
+        
+        cache.evict("file-1")
+        self.assertIsNone(cache.get("file-1", "pw"))
+        self.assertIsNotNone(cache.get("file-2", "pw"))
+        
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+    
+    def test_on_evict_reports_every_removal(self):
+        """Test that expired, evicted, dropped and cleared entries are reported"""
+        removed = []
+        cache = MasterKeyCache(ttl=0.05, max_entries=2, on_evict=removed.append)
+        cache.put("expired", "pw", os.urandom(32))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("expired", "pw"))
+        self.assertEqual(removed, ["expired"])
+        
+        cache.ttl = 60
+        for file_id in ("file-1", "file-2", "file-3"):
+            cache.put(file_id, "pw", os.urandom(32))
+        cache.evict("file-2")
+        cache.clear()
+        self.assertEqual(removed, ["expired", "file-1", "file-2", "file-3"])
+    
+    def test_get_returns_zeroable_buffer(self):
+        """Test that the key handed out is the cache's buffer and is wiped with its entry"""
+        cache = MasterKeyCache(ttl=0.05)
+        stored = cache.put("file-1", "pw", b"\x01" * 32)
+        key = cache.get("file-1", "pw")
+        self.assertIsInstance(key, bytearray)
+        self.assertIs(key, stored)
+        
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("file-1", "pw"))
+        self.assertEqual(bytes(key), b"\x00" * 32)
+
+
 class TestEncryptionSecurity(unittest.TestCase):
     """Test cases focusing on security properties"""
     
@@ -446,6 +1347,9 @@ class TestEncryptionSecurity(unittest.TestCase):
     
     def tearDown(self):
         """Clean up temporary files after tests"""
+        # Release pooled connections to the test database
+        get_connection_manager(self.db_path).close_all()
+        
         time.sleep(0.1)
         try:
             shutil.rmtree(self.test_dir)
@@ -533,6 +1437,9 @@ class TestRealWorldScenarios(unittest.TestCase):
     
     def tearDown(self):
         """Clean up temporary files after tests"""
+        # Release pooled connections to the test database
+        get_connection_manager(self.db_path).close_all()
+        
         time.sleep(0.1)
         try:
             shutil.rmtree(self.test_dir)
@@ -626,6 +1533,9 @@ class TestEncryptionPerformance(unittest.TestCase):
     
     def tearDown(self):
         """Clean up temporary files after tests"""
+        # Release pooled connections to the test database
+        get_connection_manager(self.db_path).close_all()
+        
         time.sleep(0.1)
         try:
             shutil.rmtree(self.test_dir)
@@ -694,15 +1604,25 @@ class TestEncryptionPerformance(unittest.TestCase):
             )
         segment_key_time = time.time() - start_time
         
+        # Measure bulk derivation of the same number of keys for a fresh file
+        bulk_file_id = "test-file-speed-bulk"
+        start_time = time.time()
+        self.encryptor.key_manager.derive_segment_keys(
+            master_key, [f"segment_{i}" for i in range(100)], bulk_file_id
+        )
+        bulk_segment_key_time = time.time() - start_time
+        
         print("\nKey Derivation Speed Test:")
         print("--------------------------")
         print(f"Master Key (PBKDF2): {master_key_time:.6f}s")
         print(f"100 Segment Keys (HKDF): {segment_key_time:.6f}s")
         print(f"Average per segment key: {segment_key_time/100:.6f}s")
+        print(f"100 Segment Keys (bulk HKDF): {bulk_segment_key_time:.6f}s")
         
         # Basic performance assertions
         self.assertLess(master_key_time, 2.0, "Master key derivation too slow")
         self.assertLess(segment_key_time, 1.0, "Segment key derivation too slow")
+        self.assertLess(bulk_segment_key_time, 1.0, "Bulk segment key derivation too slow")
 
 
 if __name__ == "__main__":
@@ -1 +1,5 @@
-from .encryption import KeyManager, EncryptionEngine, MetadataHandler, SegmentEncryptor
\ No newline at end of file
+from .encryption import (
+    ConnectionManager, get_connection_manager, MasterKeyCache,
+    KeyManager, EncryptionEngine, SegmentCompressor,
+    JSONMetadataCodec, BinaryMetadataCodec, MetadataHandler, SegmentContainer, SegmentEncryptor
+)
\ No newline at end of file
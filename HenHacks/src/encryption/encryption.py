@@ -1,14 +1,27 @@
 import os
 import uuid
 import json
+import time
+import zlib
+import lzma
+import hmac
+import hashlib
+import socket
+import struct
+import binascii
 import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from base64 import b64encode, b64decode
 from datetime import datetime
 
 # Import cryptography components
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.asymmetric.padding import OAEP, MGF1
@@ -21,19 +34,309 @@ try:
 except ImportError:
     ARGON2_AVAILABLE = False
 
+# zstd compression is optional (requires the zstandard package)
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# encrypt_into/decrypt_into write straight into a caller-supplied buffer.
+# They only exist in newer cryptography releases, so fall back to encrypt/decrypt.
+AEAD_INTO_AVAILABLE = hasattr(AESGCM, "encrypt_into") and hasattr(ChaCha20Poly1305, "encrypt_into")
+
+# Size of the AEAD authentication tag for both supported algorithms
+TAG_SIZE = 16
+
+
+def _read_full(reader, buffer):
+    """Fill buffer from a binary file object, returning the bytes read (short only at EOF)"""
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(view):
+        count = reader.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+class ConnectionManager:
+    """
+    Thread-local pooled SQLite connections for one database file.
+
+    Each thread reuses a single connection for its lifetime instead of opening
+    one per statement, which also lets SQLite's per-connection prepared
+    statement cache do its job. Connections run in WAL mode so readers never
+    block the writer, with synchronous=NORMAL (durable at checkpoint, safe
+    against corruption) and a larger page cache.
+    """
+    
+    def __init__(self, db_path, cache_size_kib=16384, cached_statements=256, timeout=30.0):
+        """
+        Args:
+            db_path (str): Path to the SQLite database
+            cache_size_kib (int): Page cache size per connection in KiB
+            cached_statements (int): Prepared statements kept per connection
+            timeout (float): Seconds to wait for a lock held by another writer
+        """
+        self.db_path = db_path
+        self.cache_size_kib = cache_size_kib
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []  # every pooled connection, for close_all
+        self._lock = threading.Lock()
+    
+    def connection(self):
+        """Get this thread's connection, opening and tuning it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.timeout,
+                cached_statements=self.cached_statements,
+                check_same_thread=False  # Only ever used by its owning thread; close_all may run elsewhere
+            )
+            conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+    
+    def cursor(self):
+        """Get a cursor on this thread's connection (for reads)"""
+        return self.connection().cursor()
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block of statements as one transaction on this thread's connection
+        
+        Nested transaction blocks join the outermost one, which commits on
+        success and rolls back if the block raises.
+        
+        Yields:
+            sqlite3.Cursor: Cursor to execute statements with
+        """
+        conn = self.connection()
+        self._local.depth += 1
+        try:
+            yield conn.cursor()
+            if self._local.depth == 1:
+                conn.commit()
+        except BaseException:
+            if self._local.depth == 1:
+                conn.rollback()
+            raise
+        finally:
+            self._local.depth -= 1
+    
+    def close(self):
+        """Close the calling thread's connection"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+            self._local.conn = None
+    
+    def close_all(self):
+        """Close every pooled connection (e.g. before deleting the database)"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+_connection_managers = {}
+_connection_managers_lock = threading.Lock()
+
+def get_connection_manager(db_path):
+    """Get the shared ConnectionManager for a database path"""
+    key = os.path.abspath(db_path)
+    with _connection_managers_lock:
+        manager = _connection_managers.get(key)
+        if manager is None:
+            manager = ConnectionManager(db_path)
+            _connection_managers[key] = manager
+        return manager
+
+
+class MasterKeyCache:
+    """
+    Session-scoped cache of derived master keys, keyed by file_id.
+
+    Entries expire after a TTL and the least recently used entry is evicted
+    once the cache is full. Keys are held in bytearrays so they can be zeroed
+    when they leave the cache, and get() hands out that bytearray rather than
+    a copy: a key in use is wiped together with its entry. Each entry also
+    records a keyed tag of the password that unlocked it, so a cached key is
+    only handed out to callers presenting the same password.
+    """
+    
+    def __init__(self, ttl=300, max_entries=32, on_evict=None):
+        """
+        Args:
+            ttl (float): Seconds an unlocked key stays usable
+            max_entries (int): Maximum number of keys held at once
+            on_evict (callable, optional): Called with the file_id of every
+                entry that leaves the cache (expired, evicted or cleared),
+                after its key is zeroed
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # file_id -> (key, password_tag, expires_at)
+        self._secret = os.urandom(32)  # Per-process secret for password tags
+        self._lock = threading.Lock()
+    
+    def _password_tag(self, password):
+        """Keyed tag of the password, never stored or persisted in the clear"""
+        return hmac.new(self._secret, password.encode('utf-8'), hashlib.sha256).digest()
+    
+    def _zero(self, entry):
+        """Overwrite the key material of an evicted entry"""
+        key = entry[0]
+        for i in range(len(key)):
+            key[i] = 0
+    
+    def _evict_expired(self, now):
+        expired = [file_id for file_id, entry in self._entries.items() if entry[2] <= now]
+        for file_id in expired:
+            self._zero(self._entries.pop(file_id))
+        return expired
+    
+    def _notify(self, file_ids):
+        """Report entries that left the cache, outside the cache lock"""
+        if self.on_evict is not None:
+            for file_id in file_ids:
+                self.on_evict(file_id)
+    
+    def get(self, file_id, password):
+        """
+        Look up the master key for a file
+        
+        Args:
+            file_id (str): Identifier for the file
+            password (str): Password presented by the caller
+            
+        Returns:
+            bytearray: The cached master key, or None on a miss or password
+                mismatch. This is the cache's own buffer and is zeroed when
+                the entry expires, is evicted or is locked, so use it for the
+                current operation only; don't keep it or copy it.
+        """
+        with self._lock:
+            expired = self._evict_expired(time.monotonic())
+            entry = self._entries.get(file_id)
+            if entry is not None and hmac.compare_digest(entry[1], self._password_tag(password)):
+                self._entries.move_to_end(file_id)
+                key = entry[0]
+            else:
+                key = None
+        self._notify(expired)
+        return key
+    
+    def put(self, file_id, password, master_key):
+        """
+        Cache a verified master key for a file
+        
+        Returns:
+            bytearray: The cached copy of the key, on the same terms as get()
+        """
+        with self._lock:
+            now = time.monotonic()
+            evicted = self._evict_expired(now)
+            if file_id in self._entries:
+                # Replaced, not evicted: cached segment keys are checked against the new key's fingerprint
+                self._zero(self._entries.pop(file_id))
+            key = bytearray(master_key)
+            self._entries[file_id] = (key, self._password_tag(password), now + self.ttl)
+            while len(self._entries) > self.max_entries:
+                evicted_id, entry = self._entries.popitem(last=False)
+                self._zero(entry)
+                evicted.append(evicted_id)
+        self._notify(evicted)
+        return key
+    
+    def evict(self, file_id):
+        """Drop and zero the cached key for a file, if any"""
+        with self._lock:
+            entry = self._entries.pop(file_id, None)
+            if entry is not None:
+                self._zero(entry)
+        if entry is not None:
+            self._notify([file_id])
+    
+    def clear(self):
+        """Drop and zero every cached key"""
+        evicted = []
+        with self._lock:
+            while self._entries:
+                file_id, entry = self._entries.popitem()
+                self._zero(entry)
+                evicted.append(file_id)
+        self._notify(evicted)
+    
+    def __len__(self):
+        with self._lock:
+            expired = self._evict_expired(time.monotonic())
+            count = len(self._entries)
+        self._notify(expired)
+        return count
+
 
 class KeyManager:
-    def __init__(self, db_path):
+    # Cost parameters used when no host profile has been calibrated
+    DEFAULT_ARGON2_PARAMS = {
+        "time_cost": 3,
+        "memory_cost": 65536,
+        "parallelism": 4,
+        "hash_len": 32
+    }
+    DEFAULT_PBKDF2_PARAMS = {
+        "algorithm": "sha256",
+        "iterations": 600000,
+        "length": 32
+    }
+    
+    # Lower bounds the calibration will not go below (OWASP minimums)
+    MIN_ARGON2_MEMORY_COST = 19456
+    MIN_ARGON2_TIME_COST = 2
+    MIN_PBKDF2_ITERATIONS = 600000
+    
+    def __init__(self, db_path, segment_key_cache_size=4096):
         """Initialize the key manager with path to SQLite database"""
         self.db_path = db_path
+        self.db = get_connection_manager(db_path)
         self._init_database()
+        
+        # Derived segment keys, keyed by (file_id, segment_id)
+        self.segment_key_cache_size = segment_key_cache_size
+        self._segment_key_cache = OrderedDict()
+        self._segment_key_lock = threading.Lock()
+        self._fingerprint_secret = os.urandom(32)
+    
+    def close(self):
+        """Close all pooled connections to the key database"""
+        self.db.close_all()
     
     def _init_database(self):
         """Initialize the SQLite database for key storage"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create tables for master keys and segment keys if they don't exist
+        with self.db.transaction() as cursor:
+            self._create_tables(cursor)
+    
+    def _create_tables(self, cursor):
+        """Create tables for master keys and segment keys if they don't exist"""
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS master_keys (
             file_id TEXT PRIMARY KEY,
@@ -55,17 +358,76 @@ class KeyManager:
             encryption_algorithm TEXT NOT NULL,
             nonce BLOB NOT NULL,
             tag BLOB,
+            compression TEXT,
+            content_id TEXT,
+            wrapped_key BLOB,
+            segment_hash TEXT,
             FOREIGN KEY (file_id) REFERENCES master_keys(file_id)
         )
         ''')
         
+        # Databases created by older versions lack the newer segment columns
+        cursor.execute("PRAGMA table_info(segment_keys_info)")
+        columns = [row[1] for row in cursor.fetchall()]
+        for column, column_type in (("compression", "TEXT"), ("content_id", "TEXT"),
+                                    ("wrapped_key", "BLOB"), ("segment_hash", "TEXT")):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE segment_keys_info ADD COLUMN {column} {column_type}")
+        
+        # Per-host tuning results (e.g. calibrated KDF cost parameters)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS host_profiles (
+            host TEXT NOT NULL,
+            name TEXT NOT NULL,
+            profile TEXT NOT NULL,
+            updated TEXT NOT NULL,
+            PRIMARY KEY (host, name)
+        )
+        ''')
+        
+        # Password-derived key-encryption keys for keyring (vault) mode
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vaults (
+            vault_id TEXT PRIMARY KEY,
+            salt BLOB NOT NULL,
+            kdf_type TEXT NOT NULL,
+            kdf_params TEXT NOT NULL,
+            verification_hash BLOB NOT NULL,
+            creation_date TEXT NOT NULL
+        )
+        ''')
+        
+        # Deduplicated segment blobs shared by every file that contains them,
+        # keyed by content ID and counted by the segment_keys_info rows using them
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dedup_blobs (
+            content_id TEXT PRIMARY KEY,
+            encryption_algorithm TEXT NOT NULL,
+            nonce BLOB NOT NULL,
+            tag BLOB NOT NULL,
+            ciphertext_size INTEGER NOT NULL,
+            plaintext_size INTEGER NOT NULL,
+            chunk_size INTEGER,
+            compression TEXT,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            creation_date TEXT NOT NULL
+        )
+        ''')
+        
+        # Random per-user secrets (e.g. the key for dedup content IDs)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_secrets (
+            name TEXT PRIMARY KEY,
+            secret BLOB NOT NULL,
+            creation_date TEXT NOT NULL
+        )
+        ''')
+        
         # Create indexes for better query performance
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_segment_file ON segment_keys_info(file_id)")
-        
-        conn.commit()
-        conn.close()
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_segment_content ON segment_keys_info(content_id)")
     
-    def derive_master_key(self, password, salt=None, use_argon2=True):
+    def derive_master_key(self, password, salt=None, use_argon2=True, kdf_params=None):
         """
         Derive a master key from user password using Argon2id or PBKDF2
         
@@ -73,57 +435,211 @@ class KeyManager:
             password (str): User-provided password
             salt (bytes, optional): Salt for key derivation. Generated if None.
             use_argon2 (bool): Whether to use Argon2id (if available) or PBKDF2
+            kdf_params (dict or str, optional): Cost parameters (or their JSON) to
+                derive with. When None, the calibrated profile for this host is
+                used, falling back to the built-in defaults.
             
         Returns:
             tuple: (master_key, salt, kdf_type, kdf_params, verification_hash)
         """
         if salt is None:
             salt = os.urandom(16)  # Generate 128-bit salt
+        
+        if isinstance(kdf_params, str):
+            kdf_params = json.loads(kdf_params)
             
         if use_argon2 and ARGON2_AVAILABLE:
-            # Use argon2.low_level API to provide a salt directly
-            from argon2.low_level import Type, hash_secret_raw
-            
-            master_key = hash_secret_raw(
-                secret=password.encode('utf-8'),
-                salt=salt,
-                time_cost=3,
-                memory_cost=65536,
-                parallelism=4,
-                hash_len=32,
-                type=Type.ID  # Argon2id
-            )
+            if kdf_params is None:
+                kdf_params = self.get_kdf_profile("argon2id")
+            params = dict(self.DEFAULT_ARGON2_PARAMS, **kdf_params)
+            
+            master_key = self._derive_argon2id(password, salt, params)
             
             kdf_type = "argon2id"
-            kdf_params = json.dumps({
-                "time_cost": 3,
-                "memory_cost": 65536,
-                "parallelism": 4,
-                "hash_len": 32
-            })
         else:
-            # Use PBKDF2 with high iteration count
-            kdf = PBKDF2HMAC(
-                algorithm=hashes.SHA256(),
-                length=32,             # 256-bit key
-                salt=salt,
-                iterations=600000,     # High iteration count for security
-            )
+            if kdf_params is None:
+                kdf_params = self.get_kdf_profile("pbkdf2")
+            params = dict(self.DEFAULT_PBKDF2_PARAMS, **kdf_params)
             
-            master_key = kdf.derive(password.encode('utf-8'))
+            master_key = self._derive_pbkdf2(password, salt, params)
             
             kdf_type = "pbkdf2"
-            kdf_params = json.dumps({
-                "algorithm": "sha256",
-                "iterations": 600000,
-                "length": 32
-            })
+        
+        kdf_params = json.dumps(params)
         
         # Generate a verification hash to check password correctness later
         # without storing the actual key
         verification_hash = self._create_verification_hash(master_key)
         
         return master_key, salt, kdf_type, kdf_params, verification_hash
+    
+    def _derive_argon2id(self, password, salt, params):
+        """Run Argon2id with explicit cost parameters"""
+        # Use argon2.low_level API to provide a salt directly
+        from argon2.low_level import Type, hash_secret_raw
+        
+        return hash_secret_raw(
+            secret=password.encode('utf-8'),
+            salt=salt,
+            time_cost=params["time_cost"],
+            memory_cost=params["memory_cost"],
+            parallelism=params["parallelism"],
+            hash_len=params["hash_len"],
+            type=Type.ID  # Argon2id
+        )
+    
+    def _derive_pbkdf2(self, password, salt, params):
+        """Run PBKDF2-HMAC with explicit cost parameters"""
+        if params["algorithm"] != "sha256":
+            raise ValueError(f"Unsupported PBKDF2 hash: {params['algorithm']}")
+        
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=params["length"],
+            salt=salt,
+            iterations=params["iterations"],
+        )
+        
+        return kdf.derive(password.encode('utf-8'))
+    
+    def get_kdf_profile(self, kdf_type):
+        """
+        Get the KDF cost parameters to use for new files on this host
+        
+        Args:
+            kdf_type (str): "argon2id" or "pbkdf2"
+            
+        Returns:
+            dict: Calibrated parameters if this host has been calibrated for
+                the KDF, otherwise the built-in defaults
+        """
+        profile = self.get_host_profile("kdf")
+        if profile and profile.get("kdf_type") == kdf_type:
+            return dict(profile["kdf_params"])
+        
+        if kdf_type == "argon2id":
+            return dict(self.DEFAULT_ARGON2_PARAMS)
+        return dict(self.DEFAULT_PBKDF2_PARAMS)
+    
+    def calibrate_kdf(self, target_ms=500, max_memory_cost=1048576, save=True):
+        """
+        Benchmark the KDF on this host and pick parameters for a target unlock time
+        
+        For Argon2id the memory cost is scaled first (down on small hosts, up on
+        large ones, within max_memory_cost), then the time cost is raised to fill
+        the remaining budget. Without Argon2id the PBKDF2 iteration count is
+        scaled instead. Old files are unaffected: they keep the parameters
+        stored alongside their salt.
+        
+        Args:
+            target_ms (float): Desired master-key derivation time in milliseconds
+            max_memory_cost (int): Upper bound on Argon2 memory cost in KiB
+            save (bool): Whether to store the result as this host's profile
+            
+        Returns:
+            dict: Profile with kdf_type, kdf_params, target_ms and measured_ms
+        """
+        password = "calibration"
+        salt = os.urandom(16)
+        target = target_ms / 1000.0
+        
+        def measure(derive, params):
+            start = time.perf_counter()
+            derive(password, salt, params)
+            return time.perf_counter() - start
+        
+        if ARGON2_AVAILABLE:
+            kdf_type = "argon2id"
+            params = dict(self.DEFAULT_ARGON2_PARAMS)
+            params["parallelism"] = max(1, min(params["parallelism"], os.cpu_count() or 1))
+            # Profiles never use fewer passes than the minimum, so size memory for that
+            params["time_cost"] = self.MIN_ARGON2_TIME_COST
+            elapsed = measure(self._derive_argon2id, params)
+            
+            # Shrink memory until the minimum passes fit the budget
+            while elapsed > target and params["memory_cost"] > self.MIN_ARGON2_MEMORY_COST:
+                params["memory_cost"] = max(self.MIN_ARGON2_MEMORY_COST, params["memory_cost"] // 2)
+                elapsed = measure(self._derive_argon2id, params)
+            
+            # Grow memory while the minimum passes stay within half the budget
+            while elapsed * 2 <= target and params["memory_cost"] * 2 <= max_memory_cost:
+                params["memory_cost"] *= 2
+                elapsed = measure(self._derive_argon2id, params)
+            
+            # Spend what is left of the budget on extra passes
+            pass_time = elapsed / self.MIN_ARGON2_TIME_COST
+            params["time_cost"] = max(self.MIN_ARGON2_TIME_COST, int(target / pass_time))
+            measured = measure(self._derive_argon2id, params)
+            
+            # Drop passes again if the estimate overshot
+            while measured > target and params["time_cost"] > self.MIN_ARGON2_TIME_COST:
+                params["time_cost"] = max(
+                    self.MIN_ARGON2_TIME_COST,
+                    min(params["time_cost"] - 1, int(params["time_cost"] * target / measured))
+                )
+                measured = measure(self._derive_argon2id, params)
+        else:
+            kdf_type = "pbkdf2"
+            params = dict(self.DEFAULT_PBKDF2_PARAMS)
+            params["iterations"] = 100000
+            elapsed = measure(self._derive_pbkdf2, params)
+            
+            params["iterations"] = max(
+                self.MIN_PBKDF2_ITERATIONS, int(params["iterations"] * target / elapsed)
+            )
+            measured = measure(self._derive_pbkdf2, params)
+        
+        profile = {
+            "kdf_type": kdf_type,
+            "kdf_params": params,
+            "target_ms": target_ms,
+            "measured_ms": round(measured * 1000, 1)
+        }
+        
+        if save:
+            self.store_host_profile("kdf", profile)
+        
+        return profile
+    
+    def store_host_profile(self, name, profile):
+        """
+        Store a named tuning profile for the current host
+        
+        Args:
+            name (str): Profile name (e.g. "kdf")
+            profile (dict): JSON-serializable profile data
+        """
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO host_profiles (host, name, profile, updated)
+                VALUES (?, ?, ?, ?)
+                """,
+                (socket.gethostname(), name, json.dumps(profile), datetime.now().isoformat())
+            )
+    
+    def get_host_profile(self, name):
+        """
+        Retrieve a named tuning profile for the current host
+        
+        Args:
+            name (str): Profile name (e.g. "kdf")
+            
+        Returns:
+            dict: Profile data or None if this host has no such profile
+        """
+        cursor = self.db.cursor()
+        
+        cursor.execute(
+            "SELECT profile FROM host_profiles WHERE host = ? AND name = ?",
+            (socket.gethostname(), name)
+        )
+        
+        row = cursor.fetchone()
+        
+        if row:
+            return json.loads(row[0])
+        return None
 
     def _create_verification_hash(self, key):
         """Create a hash to verify the key without storing it"""
@@ -148,19 +664,82 @@ class KeyManager:
         Returns:
             bytes: Unique key for this segment
         """
-        # Use HKDF to derive a segment-specific key
-        segment_info = f"{file_id}:{segment_id}".encode('utf-8')
+        return self.derive_segment_keys(master_key, [segment_id], file_id)[0]
+    
+    def derive_segment_keys(self, master_key, segment_ids, file_id):
+        """
+        Derive keys for many segments of a file at once
         
-        hkdf = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,    # 256-bit key
-            salt=None,    # HKDF doesn't require a salt but can use one
-            info=segment_info,
-        )
+        Equivalent to calling derive_segment_key for each segment, but the HKDF
+        extract step runs once for the whole batch and only the per-segment
+        expand step is repeated. Results are kept in a bounded cache keyed by
+        (file_id, segment_id), so re-deriving at decrypt time is a lookup.
+        
+        Args:
+            master_key (bytes): The master key from which to derive
+            segment_ids (list): Unique identifiers of the segments
+            file_id (str): Identifier for the parent file
+            
+        Returns:
+            list: Segment keys in the same order as segment_ids
+        """
+        fingerprint = self._master_key_fingerprint(master_key)
+        keys = [None] * len(segment_ids)
+        missing = []
+        
+        with self._segment_key_lock:
+            for position, segment_id in enumerate(segment_ids):
+                cached = self._segment_key_cache.get((file_id, segment_id))
+                # Only reuse keys derived from this same master key
+                if cached is not None and cached[0] == fingerprint:
+                    self._segment_key_cache.move_to_end((file_id, segment_id))
+                    keys[position] = cached[1]
+                else:
+                    missing.append(position)
+        
+        if not missing:
+            return keys
+        
+        # HKDF-Extract with no salt is HMAC keyed by a zero-filled block
+        prk = hmac.new(b"\x00" * 32, master_key, hashlib.sha256).digest()
+        
+        derived = []
+        for position in missing:
+            segment_id = segment_ids[position]
+            # Use HKDF to derive a segment-specific key
+            segment_info = f"{file_id}:{segment_id}".encode('utf-8')
+            hkdf_expand = HKDFExpand(
+                algorithm=hashes.SHA256(),
+                length=32,    # 256-bit key
+                info=segment_info,
+            )
+            keys[position] = hkdf_expand.derive(prk)
+            derived.append((segment_id, keys[position]))
+        
+        with self._segment_key_lock:
+            for segment_id, segment_key in derived:
+                self._segment_key_cache[(file_id, segment_id)] = (fingerprint, segment_key)
+                self._segment_key_cache.move_to_end((file_id, segment_id))
+            while len(self._segment_key_cache) > self.segment_key_cache_size:
+                self._segment_key_cache.popitem(last=False)
         
-        return hkdf.derive(master_key)
+        return keys
     
-    def store_master_key_info(self, file_id, salt, kdf_type, kdf_params, verification_hash):
+    def forget_segment_keys(self, file_id=None):
+        """Drop cached segment keys for a file, or for every file if None"""
+        with self._segment_key_lock:
+            if file_id is None:
+                self._segment_key_cache.clear()
+                return
+            for cache_key in [k for k in self._segment_key_cache if k[0] == file_id]:
+                del self._segment_key_cache[cache_key]
+    
+    def _master_key_fingerprint(self, master_key):
+        """Keyed fingerprint that ties cached segment keys to their master key"""
+        return hmac.new(self._fingerprint_secret, master_key, hashlib.sha256).digest()
+    
+    def store_master_key_info(self, file_id, salt, kdf_type, kdf_params, verification_hash,
+                              encrypted_key=None, encryption_info=None):
         """
         Store master key derivation info (not the key itself)
         
@@ -170,149 +749,456 @@ class KeyManager:
             kdf_type (str): Type of KDF used ("argon2id" or "pbkdf2")
             kdf_params (str): JSON string of KDF parameters
             verification_hash (bytes): Hash to verify the key
+            encrypted_key (bytes, optional): Master key wrapped under a vault key
+            encryption_info (str, optional): JSON describing how encrypted_key was wrapped
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            """
-            INSERT INTO master_keys (
-                file_id, salt, kdf_type, kdf_params, 
-                verification_hash, creation_date
-            ) VALUES (?, ?, ?, ?, ?, ?)
-            """, 
-            (
-                file_id, 
-                salt, 
-                kdf_type, 
-                kdf_params, 
-                verification_hash, 
-                datetime.now().isoformat()
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO master_keys (
+                    file_id, salt, kdf_type, kdf_params, 
+                    verification_hash, creation_date,
+                    encrypted_key, encryption_info
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, 
+                (
+                    file_id, 
+                    salt, 
+                    kdf_type, 
+                    kdf_params, 
+                    verification_hash, 
+                    datetime.now().isoformat(),
+                    encrypted_key,
+                    encryption_info
+                )
             )
-        )
-        
-        conn.commit()
-        conn.close()
     
-    def store_segment_key_info(self, segment_id, file_id, segment_index, 
-                              algorithm, nonce, tag=None):
+    def wrap_master_key(self, vault_key, vault_id, file_id, master_key):
         """
-        Store information about a segment encryption
+        Encrypt a per-file master key under a vault's key-encryption key
         
         Args:
-            segment_id (str): Unique identifier for the segment
-            file_id (str): Identifier for the parent file
-            segment_index (int): Index of this segment in the file
-            algorithm (str): Encryption algorithm used
-            nonce (bytes): Nonce or IV used for encryption
-            tag (bytes, optional): Authentication tag for AEAD ciphers
+            vault_key (bytes): Key-encryption key of the vault
+            vault_id (str): Name of the vault
+            file_id (str): File the master key belongs to (bound as associated data)
+            master_key (bytes): Random per-file master key
+            
+        Returns:
+            tuple: (encrypted_key, encryption_info) for the master_keys row
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        nonce = os.urandom(12)
+        encrypted_key = AESGCM(vault_key).encrypt(nonce, master_key, file_id.encode())
         
-        cursor.execute(
-            """
-            INSERT INTO segment_keys_info (
-                segment_id, file_id, segment_index, 
-                encryption_algorithm, nonce, tag
-            ) VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (segment_id, file_id, segment_index, algorithm, nonce, tag)
-        )
+        encryption_info = json.dumps({
+            "mode": "vault",
+            "vault_id": vault_id,
+            "algorithm": "AES-256-GCM",
+            "nonce": b64encode(nonce).decode('utf-8')
+        })
         
-        conn.commit()
-        conn.close()
+        return encrypted_key, encryption_info
     
-    def get_segment_key_info(self, segment_id):
+    def unwrap_master_key(self, vault_key, file_id, encrypted_key, encryption_info):
         """
-        Retrieve segment encryption information
+        Decrypt a per-file master key wrapped by wrap_master_key
         
         Args:
-            segment_id (str): Unique identifier for the segment
+            vault_key (bytes): Key-encryption key of the vault
+            file_id (str): File the master key belongs to
+            encrypted_key (bytes): Wrapped master key from master_keys
+            encryption_info (dict or str): Wrapping details from master_keys
             
         Returns:
-            dict: Segment encryption information or None if not found
+            bytes: The per-file master key
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT * FROM segment_keys_info WHERE segment_id = ?",
-            (segment_id,)
-        )
+        if isinstance(encryption_info, str):
+            encryption_info = json.loads(encryption_info)
         
-        row = cursor.fetchone()
-        conn.close()
+        nonce = b64decode(encryption_info["nonce"])
+        try:
+            return AESGCM(vault_key).decrypt(nonce, encrypted_key, file_id.encode())
+        except InvalidTag:
+            raise ValueError(f"Wrapped master key for file {file_id} failed authentication")
+    
+    def store_vault_info(self, vault_id, salt, kdf_type, kdf_params, verification_hash):
+        """
+        Store derivation info for a vault key-encryption key (not the key itself)
         
-        if row:
-            return dict(row)
-        return None
+        Args:
+            vault_id (str): Name of the vault
+            salt (bytes): Salt used for key derivation
+            kdf_type (str): Type of KDF used ("argon2id" or "pbkdf2")
+            kdf_params (str): JSON string of KDF parameters
+            verification_hash (bytes): Hash to verify the key
+        """
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO vaults (
+                    vault_id, salt, kdf_type, kdf_params,
+                    verification_hash, creation_date
+                ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (vault_id, salt, kdf_type, kdf_params, verification_hash, datetime.now().isoformat())
+            )
     
-    def get_master_key_info(self, file_id):
+    def get_vault_info(self, vault_id):
         """
-        Retrieve master key information
+        Retrieve vault key derivation information
         
         Args:
-            file_id (str): Unique identifier for the file
+            vault_id (str): Name of the vault
             
         Returns:
-            dict: Master key information or None if not found
+            dict: Vault information or None if not found
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
-        cursor = conn.cursor()
+        cursor = self.db.cursor()
         
         cursor.execute(
-            "SELECT * FROM master_keys WHERE file_id = ?",
-            (file_id,)
+            "SELECT * FROM vaults WHERE vault_id = ?",
+            (vault_id,)
         )
         
         row = cursor.fetchone()
-        conn.close()
         
         if row:
             return dict(row)
         return None
-
-
-class EncryptionEngine:
-    def __init__(self, key_manager, default_algorithm="AES-256-GCM"):
+    
+    def store_segment_key_info(self, segment_id, file_id, segment_index, 
+                              algorithm, nonce, tag=None, compression=None,
+                              content_id=None, wrapped_key=None, segment_hash=None):
         """
-        Initialize encryption engine
+        Store information about a segment encryption
         
         Args:
-            key_manager (KeyManager): KeyManager instance for key operations
-            default_algorithm (str): Default encryption algorithm to use
+            segment_id (str): Unique identifier for the segment
+            file_id (str): Identifier for the parent file
+            segment_index (int): Index of this segment in the file
+            algorithm (str): Encryption algorithm used
+            nonce (bytes): Nonce or IV used for encryption
+            tag (bytes, optional): Authentication tag for AEAD ciphers
+            compression (str, optional): Codec applied before encryption
+            content_id (str, optional): Dedup blob the segment refers to; its
+                reference count is incremented in the same transaction
+            wrapped_key (bytes, optional): The blob's data key wrapped under the segment key
+            segment_hash (str, optional): Keyed hash of the plaintext, used to
+                find unchanged segments when the file is updated
         """
-        self.key_manager = key_manager
-        self.default_algorithm = default_algorithm
-        self._validate_algorithm(default_algorithm)
+        self.store_segment_key_infos([
+            (segment_id, file_id, segment_index, algorithm, nonce, tag, compression,
+             content_id, wrapped_key, segment_hash)
+        ])
     
-    def _validate_algorithm(self, algorithm):
-        """Validate that the selected algorithm is supported"""
-        valid_algorithms = ["AES-256-GCM", "ChaCha20-Poly1305"]
-        if algorithm not in valid_algorithms:
-            raise ValueError(f"Algorithm must be one of: {valid_algorithms}")
+    def store_segment_key_infos(self, segment_rows):
+        """
+        Store information about many segment encryptions in one transaction
+        
+        When called inside an open ConnectionManager.transaction() block on the
+        same database, the rows join that transaction instead of committing.
+        
+        Args:
+            segment_rows (list): Tuples of (segment_id, file_id, segment_index,
+                algorithm, nonce, tag, compression, content_id, wrapped_key,
+                segment_hash), as taken by store_segment_key_info
+        """
+        with self.db.transaction() as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO segment_keys_info (
+                    segment_id, file_id, segment_index, 
+                    encryption_algorithm, nonce, tag, compression,
+                    content_id, wrapped_key, segment_hash
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                segment_rows
+            )
+            cursor.executemany(
+                "UPDATE dedup_blobs SET refcount = refcount + 1 WHERE content_id = ?",
+                [(row[7],) for row in segment_rows if row[7] is not None]
+            )
     
-    def encrypt_segment(self, segment_data, segment_key, algorithm=None):
+    def get_user_secret(self, name):
         """
-        Encrypt a segment with the provided key
+        Return a named random per-user secret, generating it on first use
         
         Args:
-            segment_data (bytes): Raw bytes of the segment to encrypt
-            segment_key (bytes): Key to use for encryption
-            algorithm (str, optional): Override default algorithm if specified
+            name (str): Name of the secret
             
         Returns:
-            dict: Containing encrypted data and metadata (nonce, tag, etc.)
+            bytes: 32-byte secret
         """
-        if algorithm is None:
-            algorithm = self.default_algorithm
-        else:
-            self._validate_algorithm(algorithm)
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                "INSERT OR IGNORE INTO user_secrets (name, secret, creation_date) VALUES (?, ?, ?)",
+                (name, os.urandom(32), datetime.now().isoformat())
+            )
+            cursor.execute("SELECT secret FROM user_secrets WHERE name = ?", (name,))
+            return cursor.fetchone()[0]
+    
+    def store_dedup_blob(self, content_id, algorithm, nonce, tag, ciphertext_size,
+                         plaintext_size, chunk_size=None, compression=None):
+        """
+        Store (or replace) the encryption info of a deduplicated segment blob
         
-        if algorithm == "AES-256-GCM":
+        Only a blob without references can be replaced (it keeps its reference
+        count). Referencing segments hold the blob's nonce and tag, so those
+        of a referenced blob never change.
+        
+        Args:
+            content_id (str): Keyed hash identifying the blob's plaintext
+            algorithm (str): Encryption algorithm used
+            nonce (bytes): Nonce, or chunk nonce prefix for streamed blobs
+            tag (bytes): Authentication tag (of the last chunk for streamed blobs)
+            ciphertext_size (int): Size of the ciphertext without tags
+            plaintext_size (int): Size of the segment before compression
+            chunk_size (int, optional): Set for blobs in the streaming chunked format
+            compression (str, optional): Codec applied before encryption
+        """
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO dedup_blobs (
+                    content_id, encryption_algorithm, nonce, tag, ciphertext_size,
+                    plaintext_size, chunk_size, compression, creation_date
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(content_id) DO UPDATE SET
+                    encryption_algorithm = excluded.encryption_algorithm,
+                    nonce = excluded.nonce,
+                    tag = excluded.tag,
+                    ciphertext_size = excluded.ciphertext_size,
+                    plaintext_size = excluded.plaintext_size,
+                    chunk_size = excluded.chunk_size,
+                    compression = excluded.compression
+                WHERE dedup_blobs.refcount = 0
+                """,
+                (content_id, algorithm, nonce, tag, ciphertext_size, plaintext_size,
+                 chunk_size, compression, datetime.now().isoformat())
+            )
+    
+    def get_dedup_blob(self, content_id):
+        """
+        Retrieve a deduplicated segment blob's encryption info and reference count
+        
+        Args:
+            content_id (str): Keyed hash identifying the blob's plaintext
+            
+        Returns:
+            dict: Blob information or None if not found
+        """
+        cursor = self.db.cursor()
+        cursor.execute("SELECT * FROM dedup_blobs WHERE content_id = ?", (content_id,))
+        row = cursor.fetchone()
+        
+        if row:
+            return dict(row)
+        return None
+    
+    def acquire_dedup_blob(self, content_id):
+        """
+        Take a reference to a deduplicated segment blob, if it is indexed
+        
+        Taking it before the referencing segment is registered keeps the blob
+        from being released by a delete in the meantime. The reference is
+        dropped with release_dedup_blobs once the segment row holds its own.
+        
+        Args:
+            content_id (str): Keyed hash identifying the blob's plaintext
+            
+        Returns:
+            dict: Blob information as from get_dedup_blob, or None if not indexed
+        """
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                "UPDATE dedup_blobs SET refcount = refcount + 1 WHERE content_id = ?", (content_id,)
+            )
+            if cursor.rowcount == 0:
+                return None
+            cursor.execute("SELECT * FROM dedup_blobs WHERE content_id = ?", (content_id,))
+            return dict(cursor.fetchone())
+    
+    def release_dedup_blobs(self, content_ids):
+        """
+        Drop one reference per entry in content_ids
+        
+        Blobs left without references are removed from the index. Joins an
+        open transaction on the same database, like store_segment_key_infos.
+        
+        Args:
+            content_ids (list): Content IDs of the segments being deleted; a blob
+                used by several of them appears several times
+            
+        Returns:
+            list: Content IDs whose last reference was dropped, so their data
+                can be deleted
+        """
+        with self.db.transaction() as cursor:
+            cursor.executemany(
+                "UPDATE dedup_blobs SET refcount = refcount - 1 WHERE content_id = ?",
+                [(content_id,) for content_id in content_ids]
+            )
+            
+            released = []
+            for content_id in set(content_ids):
+                cursor.execute(
+                    "SELECT refcount FROM dedup_blobs WHERE content_id = ?", (content_id,)
+                )
+                row = cursor.fetchone()
+                if row is not None and row[0] <= 0:
+                    released.append(content_id)
+            
+            cursor.executemany(
+                "DELETE FROM dedup_blobs WHERE content_id = ?",
+                [(content_id,) for content_id in released]
+            )
+            return released
+    
+    def get_segment_key_info(self, segment_id):
+        """
+        Retrieve segment encryption information
+        
+        Args:
+            segment_id (str): Unique identifier for the segment
+            
+        Returns:
+            dict: Segment encryption information or None if not found
+        """
+        cursor = self.db.cursor()
+        
+        cursor.execute(
+            "SELECT * FROM segment_keys_info WHERE segment_id = ?",
+            (segment_id,)
+        )
+        
+        row = cursor.fetchone()
+        
+        if row:
+            return dict(row)
+        return None
+    
+    def get_master_key_info(self, file_id):
+        """
+        Retrieve master key information
+        
+        Args:
+            file_id (str): Unique identifier for the file
+            
+        Returns:
+            dict: Master key information or None if not found
+        """
+        cursor = self.db.cursor()
+        
+        cursor.execute(
+            "SELECT * FROM master_keys WHERE file_id = ?",
+            (file_id,)
+        )
+        
+        row = cursor.fetchone()
+        
+        if row:
+            return dict(row)
+        return None
+
+
+class EncryptionEngine:
+    # Plaintext bytes per chunk in the streaming segment format
+    STREAM_CHUNK_SIZE = 1024 * 1024
+    
+    ALGORITHMS = ["AES-256-GCM", "ChaCha20-Poly1305"]
+    
+    def __init__(self, key_manager, default_algorithm="AES-256-GCM"):
+        """
+        Initialize encryption engine
+        
+        Args:
+            key_manager (KeyManager): KeyManager instance for key operations
+            default_algorithm (str): Default encryption algorithm to use, or
+                "auto" for the faster of the two on this host
+        """
+        self.key_manager = key_manager
+        if default_algorithm == "auto":
+            default_algorithm = self.select_algorithm()
+        self.default_algorithm = default_algorithm
+        self._validate_algorithm(default_algorithm)
+    
+    def _validate_algorithm(self, algorithm):
+        """Validate that the selected algorithm is supported"""
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Algorithm must be one of: {self.ALGORITHMS}")
+    
+    def benchmark_algorithms(self, sample_size=1024 * 1024, rounds=5):
+        """
+        Measure encryption throughput of each supported algorithm on this host
+        
+        Args:
+            sample_size (int): Bytes encrypted per round
+            rounds (int): Rounds per algorithm; the fastest round is kept
+            
+        Returns:
+            dict: Throughput in MB/s keyed by algorithm
+        """
+        key = os.urandom(32)
+        nonce = os.urandom(12)
+        sample = os.urandom(sample_size)
+        
+        throughput = {}
+        for algorithm in self.ALGORITHMS:
+            cipher = self._aead(algorithm, key)
+            best = float("inf")
+            for _ in range(rounds):
+                start = time.perf_counter()
+                cipher.encrypt(nonce, sample, None)
+                best = min(best, time.perf_counter() - start)
+            throughput[algorithm] = round(sample_size / max(best, 1e-9) / 1e6, 1)
+        
+        return throughput
+    
+    def select_algorithm(self, refresh=False):
+        """
+        Pick the faster AEAD for this host, benchmarking only once per host
+        
+        The choice is kept in the "aead" host profile. Segment metadata records
+        the algorithm actually used, so files stay readable on any host.
+        
+        Args:
+            refresh (bool): Benchmark again even if a profile is stored
+            
+        Returns:
+            str: The selected algorithm
+        """
+        if not refresh:
+            profile = self.key_manager.get_host_profile("aead")
+            if profile and profile.get("algorithm") in self.ALGORITHMS:
+                return profile["algorithm"]
+        
+        throughput = self.benchmark_algorithms()
+        algorithm = max(throughput, key=throughput.get)
+        
+        self.key_manager.store_host_profile("aead", {
+            "algorithm": algorithm,
+            "throughput_mb_s": throughput
+        })
+        
+        return algorithm
+    
+    def encrypt_segment(self, segment_data, segment_key, algorithm=None):
+        """
+        Encrypt a segment with the provided key
+        
+        Args:
+            segment_data (bytes): Raw bytes of the segment to encrypt
+            segment_key (bytes): Key to use for encryption
+            algorithm (str, optional): Override default algorithm if specified
+            
+        Returns:
+            dict: Containing encrypted data and metadata (nonce, tag, etc.)
+        """
+        if algorithm is None:
+            algorithm = self.default_algorithm
+        else:
+            self._validate_algorithm(algorithm)
+        
+        if algorithm == "AES-256-GCM":
             # Use AES-256-GCM (requires 256-bit key)
             aesgcm = AESGCM(segment_key)
             nonce = os.urandom(12)  # 96-bit nonce (recommended for GCM)
@@ -347,6 +1233,220 @@ class EncryptionEngine:
                 "ciphertext": actual_ciphertext
             }
     
+    def _aead(self, algorithm, segment_key):
+        """Return the AEAD cipher object for a validated algorithm"""
+        if algorithm == "AES-256-GCM":
+            return AESGCM(segment_key)
+        return ChaCha20Poly1305(segment_key)
+    
+    def seal_segment(self, segment_data, segment_key, algorithm=None, out=None, nonce=None):
+        """
+        Encrypt a segment into a single ciphertext||tag buffer
+        
+        Unlike encrypt_segment, the tag is left adjacent to the ciphertext, so
+        the result can be written to disk as-is without slicing copies.
+        
+        Args:
+            segment_data (bytes-like): Raw segment data (bytes, bytearray or memoryview)
+            segment_key (bytes): Key to use for encryption
+            algorithm (str, optional): Override default algorithm if specified
+            out (bytearray, optional): Preallocated buffer of at least
+                len(segment_data) + TAG_SIZE bytes to encrypt into
+            nonce (bytes, optional): Nonce of an earlier encryption of the same
+                data under the same key, to recreate that ciphertext exactly.
+                Never pass it for different data.
+            
+        Returns:
+            dict: algorithm, nonce, tag and "sealed" (ciphertext followed by tag)
+        """
+        if algorithm is None:
+            algorithm = self.default_algorithm
+        else:
+            self._validate_algorithm(algorithm)
+        
+        cipher = self._aead(algorithm, segment_key)
+        if nonce is None:
+            nonce = os.urandom(12)
+        sealed_size = len(segment_data) + TAG_SIZE
+        
+        if AEAD_INTO_AVAILABLE:
+            if out is None:
+                out = bytearray(sealed_size)
+            sealed = memoryview(out)[:sealed_size] if len(out) != sealed_size else out
+            cipher.encrypt_into(nonce, segment_data, None, sealed)
+        else:
+            sealed = cipher.encrypt(nonce, segment_data, None)
+        
+        return {
+            "algorithm": algorithm,
+            "nonce": nonce,
+            "tag": bytes(sealed[-TAG_SIZE:]),
+            "sealed": sealed
+        }
+    
+    def open_segment(self, sealed, nonce, algorithm, segment_key, out=None):
+        """
+        Decrypt a ciphertext||tag buffer produced by seal_segment
+        
+        Args:
+            sealed (bytes-like): Ciphertext followed by the authentication tag
+            nonce (bytes): Nonce used in encryption
+            algorithm (str): Encryption algorithm used
+            segment_key (bytes): Key to use for decryption
+            out (bytearray, optional): Preallocated buffer of at least
+                len(sealed) - TAG_SIZE bytes to decrypt into
+            
+        Returns:
+            bytes-like: Decrypted segment data
+        """
+        self._validate_algorithm(algorithm)
+        
+        cipher = self._aead(algorithm, segment_key)
+        plaintext_size = len(sealed) - TAG_SIZE
+        
+        if AEAD_INTO_AVAILABLE:
+            if out is None:
+                out = bytearray(plaintext_size)
+            plaintext = memoryview(out)[:plaintext_size] if len(out) != plaintext_size else out
+            cipher.decrypt_into(nonce, sealed, None, plaintext)
+            return plaintext
+        
+        return cipher.decrypt(nonce, sealed, None)
+    
+    def _stream_nonce(self, nonce_prefix, counter, last):
+        """Build a STREAM chunk nonce: 7-byte prefix || 32-bit counter || last-chunk flag"""
+        return nonce_prefix + counter.to_bytes(4, "big") + (b"\x01" if last else b"\x00")
+    
+    def encrypt_stream(self, reader, writer, segment_key, algorithm=None, chunk_size=None,
+                       nonce_prefix=None):
+        """
+        Encrypt a segment as a sequence of fixed-size AEAD chunks
+        
+        Each chunk is written as ciphertext||tag under its own nonce, derived
+        from a random prefix, the chunk counter and a flag set only on the
+        final chunk, so reordered, dropped or truncated chunks fail to
+        authenticate. Memory use is a few chunk buffers whatever the segment size.
+        
+        Args:
+            reader (file): Binary file object to read plaintext from
+            writer (file): Binary file object to write the encrypted chunks to
+            segment_key (bytes): Key to use for encryption
+            algorithm (str, optional): Override default algorithm if specified
+            chunk_size (int, optional): Plaintext bytes per chunk
+            nonce_prefix (bytes, optional): Prefix of an earlier encryption of
+                the same data under the same key, as for seal_segment's nonce
+            
+        Returns:
+            dict: algorithm, nonce (the prefix), tag (of the final chunk),
+                chunk_size, chunk_count and plaintext_size
+        """
+        if algorithm is None:
+            algorithm = self.default_algorithm
+        else:
+            self._validate_algorithm(algorithm)
+        if chunk_size is None:
+            chunk_size = self.STREAM_CHUNK_SIZE
+        
+        cipher = self._aead(algorithm, segment_key)
+        if nonce_prefix is None:
+            nonce_prefix = os.urandom(7)
+        
+        # Read one chunk ahead so the final chunk can be flagged
+        current = bytearray(chunk_size)
+        ahead = bytearray(chunk_size)
+        sealed = bytearray(chunk_size + TAG_SIZE)
+        
+        count = _read_full(reader, current)
+        counter = 0
+        plaintext_size = 0
+        
+        while True:
+            next_count = _read_full(reader, ahead) if count == chunk_size else 0
+            last = next_count == 0
+            if counter >= 2 ** 32:
+                raise ValueError("Segment has too many chunks for the streaming format")
+            
+            nonce = self._stream_nonce(nonce_prefix, counter, last)
+            chunk = memoryview(current)[:count]
+            if AEAD_INTO_AVAILABLE:
+                out = memoryview(sealed)[:count + TAG_SIZE]
+                cipher.encrypt_into(nonce, chunk, None, out)
+            else:
+                out = cipher.encrypt(nonce, chunk, None)
+            writer.write(out)
+            
+            counter += 1
+            plaintext_size += count
+            if last:
+                tag = bytes(out[-TAG_SIZE:])
+                break
+            current, ahead = ahead, current
+            count = next_count
+        
+        return {
+            "algorithm": algorithm,
+            "nonce": nonce_prefix,
+            "tag": tag,
+            "chunk_size": chunk_size,
+            "chunk_count": counter,
+            "plaintext_size": plaintext_size
+        }
+    
+    def decrypt_stream(self, reader, writer, nonce_prefix, algorithm, segment_key, chunk_size):
+        """
+        Decrypt a segment written by encrypt_stream
+        
+        Plaintext is written chunk by chunk as each one authenticates. Callers
+        must discard the output if an exception is raised part way through.
+        
+        Args:
+            reader (file): Binary file object positioned at the first chunk
+            writer (file): Binary file object to write plaintext to
+            nonce_prefix (bytes): Nonce prefix from the segment metadata
+            algorithm (str): Encryption algorithm used
+            segment_key (bytes): Key to use for decryption
+            chunk_size (int): Plaintext bytes per chunk
+            
+        Returns:
+            int: Number of plaintext bytes written
+        """
+        self._validate_algorithm(algorithm)
+        
+        cipher = self._aead(algorithm, segment_key)
+        stored_chunk_size = chunk_size + TAG_SIZE
+        
+        current = bytearray(stored_chunk_size)
+        ahead = bytearray(stored_chunk_size)
+        plaintext = bytearray(chunk_size)
+        
+        count = _read_full(reader, current)
+        counter = 0
+        plaintext_size = 0
+        
+        while True:
+            next_count = _read_full(reader, ahead) if count == stored_chunk_size else 0
+            last = next_count == 0
+            if count < TAG_SIZE:
+                raise ValueError("Encrypted stream is truncated")
+            
+            nonce = self._stream_nonce(nonce_prefix, counter, last)
+            chunk = memoryview(current)[:count]
+            if AEAD_INTO_AVAILABLE:
+                out = memoryview(plaintext)[:count - TAG_SIZE]
+                cipher.decrypt_into(nonce, chunk, None, out)
+            else:
+                out = cipher.decrypt(nonce, chunk, None)
+            writer.write(out)
+            
+            counter += 1
+            plaintext_size += len(out)
+            if last:
+                break
+            current, ahead = ahead, current
+            count = next_count
+        
+        return plaintext_size
+    
     def decrypt_segment(self, ciphertext, nonce, tag, algorithm, segment_key):
         """
         Decrypt a segment using the provided key and metadata
@@ -359,27 +1459,428 @@ class EncryptionEngine:
             segment_key (bytes): Key to use for decryption
             
         Returns:
-            bytes: Decrypted segment data
+            bytes: Decrypted segment data
+        """
+        self._validate_algorithm(algorithm)
+        
+        # Reconstruct the full ciphertext with tag for the cryptography library
+        full_ciphertext = ciphertext + tag
+        
+        if algorithm == "AES-256-GCM":
+            aesgcm = AESGCM(segment_key)
+            return aesgcm.decrypt(nonce, full_ciphertext, None)
+            
+        elif algorithm == "ChaCha20-Poly1305":
+            chacha = ChaCha20Poly1305(segment_key)
+            return chacha.decrypt(nonce, full_ciphertext, None)
+
+
+class SegmentCompressor:
+    """Optional compression of segment plaintext before it is encrypted"""
+    
+    # Bytes compressed from each of a few spots to judge compressibility
+    SAMPLE_SIZE = 4096
+    SAMPLE_COUNT = 3
+    
+    # Samples must shrink below this fraction for compression to be used
+    MAX_SAMPLE_RATIO = 0.9
+    
+    def available_codecs(self):
+        """Codecs usable on this install"""
+        codecs = ["zlib", "lzma"]
+        if ZSTD_AVAILABLE:
+            codecs.append("zstd")
+        return codecs
+    
+    def _validate_codec(self, codec):
+        """Validate that the selected codec is available"""
+        if codec not in self.available_codecs():
+            raise ValueError(f"Compression must be one of: {self.available_codecs()}")
+    
+    def is_compressible(self, data):
+        """
+        Judge from a few small samples whether compressing data is worthwhile
+        
+        Already-compressed media and archives barely shrink, so this avoids
+        spending a full compression pass on them.
+        
+        Args:
+            data (bytes-like): Segment plaintext
+            
+        Returns:
+            bool: True if the samples compress well
+        """
+        view = memoryview(data)
+        if len(view) <= self.SAMPLE_SIZE * self.SAMPLE_COUNT:
+            sample = bytes(view)
+        else:
+            step = (len(view) - self.SAMPLE_SIZE) // (self.SAMPLE_COUNT - 1)
+            sample = b"".join(
+                view[i * step:i * step + self.SAMPLE_SIZE] for i in range(self.SAMPLE_COUNT)
+            )
+        return self._sample_compresses(sample)
+    
+    def is_stream_compressible(self, reader):
+        """
+        Like is_compressible, for a seekable file object (position is restored)
+        
+        Args:
+            reader (file): Binary file object positioned at the segment start
+            
+        Returns:
+            bool: True if the samples compress well; False if reader can't seek
+        """
+        if not reader.seekable():
+            return False
+        
+        start = reader.tell()
+        size = reader.seek(0, os.SEEK_END) - start
+        step = max(0, size - self.SAMPLE_SIZE) // max(1, self.SAMPLE_COUNT - 1)
+        
+        samples = []
+        for i in range(self.SAMPLE_COUNT):
+            reader.seek(start + i * step)
+            samples.append(reader.read(self.SAMPLE_SIZE))
+        reader.seek(start)
+        
+        return self._sample_compresses(b"".join(samples))
+    
+    def _sample_compresses(self, sample):
+        """Cheap zlib level-1 ratio check on a sample"""
+        if not sample:
+            return False
+        return len(zlib.compress(sample, 1)) < len(sample) * self.MAX_SAMPLE_RATIO
+    
+    def compress(self, data, codec):
+        """Compress a whole segment"""
+        self._validate_codec(codec)
+        if codec == "zlib":
+            return zlib.compress(data, 6)
+        if codec == "lzma":
+            return lzma.compress(data)
+        return zstandard.ZstdCompressor().compress(data)
+    
+    def decompress(self, data, codec):
+        """Decompress a whole segment"""
+        self._validate_codec(codec)
+        if codec == "zlib":
+            return zlib.decompress(data)
+        if codec == "lzma":
+            return lzma.decompress(data)
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    
+    def compressing_reader(self, reader, codec):
+        """Wrap a binary reader so it yields the compressed stream"""
+        self._validate_codec(codec)
+        if codec == "zlib":
+            compressor = zlib.compressobj(6)
+        elif codec == "lzma":
+            compressor = lzma.LZMACompressor()
+        else:
+            compressor = zstandard.ZstdCompressor().compressobj()
+        return _CompressingReader(reader, compressor)
+    
+    def decompressing_writer(self, writer, codec):
+        """Wrap a binary writer so data written to it is decompressed first"""
+        self._validate_codec(codec)
+        if codec == "zlib":
+            decompressor = zlib.decompressobj()
+        elif codec == "lzma":
+            decompressor = lzma.LZMADecompressor()
+        else:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        return _DecompressingWriter(writer, decompressor)
+
+
+class _CompressingReader:
+    """Binary reader producing the compressed form of another reader"""
+    
+    def __init__(self, reader, compressor, block_size=1024 * 1024):
+        self.reader = reader
+        self.compressor = compressor
+        self.block_size = block_size
+        self.bytes_in = 0
+        self._pending = b""
+        self._offset = 0
+        self._eof = False
+    
+    def readinto(self, buffer):
+        # Refill from the source until there is compressed output to hand out
+        while self._offset >= len(self._pending):
+            if self._eof:
+                return 0
+            block = self.reader.read(self.block_size)
+            if block:
+                self.bytes_in += len(block)
+                self._pending = self.compressor.compress(block)
+            else:
+                self._pending = self.compressor.flush()
+                self._eof = True
+            self._offset = 0
+        
+        count = min(len(buffer), len(self._pending) - self._offset)
+        memoryview(buffer)[:count] = self._pending[self._offset:self._offset + count]
+        self._offset += count
+        return count
+
+
+class _HashingReader:
+    """Binary reader that feeds everything read from another reader to a hash"""
+    
+    def __init__(self, reader, digest):
+        self.reader = reader
+        self.digest = digest
+    
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        self.digest.update(data)
+        return data
+    
+    def readinto(self, buffer):
+        count = self.reader.readinto(buffer)
+        if count:
+            self.digest.update(memoryview(buffer)[:count])
+        return count
+
+
+class _DecompressingWriter:
+    """Binary writer that decompresses data before passing it on"""
+    
+    def __init__(self, writer, decompressor):
+        self.writer = writer
+        self.decompressor = decompressor
+        self.bytes_out = 0
+    
+    def write(self, data):
+        output = self.decompressor.decompress(bytes(data))
+        if output:
+            self.writer.write(output)
+            self.bytes_out += len(output)
+        return len(data)
+    
+    def finish(self):
+        """Write out anything the decompressor still holds"""
+        if hasattr(self.decompressor, "flush"):
+            output = self.decompressor.flush()
+            if output:
+                self.writer.write(output)
+                self.bytes_out += len(output)
+        return self.bytes_out
+
+
+class JSONMetadataCodec:
+    """Metadata as JSON text with base64 binary fields (the .meta file format)"""
+    
+    name = "json"
+    BINARY_FIELDS = ("nonce", "tag", "wrapped_key")
+    
+    def encode(self, metadata):
+        """Encode metadata from generate_segment_metadata"""
+        return json.dumps(metadata)
+    
+    def decode(self, data):
+        """Decode to a dict with the binary fields as bytes"""
+        metadata = json.loads(data)
+        for field in self.BINARY_FIELDS:
+            if field in metadata:
+                metadata[field] = b64decode(metadata[field])
+        return metadata
+    
+    def read_identity(self, data):
+        """(file_id, segment_index) of encoded metadata"""
+        metadata = json.loads(data)
+        return metadata.get("file_id"), metadata.get("segment_index")
+
+
+class BinaryMetadataCodec:
+    """
+    Metadata packed into one fixed-size struct
+    
+    The record starts with the magic, version, flags, file_id and segment
+    index, so a segment's owner can be read from the first IDENTITY.size
+    bytes without decoding the rest. Only UUID file_ids (as created by
+    setup_encryption) can be encoded.
+    """
+    
+    name = "binary"
+    MAGIC = b"BSEG"
+    VERSION = 1
+    
+    # magic, version, flags, file_id, segment_index, algorithm, compression,
+    # nonce length, nonce, tag, chunk_size, ciphertext_size, plaintext_size,
+    # body length, encryption time (ISO 8601), content_id, wrapped_key, segment_hash
+    RECORD = struct.Struct("<4sHH16sIBBB12s16sIQQQ26s32s60s32s19x")
+    IDENTITY = struct.Struct("<4sHH16sI")
+    
+    FLAG_SEALED = 0x01
+    FLAG_CHUNKED = 0x02
+    FLAG_PLAINTEXT_SIZE = 0x04
+    FLAG_DEDUP = 0x08
+    FLAG_SEGMENT_HASH = 0x10
+    
+    ALGORITHM_IDS = {"AES-256-GCM": 1, "ChaCha20-Poly1305": 2}
+    COMPRESSION_IDS = {"zlib": 1, "lzma": 2, "zstd": 3}
+    ALGORITHMS = {v: k for k, v in ALGORITHM_IDS.items()}
+    COMPRESSIONS = {v: k for k, v in COMPRESSION_IDS.items()}
+    
+    def is_binary(self, data):
+        """Whether data starts with a binary metadata record"""
+        return data[:4] == self.MAGIC
+    
+    def _pack_file_id(self, file_id):
+        # Equivalent to uuid.UUID(file_id).bytes for canonical UUID strings, but cheaper
+        packed = bytes.fromhex(file_id.replace("-", ""))
+        if len(packed) != 16:
+            raise ValueError(f"file_id is not a UUID: {file_id}")
+        return packed
+    
+    def _unpack_file_id(self, packed):
+        h = packed.hex()
+        return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+    
+    def pack(self, metadata, body_length=0):
+        """
+        Pack metadata from generate_segment_metadata
+        
+        Args:
+            metadata (dict): Segment metadata (binary fields base64 encoded)
+            body_length (int): Length of the data stored after the record, for
+                segment containers
+            
+        Returns:
+            bytes: RECORD.size bytes
+        """
+        flags = 0
+        if metadata.get("sealed"):
+            flags |= self.FLAG_SEALED
+        if "chunk_size" in metadata:
+            flags |= self.FLAG_CHUNKED
+        if "plaintext_size" in metadata:
+            flags |= self.FLAG_PLAINTEXT_SIZE
+        if "content_id" in metadata:
+            flags |= self.FLAG_DEDUP
+        if "segment_hash" in metadata:
+            flags |= self.FLAG_SEGMENT_HASH
+        
+        nonce = binascii.a2b_base64(metadata["nonce"])
+        compression = metadata.get("compression")
+        
+        return self.RECORD.pack(
+            self.MAGIC, self.VERSION, flags,
+            self._pack_file_id(metadata["file_id"]),
+            metadata["segment_index"],
+            self.ALGORITHM_IDS[metadata["algorithm"]],
+            self.COMPRESSION_IDS[compression] if compression else 0,
+            len(nonce), nonce,
+            binascii.a2b_base64(metadata["tag"]),
+            metadata.get("chunk_size", 0),
+            metadata["ciphertext_size"],
+            metadata.get("plaintext_size", 0),
+            body_length,
+            metadata["encryption_time"].encode("ascii"),
+            bytes.fromhex(metadata["content_id"]) if "content_id" in metadata else b"",
+            binascii.a2b_base64(metadata["wrapped_key"]) if "content_id" in metadata else b"",
+            bytes.fromhex(metadata["segment_hash"]) if "segment_hash" in metadata else b""
+        )
+    
+    def unpack(self, data):
+        """
+        Unpack a record
+        
+        Args:
+            data (bytes-like): At least RECORD.size bytes starting with a record
+            
+        Returns:
+            tuple: (metadata, body_length), with metadata shaped like the
+                result of MetadataHandler.deserialize_metadata
         """
-        self._validate_algorithm(algorithm)
+        if len(data) < self.RECORD.size or data[:4] != self.MAGIC:
+            raise ValueError("Not binary segment metadata")
         
-        # Reconstruct the full ciphertext with tag for the cryptography library
-        full_ciphertext = ciphertext + tag
+        (_, version, flags, file_id, segment_index, algorithm_id, compression_id,
+         nonce_length, nonce, tag, chunk_size, ciphertext_size, plaintext_size,
+         body_length, encryption_time, content_id, wrapped_key,
+         segment_hash) = self.RECORD.unpack_from(data)
         
-        if algorithm == "AES-256-GCM":
-            aesgcm = AESGCM(segment_key)
-            return aesgcm.decrypt(nonce, full_ciphertext, None)
-            
-        elif algorithm == "ChaCha20-Poly1305":
-            chacha = ChaCha20Poly1305(segment_key)
-            return chacha.decrypt(nonce, full_ciphertext, None)
+        if version != self.VERSION:
+            raise ValueError(f"Unsupported segment metadata version: {version}")
+        if algorithm_id not in self.ALGORITHMS or \
+           (compression_id and compression_id not in self.COMPRESSIONS):
+            raise ValueError("Segment metadata is corrupt")
+        
+        file_id = self._unpack_file_id(file_id)
+        metadata = {
+            "segment_id": f"{file_id}_{segment_index}",
+            "file_id": file_id,
+            "segment_index": segment_index,
+            "algorithm": self.ALGORITHMS[algorithm_id],
+            "nonce": nonce[:nonce_length],
+            "tag": tag,
+            "ciphertext_size": ciphertext_size,
+            "encryption_time": encryption_time.rstrip(b"\0").decode("ascii")
+        }
+        
+        if flags & self.FLAG_SEALED:
+            metadata["sealed"] = True
+        if flags & self.FLAG_CHUNKED:
+            metadata["chunk_size"] = chunk_size
+        if flags & self.FLAG_PLAINTEXT_SIZE:
+            metadata["plaintext_size"] = plaintext_size
+        if compression_id:
+            metadata["compression"] = self.COMPRESSIONS[compression_id]
+        if flags & self.FLAG_DEDUP:
+            metadata["content_id"] = content_id.hex()
+            metadata["wrapped_key"] = wrapped_key
+        if flags & self.FLAG_SEGMENT_HASH:
+            metadata["segment_hash"] = segment_hash.hex()
+        
+        return metadata, body_length
+    
+    def encode(self, metadata):
+        """Encode metadata from generate_segment_metadata"""
+        return self.pack(metadata)
+    
+    def decode(self, data):
+        """Decode to a dict with the binary fields as bytes"""
+        return self.unpack(data)[0]
+    
+    def read_identity(self, data):
+        """(file_id, segment_index) from the start of a record, without decoding the rest"""
+        if len(data) < self.IDENTITY.size or data[:4] != self.MAGIC:
+            raise ValueError("Not binary segment metadata")
+        _, version, _, file_id, segment_index = self.IDENTITY.unpack_from(data)
+        if version != self.VERSION:
+            raise ValueError(f"Unsupported segment metadata version: {version}")
+        return self._unpack_file_id(file_id), segment_index
 
 
 class MetadataHandler:
     """Handles creation and parsing of segment metadata"""
     
+    CODECS = {"json": JSONMetadataCodec, "binary": BinaryMetadataCodec}
+    
+    def __init__(self, codec="json"):
+        """
+        Args:
+            codec (str): Codec serialize_metadata writes, "json" or "binary".
+                deserialize_metadata reads either.
+        """
+        if codec not in self.CODECS:
+            raise ValueError(f"Codec must be one of: {list(self.CODECS)}")
+        self.codec = self.CODECS[codec]()
+        self._json = JSONMetadataCodec()
+        self._binary = BinaryMetadataCodec()
+    
+    def _codec_for(self, serialized_metadata):
+        """Codec that wrote serialized_metadata (JSON text never starts with the binary magic)"""
+        if serialized_metadata[:4] == BinaryMetadataCodec.MAGIC:
+            return self._binary
+        return self._json
+    
     def generate_segment_metadata(self, segment_id, file_id, segment_index, 
-                                 algorithm, nonce, tag, ciphertext_size):
+                                 algorithm, nonce, tag, ciphertext_size, sealed=False,
+                                 chunk_size=None, plaintext_size=None, compression=None,
+                                 content_id=None, wrapped_key=None, segment_hash=None):
         """
         Generate metadata for an encrypted segment
         
@@ -391,6 +1892,17 @@ class MetadataHandler:
             nonce (bytes): Nonce or IV used in encryption
             tag (bytes): Authentication tag (for AEAD ciphers)
             ciphertext_size (int): Size of the ciphertext in bytes
+            sealed (bool): Whether the stored segment is ciphertext||tag. Metadata
+                without the flag describes a segment stored without its tag.
+            chunk_size (int, optional): Set for segments in the streaming chunked
+                format; nonce is then the chunk nonce prefix
+            plaintext_size (int, optional): Size of the decrypted segment, used to
+                place it in the restored file before decrypting
+            compression (str, optional): Codec applied to the segment before encryption
+            content_id (str, optional): Dedup blob holding the segment's data
+            wrapped_key (bytes, optional): The blob's data key wrapped under the
+                segment key
+            segment_hash (str, optional): Keyed hash of the segment plaintext
             
         Returns:
             dict: Metadata for the segment
@@ -407,40 +1919,132 @@ class MetadataHandler:
             "encryption_time": datetime.now().isoformat()
         }
         
+        if sealed:
+            metadata["sealed"] = True
+        if chunk_size is not None:
+            metadata["chunk_size"] = chunk_size
+        if plaintext_size is not None:
+            metadata["plaintext_size"] = plaintext_size
+        if compression is not None:
+            metadata["compression"] = compression
+        if content_id is not None:
+            metadata["content_id"] = content_id
+            metadata["wrapped_key"] = b64encode(wrapped_key).decode('utf-8')
+        if segment_hash is not None:
+            metadata["segment_hash"] = segment_hash
+        
         return metadata
     
     def serialize_metadata(self, metadata):
-        """Convert metadata to JSON format for storage/transmission"""
-        return json.dumps(metadata)
+        """Encode metadata with the handler's codec for storage/transmission"""
+        return self.codec.encode(metadata)
     
     def deserialize_metadata(self, serialized_metadata):
-        """Parse serialized metadata back into a dictionary"""
-        metadata = json.loads(serialized_metadata)
+        """Parse serialized metadata (from either codec) back into a dictionary"""
+        return self._codec_for(serialized_metadata).decode(serialized_metadata)
+    
+    def read_identity(self, serialized_metadata):
+        """
+        Read only which segment serialized metadata belongs to
+        
+        Returns:
+            tuple: (file_id, segment_index)
+        """
+        return self._codec_for(serialized_metadata).read_identity(serialized_metadata)
+
+
+class SegmentContainer:
+    """
+    Single-file segment format: a binary metadata record, then the ciphertext
+    
+    The header is a BinaryMetadataCodec record, so a segment is one file (and
+    one upload) and its metadata is read without JSON parsing. Deduplicated
+    segments have an empty body; their data is the shared blob named by
+    content_id.
+    """
+    
+    MAGIC = BinaryMetadataCodec.MAGIC
+    HEADER_SIZE = BinaryMetadataCodec.RECORD.size
+    
+    def __init__(self):
+        self.codec = BinaryMetadataCodec()
+    
+    def is_container(self, prefix):
+        """Whether data starting with prefix is a segment container"""
+        return self.codec.is_binary(prefix)
+    
+    def pack_header(self, metadata, body_length):
+        """
+        Build the header for a segment
+        
+        Args:
+            metadata (dict): Metadata as from generate_segment_metadata
+            body_length (int): Bytes of ciphertext that follow the header
+            
+        Returns:
+            bytes: HEADER_SIZE bytes
+        """
+        return self.codec.pack(metadata, body_length)
+    
+    def unpack_header(self, header):
+        """
+        Parse a segment header
         
-        # Convert base64 strings back to bytes for cryptographic operations
-        if "nonce" in metadata:
-            metadata["nonce"] = b64decode(metadata["nonce"])
-        if "tag" in metadata:
-            metadata["tag"] = b64decode(metadata["tag"])
+        Args:
+            header (bytes-like): At least the first HEADER_SIZE bytes of a container
             
-        return metadata
+        Returns:
+            tuple: (metadata, body_length), with metadata shaped like the result
+                of deserialize_metadata
+        """
+        return self.codec.unpack(header)
+    
+    def read_header(self, reader):
+        """Read and parse the header, leaving reader at the start of the body"""
+        return self.unpack_header(reader.read(self.HEADER_SIZE))
+    
+    def read_identity(self, reader):
+        """Read just (file_id, segment_index) from the start of a container"""
+        return self.codec.read_identity(reader.read(self.codec.IDENTITY.size))
 
 
 class SegmentEncryptor:
     """Main class coordinating the encryption process"""
     
-    def __init__(self, db_path, default_algorithm="AES-256-GCM"):
-        """Initialize with database path and default algorithm"""
+    def __init__(self, db_path, default_algorithm="AES-256-GCM", 
+                 key_cache_ttl=300, key_cache_size=32, metadata_codec="json"):
+        """Initialize with database path, default algorithm, master-key cache limits and metadata codec"""
         self.key_manager = KeyManager(db_path)
         self.encryption_engine = EncryptionEngine(self.key_manager, default_algorithm)
-        self.metadata_handler = MetadataHandler()
+        self.metadata_handler = MetadataHandler(metadata_codec)
+        self.container = SegmentContainer()
+        self.compressor = SegmentCompressor()
+        # Segment keys derived from a master key go when the master key does
+        self.key_cache = MasterKeyCache(
+            key_cache_ttl, key_cache_size, on_evict=self.key_manager.forget_segment_keys
+        )
+        self.vault_cache = MasterKeyCache(key_cache_ttl, key_cache_size)
+        self._vault_lock = threading.Lock()
+        self._kdf_executor = None
+        self._kdf_executor_lock = threading.Lock()
+        self._dedup_secret = None
+    
+    def _get_kdf_executor(self):
+        """Lazily create the worker pool used for background key derivation"""
+        with self._kdf_executor_lock:
+            if self._kdf_executor is None:
+                self._kdf_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="kdf")
+            return self._kdf_executor
     
-    def setup_encryption(self, password):
+    def setup_encryption(self, password, vault_id=None):
         """
         Initialize encryption for a new file with password
         
         Args:
             password (str): User-provided password
+            vault_id (str, optional): Keyring to use. When set, a random master
+                key is wrapped under the vault key instead of being derived
+                from the password, so the KDF runs once per session.
             
         Returns:
             str: file_id for the encryption session
@@ -448,6 +2052,25 @@ class SegmentEncryptor:
         # Generate a unique file ID
         file_id = str(uuid.uuid4())
         
+        if vault_id is not None:
+            vault_key = self.unlock_vault(password, vault_id)
+            vault_info = self.key_manager.get_vault_info(vault_id)
+            
+            master_key = os.urandom(32)
+            encrypted_key, encryption_info = self.key_manager.wrap_master_key(
+                vault_key, vault_id, file_id, master_key
+            )
+            
+            # The KDF columns describe the vault key the master key is wrapped under
+            self.key_manager.store_master_key_info(
+                file_id, vault_info["salt"], vault_info["kdf_type"], vault_info["kdf_params"],
+                self.key_manager._create_verification_hash(master_key),
+                encrypted_key=encrypted_key, encryption_info=encryption_info
+            )
+            
+            self.key_cache.put(file_id, password, master_key)
+            return file_id, master_key
+        
         # Derive master key from password
         master_key, salt, kdf_type, kdf_params, verification_hash = \
             self.key_manager.derive_master_key(password)
@@ -459,19 +2082,177 @@ class SegmentEncryptor:
         
         return file_id, master_key
     
-    def encrypt_file_segment(self, file_id, master_key, segment_data, segment_index):
+    def setup_encryption_async(self, password, vault_id=None):
+        """
+        Start setup_encryption on a background thread
+        
+        Argon2id runs in C without holding the GIL, so the caller can analyse
+        and split the file while the master key is being derived.
+        
+        Args:
+            password (str): User-provided password
+            vault_id (str, optional): Keyring to use, as in setup_encryption
+            
+        Returns:
+            Future: Resolves to the (file_id, master_key) tuple of setup_encryption
+        """
+        return self._get_kdf_executor().submit(self.setup_encryption, password, vault_id)
+    
+    def unlock_vault(self, password, vault_id="default"):
+        """
+        Derive a vault's key-encryption key, creating the vault on first use
+        
+        The key is cached for the session, so every file in the vault is
+        unlocked with a single KDF run.
+        
+        Args:
+            password (str): Vault password
+            vault_id (str): Name of the vault
+            
+        Returns:
+            bytearray: The verified key-encryption key, as cached (see MasterKeyCache.get)
+        """
+        # Serialised so concurrent first use cannot create the vault twice
+        with self._vault_lock:
+            vault_key = self.vault_cache.get(vault_id, password)
+            if vault_key is not None:
+                return vault_key
+            
+            vault_info = self.key_manager.get_vault_info(vault_id)
+            if vault_info is None:
+                vault_key, salt, kdf_type, kdf_params, verification_hash = \
+                    self.key_manager.derive_master_key(password)
+                self.key_manager.store_vault_info(
+                    vault_id, salt, kdf_type, kdf_params, verification_hash
+                )
+            else:
+                use_argon2 = (vault_info["kdf_type"] == "argon2id")
+                if use_argon2 and not ARGON2_AVAILABLE:
+                    raise ValueError("Vault was created with Argon2id, but argon2-cffi is not installed")
+                vault_key, _, _, _, _ = self.key_manager.derive_master_key(
+                    password, vault_info["salt"], use_argon2, kdf_params=vault_info["kdf_params"]
+                )
+                if not self.key_manager.verify_master_key(vault_key, vault_info["verification_hash"]):
+                    raise ValueError("Invalid password")
+            
+            return self.vault_cache.put(vault_id, password, vault_key)
+    
+    def unlock_master_key_async(self, file_id, password):
+        """
+        Start unlock_master_key on a background thread
+        
+        Args:
+            file_id (str): Identifier for the file
+            password (str): User password
+            
+        Returns:
+            Future: Resolves to the verified master key, or raises ValueError
+        """
+        return self._get_kdf_executor().submit(self.unlock_master_key, file_id, password)
+    
+    def unlock_master_key(self, file_id, password):
+        """
+        Derive the master key for an existing file, verifying the password once
+        
+        The verified key is kept in the session cache so later segments of the
+        same file skip the KDF entirely.
+        
+        Args:
+            file_id (str): Identifier for the file
+            password (str): User password
+            
+        Returns:
+            bytearray: The verified master key, as cached (see MasterKeyCache.get)
+        """
+        master_key = self.key_cache.get(file_id, password)
+        if master_key is not None:
+            return master_key
+        
+        # Get key derivation info from database
+        key_info = self.key_manager.get_master_key_info(file_id)
+        if not key_info:
+            raise ValueError(f"No key information found for file ID: {file_id}")
+        
+        # Keyring mode: unwrap the random master key with the vault key
+        if key_info.get("encrypted_key") is not None:
+            encryption_info = json.loads(key_info["encryption_info"])
+            vault_key = self.unlock_vault(password, encryption_info["vault_id"])
+            master_key = self.key_manager.unwrap_master_key(
+                vault_key, file_id, key_info["encrypted_key"], encryption_info
+            )
+            if not self.key_manager.verify_master_key(master_key, key_info["verification_hash"]):
+                raise ValueError("Invalid password")
+            
+            return self.key_cache.put(file_id, password, master_key)
+        
+        # Derive master key using stored salt, KDF type and parameters
+        salt = key_info["salt"]
+        kdf_type = key_info["kdf_type"]
+        verification_hash = key_info["verification_hash"]
+        
+        # Use the same derivation method and cost parameters the file was created with
+        use_argon2 = (kdf_type == "argon2id")
+        if use_argon2 and not ARGON2_AVAILABLE:
+            raise ValueError("File was encrypted with Argon2id, but argon2-cffi is not installed")
+        master_key, _, _, _, _ = self.key_manager.derive_master_key(
+            password, salt, use_argon2, kdf_params=key_info["kdf_params"]
+        )
+        
+        # Verify the derived key is correct
+        if not self.key_manager.verify_master_key(master_key, verification_hash):
+            raise ValueError("Invalid password")
+        
+        return self.key_cache.put(file_id, password, master_key)
+    
+    def lock_master_key(self, file_id=None):
+        """Forget the cached master key for a file, or every file and vault key if None"""
+        if file_id is None:
+            self.key_cache.clear()
+            self.vault_cache.clear()
+        else:
+            self.key_cache.evict(file_id)
+        self.key_manager.forget_segment_keys(file_id)
+    
+    def prepare_segment_keys(self, file_id, master_key, segment_indices):
+        """
+        Derive and cache the keys for a batch of segments of one file
+        
+        Args:
+            file_id (str): Identifier for the file encryption session
+            master_key (bytes): The master key for this file
+            segment_indices (iterable): Indices of the segments
+        """
+        segment_ids = [f"{file_id}_{segment_index}" for segment_index in segment_indices]
+        self.key_manager.derive_segment_keys(master_key, segment_ids, file_id)
+    
+    def encrypt_file_segment(self, file_id, master_key, segment_data, segment_index, 
+                             store_key_info=True, out=None, compression=None, segment_hash=None):
         """
         Encrypt a single file segment
         
+        The encrypted data is the ciphertext with its tag appended, ready to be
+        written out in one piece.
+        
         Args:
             file_id (str): Identifier for the file encryption session
             master_key (bytes): The master key for this file
-            segment_data (bytes): Raw data of the segment to encrypt
+            segment_data (bytes-like): Raw data of the segment to encrypt
             segment_index (int): Index of this segment in the file
+            store_key_info (bool): Write the segment_keys_info row now. Pass False
+                to batch rows through record_segment_key_infos instead.
+            out (bytearray, optional): Preallocated buffer to encrypt into
+            compression (str, optional): Codec to compress with first. Segments
+                whose samples don't compress, or that don't end up smaller, are
+                stored uncompressed.
+            segment_hash (str, optional): Keyed plaintext hash to record (see
+                dedup_content_id)
             
         Returns:
             tuple: (encrypted_data, metadata_dict, serialized_metadata)
         """
+        plaintext_size = len(segment_data)
+        segment_data, codec = self._compress_segment(segment_data, compression)
+        
         # Generate a unique segment ID
         segment_id = f"{file_id}_{segment_index}"
         
@@ -480,48 +2261,343 @@ class SegmentEncryptor:
             master_key, segment_id, file_id
         )
         
-        # Encrypt the segment data
-        encryption_result = self.encryption_engine.encrypt_segment(
-            segment_data, segment_key
+        # Encrypt the segment data, keeping the tag after the ciphertext
+        encryption_result = self.encryption_engine.seal_segment(
+            segment_data, segment_key, out=out
         )
         
         # Extract encryption details
         algorithm = encryption_result["algorithm"]
         nonce = encryption_result["nonce"]
         tag = encryption_result["tag"]
-        ciphertext = encryption_result["ciphertext"]
+        sealed = encryption_result["sealed"]
         
         # Store segment encryption info in the database
-        self.key_manager.store_segment_key_info(
-            segment_id, file_id, segment_index, algorithm, nonce, tag
-        )
+        if store_key_info:
+            self.key_manager.store_segment_key_info(
+                segment_id, file_id, segment_index, algorithm, nonce, tag, codec,
+                segment_hash=segment_hash
+            )
         
         # Generate metadata
         metadata = self.metadata_handler.generate_segment_metadata(
             segment_id, file_id, segment_index, algorithm, 
-            nonce, tag, len(ciphertext)
+            nonce, tag, len(sealed) - TAG_SIZE, sealed=True,
+            plaintext_size=plaintext_size, compression=codec, segment_hash=segment_hash
         )
         
         # Serialize metadata for storage/transmission
         serialized_metadata = self.metadata_handler.serialize_metadata(metadata)
         
-        return ciphertext, metadata, serialized_metadata
+        return sealed, metadata, serialized_metadata
+    
+    def encrypt_file_segment_stream(self, file_id, master_key, reader, writer, segment_index,
+                                    store_key_info=True, chunk_size=None, compression=None,
+                                    segment_hash=None, hash_plaintext=False):
+        """
+        Encrypt a single file segment from a file object in constant memory
+        
+        Args:
+            file_id (str): Identifier for the file encryption session
+            master_key (bytes): The master key for this file
+            reader (file): Binary file object holding the segment plaintext
+            writer (file): Binary file object to write the encrypted segment to
+            segment_index (int): Index of this segment in the file
+            store_key_info (bool): Write the segment_keys_info row now
+            chunk_size (int, optional): Plaintext bytes per AEAD chunk
+            compression (str, optional): Codec to compress with first, used only
+                if samples of the segment compress well
+            segment_hash (str, optional): Keyed plaintext hash to record (see
+                dedup_content_id)
+            hash_plaintext (bool): Compute segment_hash from the plaintext as it
+                is encrypted, instead of reading the segment twice
+            
+        Returns:
+            tuple: (metadata_dict, serialized_metadata)
+        """
+        segment_id = f"{file_id}_{segment_index}"
+        segment_key = self.key_manager.derive_segment_key(master_key, segment_id, file_id)
+        
+        digest = hashlib.sha256() if hash_plaintext else None
+        source, codec = self._compressing_source(reader, compression, digest)
+        
+        result = self.encryption_engine.encrypt_stream(
+            source, writer, segment_key, chunk_size=chunk_size
+        )
+        plaintext_size = source.bytes_in if codec else result["plaintext_size"]
+        if digest is not None:
+            segment_hash = self.dedup_content_id(digest.digest())
+        
+        if store_key_info:
+            self.key_manager.store_segment_key_info(
+                segment_id, file_id, segment_index,
+                result["algorithm"], result["nonce"], result["tag"], codec,
+                segment_hash=segment_hash
+            )
+        
+        metadata = self.metadata_handler.generate_segment_metadata(
+            segment_id, file_id, segment_index, result["algorithm"],
+            result["nonce"], result["tag"], result["plaintext_size"],
+            chunk_size=result["chunk_size"], plaintext_size=plaintext_size,
+            compression=codec, segment_hash=segment_hash
+        )
+        
+        return metadata, self.metadata_handler.serialize_metadata(metadata)
+    
+    def _compress_segment(self, segment_data, compression):
+        """Compress segment_data if it is worth it; returns (data, codec or None)"""
+        if compression is not None and self.compressor.is_compressible(segment_data):
+            compressed = self.compressor.compress(segment_data, compression)
+            if len(compressed) < len(segment_data):
+                return compressed, compression
+        return segment_data, None
+    
+    def _recompress_segment(self, segment_data, codec):
+        """Apply exactly the codec recorded for an existing blob; returns (data, codec)"""
+        if codec is None:
+            return segment_data, None
+        return self.compressor.compress(segment_data, codec), codec
+    
+    def _check_recreated_blob(self, blob_info, tag):
+        """Make sure a recreated dedup blob matches the one files refer to"""
+        if not hmac.compare_digest(tag, blob_info["tag"]):
+            raise ValueError(
+                f"Could not recreate dedup blob {blob_info['content_id'][:12]}: "
+                "its data no longer encrypts to the stored tag"
+            )
+    
+    def _compressing_source(self, reader, compression, digest=None):
+        """
+        Wrap reader in a compressing reader if samples compress; returns (source, codec or None).
+        If digest is given, the plaintext read is also fed to it.
+        """
+        compressible = compression is not None and self.compressor.is_stream_compressible(reader)
+        if digest is not None:
+            reader = _HashingReader(reader, digest)
+        if compressible:
+            return self.compressor.compressing_reader(reader, compression), compression
+        return reader, None
+    
+    def _dedup_key(self, label, digest):
+        """HMAC of a segment's SHA-256 under the per-user dedup secret"""
+        if self._dedup_secret is None:
+            self._dedup_secret = self.key_manager.get_user_secret("dedup")
+        return hmac.new(self._dedup_secret, label + digest, hashlib.sha256).digest()
+    
+    def dedup_content_id(self, digest):
+        """
+        Content ID used to find identical segments across files
+        
+        It is keyed with the per-user dedup secret, so the index does not
+        reveal the hash of the plaintext. The same value is recorded as every
+        segment's hash so updates can tell which segments changed.
+        
+        Args:
+            digest (bytes): SHA-256 of the segment plaintext
+            
+        Returns:
+            str: Hex content ID
+        """
+        return self._dedup_key(b"content-id", digest).hex()
+    
+    def encrypt_dedup_blob(self, digest, segment_data, compression=None, out=None):
+        """
+        Encrypt a segment into a blob that any file containing it can share
+        
+        The data key is derived from the segment hash and the per-user secret,
+        so every copy of the segment gets the same key; files reference the
+        blob through reference_dedup_blob. The blob is registered in the dedup
+        index with no references yet.
+        
+        If the blob is already indexed (its file was lost), the same ciphertext
+        is recreated with the stored nonce, since files referencing the blob
+        keep its nonce and tag.
+        
+        Args:
+            digest (bytes): SHA-256 of segment_data
+            segment_data (bytes-like): Raw data of the segment
+            compression (str, optional): Codec to compress with first
+            out (bytearray, optional): Preallocated buffer to encrypt into
+            
+        Returns:
+            tuple: (sealed_data, blob_info) with blob_info as from get_dedup_blob
+        """
+        content_id = self.dedup_content_id(digest)
+        data_key = self._dedup_key(b"segment-data-key", digest)
+        existing = self.key_manager.get_dedup_blob(content_id)
+        
+        plaintext_size = len(segment_data)
+        if existing is not None:
+            segment_data, codec = self._recompress_segment(segment_data, existing["compression"])
+            result = self.encryption_engine.seal_segment(
+                segment_data, data_key, algorithm=existing["encryption_algorithm"],
+                out=out, nonce=existing["nonce"]
+            )
+            self._check_recreated_blob(existing, result["tag"])
+            return result["sealed"], existing
+        
+        segment_data, codec = self._compress_segment(segment_data, compression)
+        
+        result = self.encryption_engine.seal_segment(segment_data, data_key, out=out)
+        sealed = result["sealed"]
+        
+        self.key_manager.store_dedup_blob(
+            content_id, result["algorithm"], result["nonce"], result["tag"],
+            len(sealed) - TAG_SIZE, plaintext_size, compression=codec
+        )
+        return sealed, self.key_manager.get_dedup_blob(content_id)
+    
+    def encrypt_dedup_blob_stream(self, digest, reader, writer, chunk_size=None, compression=None):
+        """
+        Streaming version of encrypt_dedup_blob for large segments
+        
+        An indexed blob is recreated with its stored chunk size and nonce prefix.
+        
+        Args:
+            digest (bytes): SHA-256 of the segment plaintext
+            reader (file): Binary file object holding the segment plaintext
+            writer (file): Binary file object to write the blob to
+            chunk_size (int, optional): Plaintext bytes per AEAD chunk
+            compression (str, optional): Codec to compress with first
+            
+        Returns:
+            dict: blob_info as from get_dedup_blob
+        """
+        content_id = self.dedup_content_id(digest)
+        data_key = self._dedup_key(b"segment-data-key", digest)
+        existing = self.key_manager.get_dedup_blob(content_id)
+        
+        if existing is not None:
+            codec = existing["compression"]
+            source = self.compressor.compressing_reader(reader, codec) if codec else reader
+            result = self.encryption_engine.encrypt_stream(
+                source, writer, data_key, algorithm=existing["encryption_algorithm"],
+                chunk_size=existing["chunk_size"], nonce_prefix=existing["nonce"]
+            )
+            self._check_recreated_blob(existing, result["tag"])
+            return existing
+        
+        source, codec = self._compressing_source(reader, compression)
+        result = self.encryption_engine.encrypt_stream(
+            source, writer, data_key, chunk_size=chunk_size
+        )
+        plaintext_size = source.bytes_in if codec else result["plaintext_size"]
+        
+        self.key_manager.store_dedup_blob(
+            content_id, result["algorithm"], result["nonce"], result["tag"],
+            result["plaintext_size"], plaintext_size,
+            chunk_size=result["chunk_size"], compression=codec
+        )
+        return self.key_manager.get_dedup_blob(content_id)
+    
+    def reference_dedup_blob(self, file_id, master_key, segment_index, digest, blob_info,
+                             store_key_info=True):
+        """
+        Make a segment of a file point at a shared dedup blob
+        
+        The blob's data key is wrapped under the segment's own key, so the
+        file's password is still needed to decrypt it.
+        
+        Args:
+            file_id (str): Identifier for the file encryption session
+            master_key (bytes): The master key for this file
+            segment_index (int): Index of this segment in the file
+            digest (bytes): SHA-256 of the segment plaintext
+            blob_info (dict): Blob information from get_dedup_blob
+            store_key_info (bool): Write the segment_keys_info row (and take the
+                blob reference) now. Pass False to batch through record_segment_key_infos.
+            
+        Returns:
+            tuple: (metadata_dict, serialized_metadata)
+        """
+        segment_id = f"{file_id}_{segment_index}"
+        segment_key = self.key_manager.derive_segment_key(master_key, segment_id, file_id)
+        
+        key_nonce = os.urandom(12)
+        wrapped_key = key_nonce + AESGCM(segment_key).encrypt(
+            key_nonce, self._dedup_key(b"segment-data-key", digest), segment_id.encode()
+        )
+        
+        metadata = self.metadata_handler.generate_segment_metadata(
+            segment_id, file_id, segment_index, blob_info["encryption_algorithm"],
+            blob_info["nonce"], blob_info["tag"], blob_info["ciphertext_size"],
+            sealed=blob_info["chunk_size"] is None, chunk_size=blob_info["chunk_size"],
+            plaintext_size=blob_info["plaintext_size"], compression=blob_info["compression"],
+            content_id=blob_info["content_id"], wrapped_key=wrapped_key,
+            segment_hash=blob_info["content_id"]
+        )
+        
+        if store_key_info:
+            self.record_segment_key_infos([metadata])
+        
+        return metadata, self.metadata_handler.serialize_metadata(metadata)
+    
+    def encrypt_file_segments(self, file_id, master_key, segments, start_index=0):
+        """
+        Encrypt a list of segments and register them all in one transaction
+        
+        Args:
+            file_id (str): Identifier for the file encryption session
+            master_key (bytes): The master key for this file
+            segments (list): Raw data of each segment, in order
+            start_index (int): Segment index of the first item in segments
+            
+        Returns:
+            list: (encrypted_data, metadata_dict, serialized_metadata) per segment
+        """
+        indices = range(start_index, start_index + len(segments))
+        self.prepare_segment_keys(file_id, master_key, indices)
+        
+        results = [
+            self.encrypt_file_segment(
+                file_id, master_key, segment_data, segment_index, store_key_info=False
+            )
+            for segment_index, segment_data in zip(indices, segments)
+        ]
+        
+        self.record_segment_key_infos([metadata for _, metadata, _ in results])
+        return results
+    
+    def record_segment_key_infos(self, metadata_list):
+        """
+        Write segment_keys_info rows for already-encrypted segments in one batch
+        
+        Args:
+            metadata_list (list): Metadata dicts from encrypt_file_segment
+        """
+        self.key_manager.store_segment_key_infos([
+            (
+                metadata["segment_id"],
+                metadata["file_id"],
+                metadata["segment_index"],
+                metadata["algorithm"],
+                b64decode(metadata["nonce"]),
+                b64decode(metadata["tag"]),
+                metadata.get("compression"),
+                metadata.get("content_id"),
+                b64decode(metadata["wrapped_key"]) if "wrapped_key" in metadata else None,
+                metadata.get("segment_hash")
+            )
+            for metadata in metadata_list
+        ])
     
-    def decrypt_file_segment(self, encrypted_data, metadata, password=None, master_key=None):
+    def decrypt_file_segment(self, encrypted_data, metadata, password=None, master_key=None,
+                             out=None):
         """
         Decrypt a file segment using either password or master key
         
         Args:
-            encrypted_data (bytes): Encrypted segment data
+            encrypted_data (bytes-like): Encrypted segment data
             metadata (dict or str): Segment metadata (or serialized metadata)
             password (str, optional): User password (if master_key not provided)
             master_key (bytes, optional): Master key (if already derived)
+            out (bytearray, optional): Preallocated buffer to decrypt sealed segments into
             
         Returns:
-            bytes: Decrypted segment data
+            bytes-like: Decrypted segment data
         """
         # Parse metadata if it's serialized
-        if isinstance(metadata, str):
+        if not isinstance(metadata, dict):
             metadata = self.metadata_handler.deserialize_metadata(metadata)
         
         segment_id = metadata["segment_id"]
@@ -530,39 +2606,78 @@ class SegmentEncryptor:
         nonce = metadata["nonce"]
         tag = metadata["tag"]
         
-        # If master key not provided, derive it from password
-        if master_key is None and password is not None:
-            # Get key derivation info from database
-            key_info = self.key_manager.get_master_key_info(file_id)
-            if not key_info:
-                raise ValueError(f"No key information found for file ID: {file_id}")
-            
-            # Derive master key using stored parameters
-            salt = key_info["salt"]
-            kdf_type = key_info["kdf_type"]
-            verification_hash = key_info["verification_hash"]
-            
-            # Use the same derivation method based on stored KDF type
-            use_argon2 = (kdf_type == "argon2id")
-            master_key, _, _, _, _ = self.key_manager.derive_master_key(
-                password, salt, use_argon2
+        segment_key = self._segment_key_for(metadata, password, master_key)
+        
+        # Sealed segments carry their tag; older ones need it appended from metadata
+        if metadata.get("sealed"):
+            decrypted_data = self.encryption_engine.open_segment(
+                encrypted_data, nonce, algorithm, segment_key,
+                out=None if metadata.get("compression") else out
+            )
+        else:
+            decrypted_data = self.encryption_engine.decrypt_segment(
+                encrypted_data, nonce, tag, algorithm, segment_key
             )
+        
+        if metadata.get("compression"):
+            return self.compressor.decompress(decrypted_data, metadata["compression"])
+        return decrypted_data
+    
+    def decrypt_file_segment_stream(self, reader, writer, metadata, password=None, master_key=None):
+        """
+        Decrypt a segment stored in the streaming chunked format
+        
+        Args:
+            reader (file): Binary file object holding the encrypted segment
+            writer (file): Binary file object to write plaintext to
+            metadata (dict or str): Segment metadata (or serialized metadata)
+            password (str, optional): User password (if master_key not provided)
+            master_key (bytes, optional): Master key (if already derived)
             
-            # Verify the derived key is correct
-            if not self.key_manager.verify_master_key(master_key, verification_hash):
-                raise ValueError("Invalid password")
+        Returns:
+            int: Number of plaintext bytes written
+        """
+        if not isinstance(metadata, dict):
+            metadata = self.metadata_handler.deserialize_metadata(metadata)
+        
+        segment_key = self._segment_key_for(metadata, password, master_key)
+        
+        if metadata.get("compression"):
+            writer = self.compressor.decompressing_writer(writer, metadata["compression"])
+        
+        written = self.encryption_engine.decrypt_stream(
+            reader, writer, metadata["nonce"], metadata["algorithm"],
+            segment_key, metadata["chunk_size"]
+        )
+        
+        if metadata.get("compression"):
+            return writer.finish()
+        return written
+    
+    def _segment_key_for(self, metadata, password=None, master_key=None):
+        """Derive the key for the segment described by metadata"""
+        file_id = metadata["file_id"]
+        
+        # If master key not provided, unlock it from password (cached per session)
+        if master_key is None and password is not None:
+            master_key = self.unlock_master_key(file_id, password)
         
         if master_key is None:
             raise ValueError("Either password or master_key must be provided")
         
-        # Derive segment key
         segment_key = self.key_manager.derive_segment_key(
-            master_key, segment_id, file_id
+            master_key, metadata["segment_id"], file_id
         )
         
-        # Decrypt the segment
-        decrypted_data = self.encryption_engine.decrypt_segment(
-            encrypted_data, nonce, tag, algorithm, segment_key
-        )
+        # Deduplicated segments are encrypted under a data key shared by every
+        # copy; each file holds it wrapped under its own segment key
+        if metadata.get("wrapped_key"):
+            wrapped_key = metadata["wrapped_key"]
+            try:
+                return AESGCM(segment_key).decrypt(
+                    wrapped_key[:12], wrapped_key[12:], metadata["segment_id"].encode()
+                )
+            except InvalidTag:
+                raise ValueError("Could not unwrap the segment data key")
         
-        return decrypted_data
\ No newline at end of file
+        return segment_key
@@ -105,6 +105,7 @@ def test_basic_encryption():
     print("\nCleaning up test files...")
     os.remove("test_ciphertext.bin")
     os.remove("test_metadata.json")
+    segment_encryptor.key_manager.close()
     if os.path.exists(DB_PATH):
         os.remove(DB_PATH)
     
@@ -5,16 +5,28 @@ import sqlite3
 from io import BytesIO
 import argparse
 import sys
-from math import ceil
+from math import ceil, log2
 import shutil
 import mimetypes
 import uuid
 import time
 import io
+import hashlib
+import codecs
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# numpy speeds up content-defined chunking but is optional
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
 import pyfiglet
 from gui import introMenu
-from encryption import KeyManager, SegmentEncryptor
-from dropbox_helper import download_and_delete_file, list_files, upload_file
+from encryption import KeyManager, SegmentEncryptor, get_connection_manager
+from dropbox_helper import download_and_delete_file, download_file, list_files, upload_file
 
 # Settings file path
 SETTINGS_FILE = "settings.json"
@@ -22,7 +34,344 @@ SETTINGS_FILE = "settings.json"
 # Database for encryption keys
 DB_PATH = "keys.db"
 key_manager = KeyManager(DB_PATH)
-segment_encryptor = SegmentEncryptor(DB_PATH)
+# "auto" benchmarks AES-GCM and ChaCha20 once per host and uses the faster one
+segment_encryptor = SegmentEncryptor(DB_PATH, default_algorithm="auto")
+
+# Shared thread-local connection pool for the catalog tables
+db = get_connection_manager(DB_PATH)
+
+# Segments larger than this are encrypted in the streaming chunked format,
+# so they never have to fit in memory
+STREAM_SEGMENT_THRESHOLD = 64 * 1024 * 1024
+
+# Block size used when copying segment data between files
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Parallel segment encryption: worker threads and the cap on bytes held by
+# segments being encrypted at once
+ENCRYPT_WORKERS = os.cpu_count() or 1
+ENCRYPT_MEMORY_BUDGET = 512 * 1024 * 1024
+
+# Parallel restore uses the same limits
+RESTORE_WORKERS = ENCRYPT_WORKERS
+RESTORE_MEMORY_BUDGET = ENCRYPT_MEMORY_BUDGET
+
+# Default (min, avg, max) chunk sizes for content-defined chunking
+CDC_CHUNK_SIZES = (1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+# One-pass file analysis: read size, bytes sampled per read for the entropy
+# estimate, and number of analysed files remembered per session
+ANALYSIS_BLOCK_SIZE = 4 * 1024 * 1024
+ENTROPY_SAMPLE_SIZE = 16 * 1024
+FILE_INFO_CACHE_SIZE = 256
+
+# Files with a higher sampled entropy (bits per byte) are already compressed
+# or encrypted, so upload skips compressing them
+INCOMPRESSIBLE_ENTROPY = 7.5
+
+# Sharded segment store: each file's segments and manifest, and the shared
+# blobs of deduplicated segments (one per distinct content)
+STORE_DIR = os.path.join("output", "store")
+
+# Segments downloaded for a restore are kept here until it finishes
+DOWNLOAD_TEMP_DIR = os.path.join("output", "temp")
+
+# Format version of the per-file segment manifests
+MANIFEST_VERSION = 1
+
+# Gear hash table for content-defined chunking. It must never change, or
+# boundaries would stop lining up with chunks of earlier uploads.
+CDC_GEAR = [
+    int.from_bytes(hashlib.sha256(b"ByteScatter gear %d" % i).digest()[:8], "big")
+    for i in range(256)
+]
+CDC_GEAR_ARRAY = numpy.array(CDC_GEAR, dtype=numpy.uint64) if NUMPY_AVAILABLE else None
+
+# Bytes hashed per numpy pass in find_cdc_cut, small enough to stay in cache
+CDC_SCAN_BLOCK_SIZE = 32 * 1024
+
+#
+#   Finds every segment stored in a directory by reading each segment's owner
+#
+def scan_segment_files(output_dir="output"):
+    """
+    Reads the file_id/index prefix of every container and legacy .meta file
+    in output_dir.
+    
+    Args:
+        output_dir (str): Directory to scan
+        
+    Returns:
+        list: (file_id, segment_index, encrypted_path, metadata_path) of each
+            segment, with metadata_path None for containers
+    """
+    segments = []
+    for filename in os.listdir(output_dir):
+        stem, extension = os.path.splitext(filename)
+        if extension == ".seg":
+            enc_path, meta_path = os.path.join(output_dir, filename), None
+        elif extension == ".meta":
+            enc_path = os.path.join(output_dir, stem + ".enc")
+            meta_path = os.path.join(output_dir, filename)
+            if not os.path.exists(enc_path):
+                continue
+        else:
+            continue
+        
+        # Only the file_id/index prefix is decoded, not the whole record
+        try:
+            if meta_path:
+                with open(meta_path, "rb") as f:
+                    owner, segment_index = segment_encryptor.metadata_handler.read_identity(f.read())
+            else:
+                with open(enc_path, "rb") as f:
+                    owner, segment_index = segment_encryptor.container.read_identity(f)
+        except Exception as e:
+            print(f"Error reading metadata from {meta_path or enc_path}: {e}")
+            continue
+        segments.append((owner, segment_index or 0, enc_path, meta_path))
+    return segments
+
+#
+#   Records where a file's segments are stored locally
+#
+def record_local_segments(file_id, segments_info):
+    """
+    Adds segments to the local path index, with the size and modification
+    time their files have now so later lookups can tell if they changed.
+    
+    Args:
+        file_id (str): ID of the file the segments belong to
+        segments_info (list): Segment entries ("encrypted_path", "metadata_path",
+            "segment_index")
+    """
+    rows = []
+    for segment_info in segments_info:
+        try:
+            stat = os.stat(segment_info["encrypted_path"])
+        except OSError as e:
+            print(f"Cannot index segment {segment_info['segment_index']}: {e}")
+            continue
+        rows.append((
+            f"{file_id}_{segment_info['segment_index']}", file_id, segment_info["segment_index"],
+            segment_info["encrypted_path"], segment_info.get("metadata_path"),
+            stat.st_size, stat.st_mtime_ns
+        ))
+    
+    with db.transaction() as cursor:
+        cursor.executemany(
+            """
+            INSERT OR REPLACE INTO segment_local_paths (
+                segment_id, file_id, segment_index, encrypted_path, metadata_path,
+                size, mtime_ns, recorded_date
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            """,
+            rows
+        )
+
+#
+#   Indexes the segments already on disk (catalogs from before the local path index)
+#
+def index_existing_segments(output_dir="output"):
+    directories = [output_dir] + segment_store.shard_dirs()
+    directories = [directory for directory in directories if os.path.isdir(directory)]
+    if not directories:
+        return
+    
+    cursor = db.cursor()
+    cursor.execute("SELECT segment_id FROM segment_keys_info")
+    known_segment_ids = {row[0] for row in cursor.fetchall()}
+    
+    by_file = {}
+    for file_id, segment_index, enc_path, meta_path in \
+            (found for directory in directories for found in scan_segment_files(directory)):
+        if f"{file_id}_{segment_index}" in known_segment_ids:
+            by_file.setdefault(file_id, []).append({
+                "encrypted_path": enc_path,
+                "metadata_path": meta_path,
+                "segment_index": segment_index
+            })
+    
+    for file_id, segments in by_file.items():
+        record_local_segments(file_id, segments)
+    if by_file:
+        print(f"Indexed local segments of {len(by_file)} files")
+
+#
+#   Sharded on-disk layout of segment files
+#
+class SegmentStore:
+    """
+    Places segment files in a two-level sharded tree instead of one flat
+    directory.
+    
+    A file's containers (<file_id>_<index>.seg) and manifest live in
+    <root>/<ab>/<cd>/, where abcd are the first hex digits of the file_id.
+    Dedup blobs live in <root>/blobs/<ab>/<cd>/ under their content ID.
+    """
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def shard_dir(self, file_id):
+        """Directory holding a file's segments and manifest"""
+        return os.path.join(self.root, file_id[:2], file_id[2:4])
+    
+    def shard_dirs(self):
+        """Every existing shard directory (not the blob tree)"""
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.join(self.root, first, second)
+            for first in sorted(os.listdir(self.root)) if first != "blobs"
+            for second in sorted(os.listdir(os.path.join(self.root, first)))
+        ]
+    
+    def file_path(self, file_id, name):
+        """Path of the file's object called name (e.g. in its manifest)"""
+        return os.path.join(self.shard_dir(file_id), name)
+    
+    def segment_path(self, file_id, segment_index, extension=".seg"):
+        return self.file_path(file_id, f"{file_id}_{segment_index}{extension}")
+    
+    def manifest_path(self, file_id):
+        return self.file_path(file_id, f"{file_id}.manifest")
+    
+    def blob_path(self, content_id):
+        return os.path.join(self.root, "blobs", content_id[:2], content_id[2:4], f"{content_id}.enc")
+    
+    def put(self, source_path, path):
+        """Moves a finished file to its place in the store"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+        return path
+    
+    def migrate(self, legacy_dir="output"):
+        """
+        Moves the segments, manifests and dedup blobs of the flat legacy_dir
+        layout into the store and re-records the moved segments in the local
+        path index. Files keep their names, so manifests stay valid. Running
+        it again finds nothing left to move.
+        
+        Files the catalog doesn't know (segments without a segment_keys_info
+        row, manifests of unknown files, unindexed blobs) are left in place.
+        
+        Args:
+            legacy_dir (str): Directory of the flat layout
+            
+        Returns:
+            int: Number of files moved
+        """
+        if not os.path.isdir(legacy_dir):
+            return 0
+        
+        cursor = db.cursor()
+        cursor.execute("SELECT segment_id FROM segment_keys_info")
+        known_segment_ids = {row[0] for row in cursor.fetchall()}
+        cursor.execute("SELECT file_id FROM master_files")
+        known_file_ids = {row[0] for row in cursor.fetchall()}
+        cursor.execute("SELECT content_id FROM dedup_blobs")
+        known_content_ids = {row[0] for row in cursor.fetchall()}
+        
+        moved = 0
+        skipped = 0
+        by_file = {}
+        for file_id, segment_index, enc_path, meta_path in scan_segment_files(legacy_dir):
+            if f"{file_id}_{segment_index}" not in known_segment_ids:
+                skipped += 1
+                continue
+            segment_info = {
+                "encrypted_path": self.put(enc_path, self.file_path(file_id, os.path.basename(enc_path))),
+                "metadata_path": self.put(meta_path, self.file_path(file_id, os.path.basename(meta_path)))
+                                 if meta_path else None,
+                "segment_index": segment_index
+            }
+            by_file.setdefault(file_id, []).append(segment_info)
+            moved += 2 if meta_path else 1
+        
+        for filename in os.listdir(legacy_dir):
+            if filename.endswith(".manifest"):
+                file_id = filename[:-len(".manifest")]
+                if file_id not in known_file_ids:
+                    skipped += 1
+                    continue
+                self.put(os.path.join(legacy_dir, filename), self.manifest_path(file_id))
+                moved += 1
+        
+        legacy_blob_dir = os.path.join(legacy_dir, "dedup")
+        if os.path.isdir(legacy_blob_dir):
+            for filename in os.listdir(legacy_blob_dir):
+                if filename.endswith(".enc"):
+                    content_id = filename[:-len(".enc")]
+                    if content_id not in known_content_ids:
+                        skipped += 1
+                        continue
+                    self.put(os.path.join(legacy_blob_dir, filename), self.blob_path(content_id))
+                    moved += 1
+            if not os.listdir(legacy_blob_dir):
+                os.rmdir(legacy_blob_dir)
+        
+        for file_id, segments in by_file.items():
+            record_local_segments(file_id, segments)
+        if moved:
+            print(f"Moved {moved} files from {legacy_dir} into the segment store at {self.root}")
+        if skipped:
+            print(f"Left {skipped} files in {legacy_dir} that the catalog doesn't know")
+        return moved
+
+segment_store = SegmentStore(STORE_DIR)
+
+#
+#   Creates the file catalog tables if they don't exist
+#
+def init_catalog():
+    with db.transaction() as cursor:
+        # Create master_files table if it doesn't exist
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS master_files (
+            file_id TEXT PRIMARY KEY,
+            original_filename TEXT NOT NULL,
+            segment_count INTEGER NOT NULL,
+            creation_date TEXT NOT NULL,
+            generation INTEGER NOT NULL DEFAULT 1
+        )
+        ''')
+        
+        # Catalogs created before incremental updates lack the generation counter
+        cursor.execute("PRAGMA table_info(master_files)")
+        if "generation" not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE master_files ADD COLUMN generation INTEGER NOT NULL DEFAULT 1")
+        
+        # Create table for cloud storage locations if it doesn't exist
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS segment_cloud_locations (
+            segment_id TEXT PRIMARY KEY,
+            cloud_service TEXT NOT NULL,
+            remote_id TEXT NOT NULL,
+            upload_date TEXT NOT NULL,
+            FOREIGN KEY (segment_id) REFERENCES segment_keys_info(segment_id)
+        )
+        ''')
+        
+        # Local files of each segment, so lookups never have to list output/
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS segment_local_paths (
+            segment_id TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            segment_index INTEGER NOT NULL,
+            encrypted_path TEXT NOT NULL,
+            metadata_path TEXT,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            recorded_date TEXT NOT NULL,
+            FOREIGN KEY (segment_id) REFERENCES segment_keys_info(segment_id)
+        )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_segment_local_paths_file ON segment_local_paths (file_id, segment_index)"
+        )
+
+init_catalog()
 
 def introMenu():
     text = pyfiglet.figlet_format("Byte Scatter", justify="center")
@@ -71,22 +420,6 @@ def save_settings(settings):
     except Exception as e:
         print(f"Error saving settings: {e}")
 
-#
-#   Detect what file type - using mimetypes instead of magic
-#
-def detect_file_type(filepath):
-    # Use mimetypes module instead of magic for better compatibility
-    mime_type, _ = mimetypes.guess_type(filepath)
-    if mime_type is None:
-        # If mimetype can't be determined, check if it's text by trying to read it
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                f.read(1024)  # Try to read a bit of the file
-                return "text/plain"  # If no error, it's probably text
-        except UnicodeDecodeError:
-            return "application/octet-stream"  # It's binary
-    return mime_type
-
 #
 #   Reads a file in binary mode and returns its raw data
 #
@@ -105,122 +438,553 @@ def read_file_raw(filepath):
         return None
 
 #
-#   Gets file line count or size for binary files
+#   Analyses a file in one pass: size, newlines, text/binary, hash and entropy
 #
+_file_info_cache = OrderedDict()
+_file_info_lock = threading.Lock()
+
 def get_file_info(file_path):
-    file_type = detect_file_type(file_path)
+    """
+    Reads the file once in ANALYSIS_BLOCK_SIZE blocks and gathers everything
+    the upload needs to know about it.
     
-    if file_type and "text" in file_type: 
-        try:
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                return {"type": "text", "lines": len(f.readlines()), "size": os.path.getsize(file_path)}
-        except Exception as e:
-            print(f"Error reading text file: {e}")
-            # Fallback to binary handling
+    The type comes from the file extension (mimetypes) when it has a known
+    one; otherwise the file is text if all of it is valid UTF-8. The entropy
+    is estimated from the first ENTROPY_SAMPLE_SIZE bytes of every block.
+    Results are cached per (path, size, mtime), so analysing an unchanged
+    file again in the same session doesn't read it.
     
-    # For binary or if text file reading failed
+    Args:
+        file_path (str): Path to the file
+        
+    Returns:
+        dict: "type" ("text" or "binary"), "size", "newlines", "sha256" (hex)
+            and "entropy" (bits per byte), or None if the file can't be read
+    """
     try:
-        return {"type": "binary", "size": os.path.getsize(file_path)}
-    except Exception as e:
+        stat = os.stat(file_path)
+    except OSError as e:
         print(f"Error getting file size: {e}")
         return None
+    
+    cache_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _file_info_lock:
+        if cache_key in _file_info_cache:
+            _file_info_cache.move_to_end(cache_key)
+            return dict(_file_info_cache[cache_key])
+    
+    mime_type, _ = mimetypes.guess_type(file_path)
+    decoder = codecs.getincrementaldecoder("utf-8")() if mime_type is None else None
+    digest = hashlib.sha256()
+    byte_counts = Counter()
+    newlines = 0
+    size = 0
+    
+    try:
+        with open(file_path, "rb") as f:
+            while True:
+                block = f.read(ANALYSIS_BLOCK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                digest.update(block)
+                newlines += block.count(b"\n")
+                byte_counts.update(block[:ENTROPY_SAMPLE_SIZE])
+                
+                # Stop sniffing at the first invalid byte sequence
+                if decoder is not None:
+                    try:
+                        decoder.decode(block)
+                    except UnicodeDecodeError:
+                        decoder = None
+        if decoder is not None:
+            decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        decoder = None
+    except OSError as e:
+        print(f"Error reading file: {e}")
+        return None
+    
+    if mime_type is not None:
+        is_text = "text" in mime_type
+    else:
+        is_text = decoder is not None
+    
+    sampled = sum(byte_counts.values())
+    entropy = -sum(
+        count / sampled * log2(count / sampled) for count in byte_counts.values()
+    ) if sampled else 0.0
+    
+    info = {
+        "type": "text" if is_text else "binary",
+        "size": size,
+        "newlines": newlines,
+        "sha256": digest.hexdigest(),
+        "entropy": entropy
+    }
+    
+    with _file_info_lock:
+        _file_info_cache[cache_key] = info
+        while len(_file_info_cache) > FILE_INFO_CACHE_SIZE:
+            _file_info_cache.popitem(last=False)
+    return dict(info)
 
 #
-#   Splits a text file into chunks based on line count
+#   A byte range of the source file that is encrypted as one segment
 #
-def split_text_file(filename, input_file, num_files, num_lines):
-    ensure_output_dir()
+class SegmentRange:
+    """
+    Segment of a file described by its position instead of a copy on disk.
     
-    # create size for each new file
-    size_of_new_file = ceil(num_lines / num_files)
-    splits = []
+    Attributes:
+        path (str): Path to the original file
+        offset (int): Byte offset of the segment in the file
+        length (int): Segment length in bytes
+        name (str): Split name used for the encrypted file
+    """
+    
+    def __init__(self, path, offset, length, name):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.name = name
+    
+    def __repr__(self):
+        return f"SegmentRange({self.name!r}, offset={self.offset}, length={self.length})"
+    
+    def open(self):
+        """Returns a read-only file object over just this range"""
+        return RangeReader(self.path, self.offset, self.length)
+    
+    def read(self):
+        """Reads the whole range into memory"""
+        with self.open() as reader:
+            return reader.read()
 
-    temp_dir = os.path.join("output", "temp")
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+class RangeReader(io.RawIOBase):
+    """
+    Seekable reader over part of a file.
+    
+    Reads are positional (os.preadv / os.pread) on a descriptor owned by the
+    reader, so any number of ranges of one file can be read concurrently. On
+    platforms without positional reads the reader seeks its own descriptor.
+    """
+    
+    def __init__(self, path, offset, length):
+        super().__init__()
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        self._offset = offset
+        self._length = length
+        self._position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._position
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._length
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return self._position
+    
+    def readinto(self, buffer):
+        remaining = self._length - self._position
+        if remaining <= 0:
+            return 0
+        view = memoryview(buffer).cast("B")[:remaining]
+        position = self._offset + self._position
+        if hasattr(os, "preadv"):
+            count = os.preadv(self._fd, [view], position)
+        elif hasattr(os, "pread"):
+            data = os.pread(self._fd, len(view), position)
+            count = len(data)
+            view[:count] = data
+        else:
+            os.lseek(self._fd, position, os.SEEK_SET)
+            data = os.read(self._fd, len(view))
+            count = len(data)
+            view[:count] = data
+        self._position += count
+        return count
+    
+    def readall(self):
+        # One read for the rest of the range instead of RawIOBase's small blocks
+        data = bytearray(max(0, self._length - self._position))
+        view = memoryview(data)
+        total = 0
+        while total < len(data):
+            count = self.readinto(view[total:])
+            if not count:
+                break
+            total += count
+        view.release()
+        del data[total:]
+        return bytes(data)
+    
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
 
+#
+#   Splits a text file into line-aligned byte ranges
+#
+def split_text_file(filename, input_file, num_files):
+    """
+    Splits a text file into num_files parts of roughly equal byte size.
+    
+    Part n would end at byte (n + 1) * size / num_files; the cut is moved
+    forward to just after the next newline so no line is split. Only the
+    bytes between each target and the following newline are read. A part can
+    be empty when a single line spans several targets. The parts cover the
+    file exactly, so they join back into the original.
+    
+    Args:
+        filename (str): Original file name, used in the split names
+        input_file (str): Path to the text file
+        num_files (int): Number of parts
+        
+    Returns:
+        list: SegmentRange of each part, in order
+    """
+    file_size = os.path.getsize(input_file)
+    bounds = [0]
+    
+    with open(input_file, "rb") as f:
+        for file_num in range(num_files - 1):
+            target = (file_num + 1) * file_size // num_files
+            
+            # Cut after the first newline at or after the target, never before the last cut
+            position = max(target - 1, bounds[-1])
+            cut = file_size
+            f.seek(position)
+            while position < file_size:
+                block = f.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+                newline = block.find(b"\n")
+                if newline != -1:
+                    cut = position + newline + 1
+                    break
+                position += len(block)
+            bounds.append(cut)
+    bounds.append(file_size)
+    
+    splits = []
     for file_num in range(num_files):
-        # create new file name, which is appended with the current file number
-        new_output_file = os.path.join(temp_dir, f"split_{file_num}_{filename}")
-
-        # define start and end line number
-        start_line = file_num * size_of_new_file
-        end_line = ((file_num + 1) * size_of_new_file) - 1
+        start, end = bounds[file_num], bounds[file_num + 1]
+        print(f"File #{file_num} | Start: {start} | End: {end - 1}")
+        splits.append(SegmentRange(input_file, start, end - start, f"split_{file_num}_{filename}"))
+    return splits
 
-        print(f"File #{file_num} | Start: {start_line} | End: {end_line}")
+#
+#   Split binary file into chunks
+#
+def split_binary_file(file_path, num_splits):
+    """ Splits a binary file into multiple parts and returns a list of their byte ranges. """
+    file_size = os.path.getsize(file_path)
+    chunk_size = ceil(file_size / num_splits)
+    file_name = os.path.basename(file_path)
 
-        # open new output file for writing
-        with open(new_output_file, "w") as o:
-            with open(input_file, "r", encoding='utf-8', errors='ignore') as i:
-                for line_num, line in enumerate(i, start=0):
-                    # Write lines within the specified range
-                    if start_line <= line_num <= end_line:
-                        o.write(line)
+    splits = []
+    for i in range(num_splits):
+        offset = i * chunk_size
+        if offset >= file_size:
+            break  # Stop if there's no more data to read
 
-        # Append the output file path to the list of splits
-        splits.append(new_output_file)
+        length = min(chunk_size, file_size - offset)
+        splits.append(SegmentRange(file_path, offset, length, f"split_{i}_{file_name}"))
 
     return splits
 
 #
-#   Split binary file into chunks
+#   Finds the next content-defined cut point in a buffer (FastCDC gear hash)
 #
-def split_binary_file(file_path, num_splits):
-    """ Splits a binary file into multiple parts and returns a list of chunked filenames. """
-    ensure_output_dir()
+def find_cdc_cut(data, length, min_size, avg_size, max_size):
+    """
+    Returns the length of the next chunk at the start of data.
     
-    temp_dir = os.path.join("output", "temp")
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+    A rolling gear hash is computed from min_size onwards. A stricter mask is
+    used before avg_size and a looser one after it (FastCDC's normalized
+    chunking), which keeps chunk sizes close to avg_size. With numpy the hash
+    is computed a block at a time instead of byte by byte.
     
-    file_size = os.path.getsize(file_path)
-    chunk_size = ceil(file_size / num_splits)
-    file_name = os.path.basename(file_path)
+    Args:
+        data (bytes-like): Buffered file data
+        length (int): Number of valid bytes in data
+        min_size (int): Smallest chunk allowed
+        avg_size (int): Target average chunk size
+        max_size (int): Largest chunk allowed
+        
+    Returns:
+        int: Chunk length
+    """
+    if length <= min_size:
+        return length
+    
+    bits = max(1, avg_size.bit_length() - 1)
+    mask_small = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+    mask_large = ((1 << max(1, bits - 2)) - 1) << (64 - max(1, bits - 2))
+    
+    end = min(length, max_size)
+    normal = min(end, avg_size)
+    if NUMPY_AVAILABLE:
+        return _find_cdc_cut_numpy(data, min_size, normal, end, mask_small, mask_large)
+    
+    gear = CDC_GEAR
+    view = memoryview(data)
+    fingerprint = 0
+    
+    i = min_size
+    for byte in view[min_size:normal]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+        i += 1
+        if not fingerprint & mask_small:
+            return i
+    for byte in view[i:end]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+        i += 1
+        if not fingerprint & mask_large:
+            return i
+    return end
+
+def _find_cdc_cut_numpy(data, min_size, normal, end, mask_small, mask_large):
+    """
+    find_cdc_cut for whole blocks at a time.
+    
+    After n bytes the fingerprint is the sum of gear[data[i - k]] << k for
+    k < min(n, 64), since older bytes have been shifted out. Each block's
+    fingerprints are built from its gear values (plus the 63 bytes before it)
+    in six shift-and-add passes, each doubling the number of bytes summed.
+    """
+    array = numpy.frombuffer(data, dtype=numpy.uint8, count=end)
+    scratch = numpy.empty(CDC_SCAN_BLOCK_SIZE + 63, dtype=numpy.uint64)
+    
+    start = min_size
+    while start < end:
+        stop = min(start + CDC_SCAN_BLOCK_SIZE, end)
+        first = max(min_size, start - 63)
+        count = stop - first
+        fingerprints = CDC_GEAR_ARRAY.take(array[first:stop])
+        shift = 1
+        while shift < min(64, count):
+            shifted = scratch[:count - shift]
+            numpy.left_shift(fingerprints[:count - shift], shift, out=shifted)
+            fingerprints[shift:] += shifted
+            shift <<= 1
+        fingerprints = fingerprints[start - first:]
+        
+        masks = numpy.full(stop - start, mask_large, dtype=numpy.uint64)
+        if start < normal:
+            masks[:min(normal, stop) - start] = mask_small
+        cuts = numpy.flatnonzero((fingerprints & masks) == 0)
+        if cuts.size:
+            return start + int(cuts[0]) + 1
+        start = stop
+    return end
 
+#
+#   Split a file into content-defined chunks
+#
+def split_cdc_file(file_path, chunk_sizes=None):
+    """
+    Splits a file at content-defined boundaries instead of fixed offsets.
+    
+    Boundaries depend only on nearby bytes, so an insertion or deletion only
+    changes the chunks around it, and later versions of a file share most of
+    their chunks with earlier ones.
+    
+    Args:
+        file_path (str): Path to the original file
+        chunk_sizes (tuple, optional): (min, avg, max) chunk sizes in bytes,
+            CDC_CHUNK_SIZES by default
+        
+    Returns:
+        list: SegmentRange of each chunk, in order
+    """
+    min_size, avg_size, max_size = chunk_sizes or CDC_CHUNK_SIZES
+    if not 0 < min_size <= avg_size <= max_size:
+        raise ValueError("Chunk sizes must satisfy 0 < min <= avg <= max")
+    
+    file_name = os.path.basename(file_path)
     splits = []
+    offset = 0
+    buffer = bytearray()
+    eof = False
+    
     with open(file_path, "rb") as f:
-        for i in range(num_splits):
-            chunk_data = f.read(chunk_size)  # Read a chunk of bytes
-            if not chunk_data:
-                break  # Stop if there's no more data to read
+        while True:
+            # Keep at least one maximum-size chunk buffered
+            while not eof and len(buffer) < max_size:
+                block = f.read(max(COPY_BLOCK_SIZE, max_size - len(buffer)))
+                if not block:
+                    eof = True
+                else:
+                    buffer += block
+            if not buffer:
+                break
+            
+            cut = find_cdc_cut(buffer, len(buffer), min_size, avg_size, max_size)
+            splits.append(SegmentRange(file_path, offset, cut, f"split_{len(splits)}_{file_name}"))
+            
+            offset += cut
+            del buffer[:cut]
+    
+    # An empty file still becomes one (empty) segment
+    if not splits:
+        splits.append(SegmentRange(file_path, 0, 0, f"split_0_{file_name}"))
+    
+    return splits
 
-            chunk_filename = os.path.join(temp_dir, f"split_{i}_{file_name}")
-            with open(chunk_filename, "wb") as chunk_file:
-                chunk_file.write(chunk_data)  # Write chunk to new file
+#
+#   Path of the container for a segment: <file_id>_<index>.seg in the store,
+#   or in output_dir if given
+#
+def segment_output_path(file_id, segment_index, output_dir=None):
+    if output_dir:
+        return os.path.join(output_dir, f"{file_id}_{segment_index}.seg")
+    path = segment_store.segment_path(file_id, segment_index)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
 
-            splits.append(chunk_filename)
+#
+#   Writes a segment container: the metadata header followed by the ciphertext
+#
+def write_segment_container(path, metadata, ciphertext=b""):
+    container = segment_encryptor.container
+    with open(path, "wb") as f:
+        f.write(container.pack_header(metadata, len(ciphertext)))
+        f.write(ciphertext)
 
-    return splits
+#
+#   Reads a stored segment: a container, or a legacy .enc file with its .meta file
+#
+def load_segment(encrypted_path, metadata_path=None):
+    """
+    Reads a segment's metadata and finds its ciphertext.
+    
+    Containers hold their metadata in the header; a deduplicated segment's
+    container has no body and its ciphertext is the shared blob. Legacy
+    segments are an .enc file of ciphertext plus a JSON .meta file.
+    
+    Args:
+        encrypted_path (str): Path to the container or legacy .enc file
+        metadata_path (str, optional): The .meta file of a legacy segment
+        
+    Returns:
+        tuple: (metadata, data_path, data_offset), with metadata as from
+            deserialize_metadata and the ciphertext starting at data_offset
+            of data_path
+    """
+    if metadata_path:
+        with open(metadata_path, "r") as f:
+            metadata = segment_encryptor.metadata_handler.deserialize_metadata(f.read())
+        return metadata, encrypted_path, 0
+    
+    with open(encrypted_path, "rb") as f:
+        metadata, body_length = segment_encryptor.container.read_header(f)
+    if not body_length and "content_id" in metadata:
+        return metadata, dedup_blob_path(metadata["content_id"]), 0
+    return metadata, encrypted_path, segment_encryptor.container.HEADER_SIZE
+
+#
+#   Whether a segment entry's local files are all present
+#
+def segment_files_exist(segment_info):
+    encrypted_path = segment_info.get("encrypted_path")
+    metadata_path = segment_info.get("metadata_path")
+    return bool(encrypted_path) and os.path.exists(encrypted_path) and \
+        (not metadata_path or os.path.exists(metadata_path))
 
 #
 #   Encrypt a file segment and save metadata with clear file ID association
 #
-def encrypt_segment(segment_path, file_id, master_key, segment_index):
+def encrypt_segment(segment, file_id, master_key, segment_index, pending_key_info=None,
+                    compression=None, dedup=False, output_dir=None):
     """
     Encrypts a file segment using the SegmentEncryptor.
     
+    The segment is read straight from its range of the original file, which
+    must not change until encryption is done.
+    
     Args:
-        segment_path (str): Path to the segment file
+        segment (SegmentRange): Byte range of the original file to encrypt
         file_id (str): Unique ID for the original file
         master_key (bytes): The master encryption key
         segment_index (int): Index of this segment in the original file
+        pending_key_info (list, optional): If given, the segment's key info row is
+            not written immediately; its metadata is appended here so the caller
+            can record all segments in one transaction.
+        compression (str, optional): Codec to compress compressible segments with
+        dedup (bool): Share the encrypted data with identical segments of other files
+        output_dir (str, optional): Directory to write the segment container to
+            instead of the segment store
         
     Returns:
-        tuple: (encrypted_file_path, metadata_path)
+        str: Path of the segment container, or None on failure
     """
+    # Name the container with the file_id for easier matching
+    encrypted_path = segment_output_path(file_id, segment_index, output_dir)
+    
+    if dedup:
+        return encrypt_dedup_segment(
+            segment, encrypted_path, file_id, master_key,
+            segment_index, pending_key_info, compression
+        )
+    
+    # Large segments are streamed through in chunks instead of read whole
+    if segment.length > STREAM_SEGMENT_THRESHOLD:
+        container = segment_encryptor.container
+        try:
+            with segment.open() as reader, open(encrypted_path, "wb") as writer:
+                # The header is written once the tag, sizes and hash are known
+                writer.write(bytes(container.HEADER_SIZE))
+                metadata, _ = segment_encryptor.encrypt_file_segment_stream(
+                    file_id, master_key, reader, writer, segment_index,
+                    store_key_info=pending_key_info is None, compression=compression,
+                    hash_plaintext=True
+                )
+                body_length = writer.tell() - container.HEADER_SIZE
+                writer.seek(0)
+                writer.write(container.pack_header(metadata, body_length))
+        except Exception as e:
+            print(f"Encryption error: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+        
+        if pending_key_info is not None:
+            pending_key_info.append(metadata)
+        
+        print(f"Encrypted (streamed): {segment.name} -> {encrypted_path}")
+        return encrypted_path
+    
     # Read the segment data
-    segment_data = read_file_raw(segment_path)
-    if segment_data is None:
-        print(f"Error: Could not read segment {segment_path}")
-        return None, None
+    try:
+        segment_data = segment.read()
+    except OSError as e:
+        print(f"Error: Could not read segment {segment.name}: {e}")
+        return None
 
     # Print the first few bytes to verify we're reading binary data
     print(f"Debug: First 20 bytes of segment data: {segment_data[:20]}")
 
     # Encrypt the segment using our encryption module
     try:
-        ciphertext, metadata, serialized_metadata = segment_encryptor.encrypt_file_segment(
-            file_id, master_key, segment_data, segment_index
+        segment_hash = segment_encryptor.dedup_content_id(hashlib.sha256(segment_data).digest())
+        ciphertext, metadata, _ = segment_encryptor.encrypt_file_segment(
+            file_id, master_key, segment_data, segment_index,
+            store_key_info=pending_key_info is None, compression=compression,
+            segment_hash=segment_hash
         )
         
         # Print the first few bytes of ciphertext to verify encryption worked
@@ -234,57 +998,227 @@ def encrypt_segment(segment_path, file_id, master_key, segment_index):
         print(f"Encryption error: {e}")
         import traceback
         traceback.print_exc()
-        return None, None
+        return None
     
-    # Rename the segment files to include the file_id for easier matching
-    file_base = os.path.basename(segment_path)
-    encrypted_path = os.path.join("output", f"{file_id[:8]}_{file_base}_{segment_index}.enc")
+    # Save the metadata header and encrypted data as one file
+    write_segment_container(encrypted_path, metadata, ciphertext)
     
-    # Save encrypted data to file
-    with open(encrypted_path, "wb") as f:
-        f.write(ciphertext)
+    if pending_key_info is not None:
+        pending_key_info.append(metadata)
+    
+    print(f"Encrypted: {segment.name} -> {encrypted_path}")
+    return encrypted_path
+
+#
+#   Deduplicated segment storage
+#
+_dedup_locks = {}
+_dedup_locks_guard = threading.Lock()
+
+def dedup_lock(content_id):
+    """Lock serializing creation of the blob for one content ID"""
+    with _dedup_locks_guard:
+        return _dedup_locks.setdefault(content_id, threading.Lock())
+
+def dedup_blob_path(content_id):
+    return segment_store.blob_path(content_id)
+
+def remove_released_blobs(content_ids):
+    """Deletes the files of blobs release_dedup_blobs dropped from the index"""
+    for content_id in content_ids:
+        with dedup_lock(content_id):
+            # An upload may have stored the blob again since it was released
+            if segment_encryptor.key_manager.get_dedup_blob(content_id) is None:
+                blob_path = dedup_blob_path(content_id)
+                if os.path.exists(blob_path):
+                    os.remove(blob_path)
+
+def release_dedup_pins(content_ids):
+    """Drops the references encrypt_dedup_segment took for an upload that was not registered"""
+    remove_released_blobs(segment_encryptor.key_manager.release_dedup_blobs(content_ids))
+
+def hash_segment(segment):
+    digest = hashlib.sha256()
+    with segment.open() as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.digest()
+
+#
+#   Encrypt a segment through the dedup store, reusing an identical earlier segment
+#
+def encrypt_dedup_segment(segment, encrypted_path, file_id, master_key,
+                          segment_index, pending_key_info=None, compression=None):
+    """
+    Encrypts a segment into the shared dedup store, or reuses the blob of an
+    identical segment that is already there.
     
-    # Save metadata to file alongside the encrypted segment
-    metadata_path = encrypted_path.replace(".enc", ".meta")
-    with open(metadata_path, "w") as f:
-        f.write(serialized_metadata)
+    The blob lives in the store's blobs tree. The file's own container at
+    encrypted_path holds only the header, which names the blob.
     
-    print(f"Encrypted: {segment_path} -> {encrypted_path}")
-    return encrypted_path, metadata_path
+    A reference to the blob is taken straight away. When pending_key_info is
+    given, the caller drops it with release_dedup_blobs once the segment's row
+    is recorded (or with release_dedup_pins if the upload fails).
+    
+    Args:
+        segment (SegmentRange): Byte range of the original file to encrypt
+        encrypted_path (str): Per-file path for the segment container
+        file_id (str): Unique ID for the original file
+        master_key (bytes): The master encryption key
+        segment_index (int): Index of this segment in the original file
+        pending_key_info (list, optional): Collects metadata instead of writing
+            the key info row, as in encrypt_segment
+        compression (str, optional): Codec to compress new blobs with
+        
+    Returns:
+        str: Path of the segment container, or None on failure
+    """
+    pinned = False
+    try:
+        digest = hash_segment(segment)
+        content_id = segment_encryptor.dedup_content_id(digest)
+        blob_path = dedup_blob_path(content_id)
+        
+        with dedup_lock(content_id):
+            blob_info = segment_encryptor.key_manager.acquire_dedup_blob(content_id)
+            pinned = blob_info is not None
+            if blob_info is not None and os.path.exists(blob_path):
+                print(f"Reusing stored segment {content_id[:12]} for {segment.name}")
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                part_path = blob_path + ".part"
+                # A blob that is indexed but missing is recreated in its
+                # original format, so it matches the headers that refer to it
+                if blob_info is not None:
+                    streamed = blob_info["chunk_size"] is not None
+                else:
+                    streamed = segment.length > STREAM_SEGMENT_THRESHOLD
+                if streamed:
+                    with segment.open() as reader, open(part_path, "wb") as writer:
+                        blob_info = segment_encryptor.encrypt_dedup_blob_stream(
+                            digest, reader, writer, compression=compression
+                        )
+                else:
+                    segment_data = segment.read()
+                    sealed, blob_info = segment_encryptor.encrypt_dedup_blob(
+                        digest, segment_data, compression=compression
+                    )
+                    with open(part_path, "wb") as f:
+                        f.write(sealed)
+                os.replace(part_path, blob_path)
+                if not pinned:
+                    blob_info = segment_encryptor.key_manager.acquire_dedup_blob(content_id)
+                    pinned = True
+        
+        metadata, _ = segment_encryptor.reference_dedup_blob(
+            file_id, master_key, segment_index, digest, blob_info,
+            store_key_info=pending_key_info is None
+        )
+        write_segment_container(encrypted_path, metadata)
+        if pending_key_info is None:
+            # The key info row holds its own reference now
+            release_dedup_pins([content_id])
+    except Exception as e:
+        if pinned:
+            release_dedup_pins([content_id])
+        print(f"Encryption error: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+    
+    if pending_key_info is not None:
+        pending_key_info.append(metadata)
+    
+    print(f"Encrypted (dedup): {segment.name} -> {encrypted_path}")
+    return encrypted_path
+
+#
+#   Finds cloud copies of a deduplicated segment uploaded for any file
+#
+def find_dedup_cloud_locations(content_id):
+    """
+    Returns the (cloud_service, remote_id) pairs already holding a dedup blob.
+    
+    Args:
+        content_id (str): Content ID of the blob
+        
+    Returns:
+        list: Distinct (cloud_service, remote_id) tuples
+    """
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT DISTINCT c.cloud_service, c.remote_id
+        FROM segment_cloud_locations c
+        JOIN segment_keys_info s ON c.segment_id = s.segment_id
+        WHERE s.content_id = ?
+    """, (content_id,))
+    return [(row["cloud_service"], row["remote_id"]) for row in cursor.fetchall()]
 
 #
 #   Decrypts a file segment using stored metadata
 #
-def decrypt_segment(encrypted_path, metadata_path, password=None, master_key=None):
+def decrypt_segment(encrypted_path, metadata_path=None, password=None, master_key=None):
     """
     Decrypts a file segment using the SegmentEncryptor.
     
     Args:
-        encrypted_path (str): Path to the encrypted segment file
-        metadata_path (str): Path to the metadata file
+        encrypted_path (str): Path to the segment container (or legacy .enc file)
+        metadata_path (str, optional): Path to the .meta file of a legacy segment
         password (str, optional): Password for decryption
         master_key (bytes, optional): Master key for decryption
         
     Returns:
         str: Path to the decrypted segment file
     """
-    # Read the encrypted data and metadata
-    encrypted_data = read_file_raw(encrypted_path)
-    if encrypted_data is None:
-        print(f"Error: Could not read encrypted file {encrypted_path}")
-        return None
-    
     try:
-        with open(metadata_path, "r") as f:
-            serialized_metadata = f.read()
+        metadata, data_path, data_offset = load_segment(encrypted_path, metadata_path)
     except Exception as e:
         print(f"Error reading metadata file: {e}")
         return None
     
+    # Save decrypted data to file - create a decrypted path based on the encrypted path
+    # For the naming format (fileid_originalname_segmentindex.seg)
+    basename = os.path.basename(encrypted_path)
+    # Remove the file ID prefix and keep only the original part
+    if '_' in basename:
+        original_part = '_'.join(basename.split('_')[1:])
+    else:
+        original_part = basename
+        
+    # Create decrypted path
+    decrypted_path = os.path.join(os.path.dirname(encrypted_path), f"dec_{os.path.splitext(original_part)[0]}")
+    
+    # Streamed segments are decrypted chunk by chunk straight to disk
+    if "chunk_size" in metadata:
+        try:
+            with open(data_path, "rb") as reader, open(decrypted_path, "wb") as writer:
+                reader.seek(data_offset)
+                segment_encryptor.decrypt_file_segment_stream(
+                    reader, writer, metadata, password=password, master_key=master_key
+                )
+        except Exception as e:
+            print(f"Decryption error: {e}")
+            # Never leave partially authenticated plaintext behind
+            if os.path.exists(decrypted_path):
+                os.remove(decrypted_path)
+            return None
+        
+        print(f"Decrypted (streamed): {encrypted_path} -> {decrypted_path}")
+        return decrypted_path
+    
+    # Read the encrypted data
+    try:
+        with open(data_path, "rb") as f:
+            f.seek(data_offset)
+            encrypted_data = f.read()
+    except OSError as e:
+        print(f"Error: Could not read encrypted file {data_path}: {e}")
+        return None
+    
     # Decrypt the segment using our encryption module
     try:
         decrypted_data = segment_encryptor.decrypt_file_segment(
-            encrypted_data, serialized_metadata, password=password, master_key=master_key
+            encrypted_data, metadata, password=password, master_key=master_key
         )
     except ValueError as e:
         print(f"Decryption error: {e}")
@@ -295,18 +1229,6 @@ def decrypt_segment(encrypted_path, metadata_path, password=None, master_key=Non
         traceback.print_exc()
         return None
     
-    # Save decrypted data to file - create a decrypted path based on the encrypted path
-    # For the new naming format (fileid_originalname_segmentindex.enc)
-    basename = os.path.basename(encrypted_path)
-    # Remove the file ID prefix and keep only the original part
-    if '_' in basename:
-        original_part = '_'.join(basename.split('_')[1:])
-    else:
-        original_part = basename
-        
-    # Create decrypted path
-    decrypted_path = os.path.join(os.path.dirname(encrypted_path), f"dec_{original_part.replace('.enc', '')}")
-    
     try:
         with open(decrypted_path, "wb") as f:
             f.write(decrypted_data)
@@ -317,59 +1239,150 @@ def decrypt_segment(encrypted_path, metadata_path, password=None, master_key=Non
         print(f"Error writing decrypted file: {e}")
         return None
 
+#
+#   Limits the memory held by segments being encrypted in parallel
+#
+class MemoryBudget:
+    """Blocks callers until the requested number of bytes fits under the limit"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = threading.Condition()
+    
+    def acquire(self, amount):
+        """Reserve amount bytes (capped at the limit) and return the reservation"""
+        amount = min(amount, self.limit)
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_use + amount <= self.limit)
+            self.in_use += amount
+        return amount
+    
+    def release(self, amount):
+        """Return a reservation made by acquire"""
+        with self._condition:
+            self.in_use -= amount
+            self._condition.notify_all()
+
+#
+#   Estimates the peak memory needed to process a segment of the given size
+#
+def segment_memory_cost(size):
+    # Streamed segments only hold a few chunk buffers; whole segments hold
+    # the plaintext and the ciphertext at once
+    if size > STREAM_SEGMENT_THRESHOLD:
+        return 3 * segment_encryptor.encryption_engine.STREAM_CHUNK_SIZE
+    return 2 * size
+
+#
+#   Encrypts segments on a thread pool under a memory budget
+#
+def encrypt_segments_parallel(jobs, file_id, master_key, pending_key_info, workers=None,
+                              memory_budget=None, compression=None, dedup=False,
+                              output_dir=None):
+    """
+    Encrypts segments in parallel with encrypt_segment.
+    
+    Jobs are submitted in order and only once the segment fits in the memory
+    budget (the AEAD and file I/O release the GIL).
+    
+    Args:
+        jobs (list): (SegmentRange, segment_index) pairs
+        file_id (str): Unique ID for the original file
+        master_key (bytes): The master encryption key
+        pending_key_info (list): Collects the metadata of each encrypted segment
+        workers (int, optional): Encryption threads, ENCRYPT_WORKERS by default
+        memory_budget (int, optional): Max bytes held by in-flight segments,
+            ENCRYPT_MEMORY_BUDGET by default
+        compression (str, optional): Codec to compress compressible segments with
+        dedup (bool): Share the encrypted data with identical segments of other files
+        output_dir (str, optional): Directory to write the encrypted segments to
+            instead of the segment store
+        
+    Returns:
+        list: Segment container path (None on failure) per job, in job order
+    """
+    budget = MemoryBudget(memory_budget or ENCRYPT_MEMORY_BUDGET)
+    
+    def encrypt_with_budget(segment, idx, reserved):
+        try:
+            return encrypt_segment(
+                segment, file_id, master_key, idx, pending_key_info, compression, dedup,
+                output_dir
+            )
+        finally:
+            budget.release(reserved)
+    
+    with ThreadPoolExecutor(max_workers=workers or ENCRYPT_WORKERS) as executor:
+        futures = []
+        for segment, idx in jobs:
+            reserved = budget.acquire(segment_memory_cost(segment.length))
+            futures.append(executor.submit(encrypt_with_budget, segment, idx, reserved))
+        return [future.result() for future in futures]
+
+#
+#   Drops the key profile of a file that was never registered in the catalog
+#
+def discard_file_key(file_id):
+    segment_encryptor.lock_master_key(file_id)
+    with db.transaction() as cursor:
+        cursor.execute("DELETE FROM master_keys WHERE file_id = ?", (file_id,))
+
+#
+#   Drops the key profile set up in the background unless its file was registered
+#
+def discard_unregistered_key(key_future):
+    try:
+        file_id, _ = key_future.result()
+    except Exception:
+        return  # No key profile was created
+    
+    cursor = db.cursor()
+    cursor.execute("SELECT 1 FROM master_files WHERE file_id = ?", (file_id,))
+    if cursor.fetchone() is None:
+        discard_file_key(file_id)
+
 #
 #   Process of encrypting all segments of a file
 #
-def encrypt_file_segments(segments, file_password, original_filename, upload_to_cloud=False):
+def encrypt_file_segments(segments, file_password, original_filename, upload_to_cloud=False,
+                          key_future=None, workers=None, memory_budget=None, compression=None,
+                          dedup=False):
     """
     Encrypts all segments of a file and returns data needed for later decryption.
     
+    Segments are encrypted on a thread pool (the AEAD and file I/O release the
+    GIL). Output names, segment order and catalog rows are the same as a serial
+    run.
+    
     Args:
-        segments (list): List of segment file paths
+        segments (list): SegmentRange of each segment, in order
         file_password (str): Password for encryption
         original_filename (str): Original file name for metadata
         upload_to_cloud (bool): Whether to upload segments to cloud services
+        key_future (Future, optional): Pending setup_encryption_async result to
+            use instead of deriving the master key here
+        workers (int, optional): Encryption threads, ENCRYPT_WORKERS by default
+        memory_budget (int, optional): Max bytes held by in-flight segments,
+            ENCRYPT_MEMORY_BUDGET by default
+        compression (str, optional): Codec ("zlib", "lzma" or "zstd") to compress
+            segments with before encryption; incompressible segments are left as-is
+        dedup (bool): Reuse the stored (and uploaded) copy of segments that
+            match a segment of another file
         
     Returns:
-        tuple: (file_id, encrypted_segments, master_key)
+        tuple: (file_id, encrypted_segments, master_key), or (None, None, None)
+            if a segment could not be encrypted
     """
-    # Set up encryption for the file (generate file_id and master key)
-    file_id, master_key = segment_encryptor.setup_encryption(file_password)
+    # Set up encryption for the file (generate file_id and master key).
+    # If derivation was started in the background, wait for it here, before
+    # the first segment is encrypted.
+    if key_future is not None:
+        file_id, master_key = key_future.result()
+    else:
+        file_id, master_key = segment_encryptor.setup_encryption(file_password)
     print(f"Created encryption profile for file with ID: {file_id}")
     
-    # Store additional metadata about the original file in the database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Create master_files table if it doesn't exist
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS master_files (
-        file_id TEXT PRIMARY KEY,
-        original_filename TEXT NOT NULL,
-        segment_count INTEGER NOT NULL,
-        creation_date TEXT NOT NULL
-    )
-    ''')
-    
-    # Create table for cloud storage locations if it doesn't exist
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS segment_cloud_locations (
-        segment_id TEXT PRIMARY KEY,
-        cloud_service TEXT NOT NULL,
-        remote_id TEXT NOT NULL,
-        upload_date TEXT NOT NULL,
-        FOREIGN KEY (segment_id) REFERENCES segment_keys_info(segment_id)
-    )
-    ''')
-    
-    # Insert file info
-    cursor.execute(
-        "INSERT INTO master_files (file_id, original_filename, segment_count, creation_date) VALUES (?, ?, ?, datetime('now'))",
-        (file_id, original_filename, len(segments))
-    )
-    conn.commit()
-    conn.close()
-    
     # Initialize cloud services if needed
     cloud_services = []
     if upload_to_cloud:
@@ -383,56 +1396,102 @@ def encrypt_file_segments(segments, file_password, original_filename, upload_to_
     
     encrypted_segments = []
     
-    # Encrypt each segment
-    for idx, segment_path in enumerate(segments):
-        # Ensure the output directory exists
-        if not os.path.exists("output"):
-            os.makedirs("output")
-            
-        encrypted_path, metadata_path = encrypt_segment(segment_path, file_id, master_key, idx)
-        
+    # Catalog rows are collected here and written in a single transaction at the end
+    pending_key_info = []
+    cloud_location_rows = []
+    
+    # Derive all segment keys in one batch before encrypting
+    segment_encryptor.prepare_segment_keys(file_id, master_key, range(len(segments)))
+    
+    # Ensure the output directory exists
+    if not os.path.exists("output"):
+        os.makedirs("output")
+    
+    encryption_results = encrypt_segments_parallel(
+        [(segment, idx) for idx, segment in enumerate(segments)],
+        file_id, master_key, pending_key_info, workers, memory_budget, compression, dedup
+    )
+    
+    # References encrypt_dedup_segment took on the shared blobs
+    dedup_pins = [metadata["content_id"] for metadata in pending_key_info if "content_id" in metadata]
+    
+    # Register nothing unless every segment was encrypted
+    if any(encrypted_path is None for encrypted_path in encryption_results):
+        print("Error: Not all segments could be encrypted. The file was not stored.")
+        for idx in range(len(segments)):
+            encrypted_path = segment_output_path(file_id, idx)
+            if os.path.exists(encrypted_path):
+                os.remove(encrypted_path)
+        release_dedup_pins(dedup_pins)
+        discard_file_key(file_id)
+        return None, None, None
+    
+    # Workers finish in any order; keep the catalog rows in segment order
+    pending_key_info.sort(key=lambda metadata: metadata["segment_index"])
+    content_ids = {
+        metadata["segment_index"]: metadata["content_id"]
+        for metadata in pending_key_info if "content_id" in metadata
+    }
+    
+    # Cloud copies of dedup blobs uploaded during this run
+    uploaded_blobs = {}
+    
+    # Upload and collect results in segment order
+    for idx, encrypted_path in enumerate(encryption_results):
         segment_info = {
             "encrypted_path": encrypted_path,
-            "metadata_path": metadata_path,
+            "metadata_path": None,
             "segment_index": idx,
             "cloud_locations": []
         }
         
+        content_id = content_ids.get(idx)
+        if content_id:
+            segment_info["content_id"] = content_id
+        
+        # A dedup blob already in the cloud is referenced rather than uploaded again
+        if upload_to_cloud and content_id:
+            service_names = {service.service_name for service in cloud_services}
+            reused = [
+                (service_name, remote_id)
+                for service_name, remote_id in
+                uploaded_blobs.get(content_id) or find_dedup_cloud_locations(content_id)
+                if service_name in service_names
+            ]
+            if reused:
+                service_name, remote_id = reused[0]
+                cloud_location_rows.append((f"{file_id}_{idx}", service_name, remote_id))
+                segment_info["cloud_locations"].append({
+                    "service": service_name,
+                    "remote_id": remote_id
+                })
+                print(f"Segment {idx} already stored on {service_name}, skipping upload.")
+        
         # Upload to cloud if requested
-        if upload_to_cloud and cloud_services and encrypted_path:
-            # Get the encrypted data
-            with open(encrypted_path, "rb") as f:
+        if upload_to_cloud and cloud_services and encrypted_path and \
+           not segment_info["cloud_locations"]:
+            # Get the container (a dedup segment's data is its shared blob)
+            with open(dedup_blob_path(content_id) if content_id else encrypted_path, "rb") as f:
                 encrypted_data = f.read()
             
             # Choose a cloud service (round-robin)
             service = cloud_services[idx % len(cloud_services)]
             
-            # Generate a remote path
-            remote_path = f"{file_id}_{idx}.enc"
+            # Generate a remote path (shared blobs are named by content)
+            remote_path = f"{content_id}.enc" if content_id else f"{file_id}_{idx}.seg"
             
             # Upload the segment
             print(f"Uploading segment {idx} to {service.service_name}...")
             remote_id = service.upload_segment(encrypted_data, remote_path)
             
             if remote_id:
-                # Store cloud location in database
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                
                 # Generate segment_id that matches what's in segment_keys_info
                 segment_id = f"{file_id}_{idx}"
                 
-                cursor.execute(
-                    """
-                    INSERT INTO segment_cloud_locations (
-                        segment_id, cloud_service, remote_id, upload_date
-                    ) VALUES (?, ?, ?, datetime('now'))
-                    """, 
-                    (segment_id, service.service_name, remote_id)
-                )
-                
-                conn.commit()
-                conn.close()
+                # Queue cloud location for the database
+                cloud_location_rows.append((segment_id, service.service_name, remote_id))
+                if content_id:
+                    uploaded_blobs[content_id] = [(service.service_name, remote_id)]
                 
                 # Add to the segment info
                 segment_info["cloud_locations"].append({
@@ -447,8 +1506,31 @@ def encrypt_file_segments(segments, file_password, original_filename, upload_to_
             # Verify the encrypted file exists
             if not os.path.exists(encrypted_path):
                 print(f"WARNING: Expected encrypted file {encrypted_path} was not created!")
-            if not os.path.exists(metadata_path):
-                print(f"WARNING: Expected metadata file {metadata_path} was not created!")
+    
+    # Register the file, all segment keys and cloud locations with one commit
+    with db.transaction() as cursor:
+        # Insert file info
+        cursor.execute(
+            "INSERT INTO master_files (file_id, original_filename, segment_count, creation_date) VALUES (?, ?, ?, datetime('now'))",
+            (file_id, original_filename, len(segments))
+        )
+        
+        segment_encryptor.record_segment_key_infos(pending_key_info)
+        # The segment rows now hold the blob references
+        segment_encryptor.key_manager.release_dedup_blobs(dedup_pins)
+        
+        cursor.executemany(
+            """
+            INSERT INTO segment_cloud_locations (
+                segment_id, cloud_service, remote_id, upload_date
+            ) VALUES (?, ?, ?, datetime('now'))
+            """, 
+            cloud_location_rows
+        )
+        
+        record_local_segments(file_id, encrypted_segments)
+    
+    save_file_manifest(file_id, encrypted_segments)
     
     print(f"All {len(encrypted_segments)} segments encrypted successfully")
     
@@ -465,23 +1547,237 @@ def encrypt_file_segments(segments, file_password, original_filename, upload_to_
                 # This is expected for properly encrypted data
                 print("Encryption verified: Files contain non-plaintext data.")
     
-    # Clean up temporary segment files
-    for segment_path in segments:
-        if os.path.exists(segment_path):
+    return file_id, encrypted_segments, master_key
+
+#
+#   Finds a file's segments in a directory by reading each segment's metadata
+#
+def find_segments_by_metadata(file_id, output_dir=None):
+    """
+    Scans output_dir for containers and legacy .enc/.meta pairs belonging to file_id.
+    
+    Args:
+        file_id (str): The file ID to look for
+        output_dir (str, optional): Directory to scan, by default the file's
+            directory in the segment store
+        
+    Returns:
+        list: Segment entries ("encrypted_path", "metadata_path", "segment_index")
+    """
+    return [
+        {"encrypted_path": enc_path, "metadata_path": meta_path, "segment_index": segment_index}
+        for owner, segment_index, enc_path, meta_path in
+        scan_segment_files(output_dir or segment_store.shard_dir(file_id))
+        if owner == file_id
+    ]
+
+#
+#   Looks up segments in the local path index, checking each file's stat
+#
+def indexed_local_segments(file_id=None, segment_id=None):
+    """
+    Returns the indexed local files of a file's segments (or of one segment).
+    
+    A row is trusted while its file has the recorded size and modification
+    time. A changed file is kept if its header still names the segment, and
+    rows of missing or replaced files are dropped.
+    
+    Args:
+        file_id (str, optional): File whose segments to look up
+        segment_id (str, optional): Single segment to look up instead
+        
+    Returns:
+        dict: segment_index -> segment entry ("encrypted_path", "metadata_path",
+            "segment_index") for each segment whose files are in place
+    """
+    cursor = db.cursor()
+    if segment_id is not None:
+        cursor.execute("SELECT * FROM segment_local_paths WHERE segment_id = ?", (segment_id,))
+    else:
+        cursor.execute(
+            "SELECT * FROM segment_local_paths WHERE file_id = ? ORDER BY segment_index", (file_id,)
+        )
+    
+    segments = {}
+    stale = []
+    refreshed = []
+    for row in cursor.fetchall():
+        segment_info = {
+            "encrypted_path": row["encrypted_path"],
+            "metadata_path": row["metadata_path"],
+            "segment_index": row["segment_index"]
+        }
+        try:
+            stat = os.stat(row["encrypted_path"])
+        except OSError:
+            stale.append(row["segment_id"])
+            continue
+        if row["metadata_path"] and not os.path.exists(row["metadata_path"]):
+            stale.append(row["segment_id"])
+            continue
+        
+        if stat.st_size != row["size"] or stat.st_mtime_ns != row["mtime_ns"]:
+            # Rewritten since it was indexed: check it is still the same segment
             try:
-                os.remove(segment_path)
-            except Exception as e:
-                print(f"Warning: Could not remove temporary segment file {segment_path}: {e}")
+                if row["metadata_path"]:
+                    with open(row["metadata_path"], "rb") as f:
+                        identity = segment_encryptor.metadata_handler.read_identity(f.read())
+                else:
+                    with open(row["encrypted_path"], "rb") as f:
+                        identity = segment_encryptor.container.read_identity(f)
+            except Exception:
+                identity = None
+            if identity != (row["file_id"], row["segment_index"]):
+                stale.append(row["segment_id"])
+                continue
+            refreshed.append((stat.st_size, stat.st_mtime_ns, row["segment_id"]))
+        
+        segments[row["segment_index"]] = segment_info
     
-    # Also try to remove the temp directory if it's empty
-    temp_dir = os.path.join("output", "temp")
-    if os.path.exists(temp_dir):
-        try:
-            os.rmdir(temp_dir)
-        except:
-            pass  # Ignore if directory is not empty or can't be removed
+    if stale or refreshed:
+        with db.transaction() as cursor:
+            cursor.executemany("DELETE FROM segment_local_paths WHERE segment_id = ?",
+                               [(stale_id,) for stale_id in stale])
+            cursor.executemany("UPDATE segment_local_paths SET size = ?, mtime_ns = ? WHERE segment_id = ?",
+                               refreshed)
+    return segments
+
+#
+#   Writes a file's manifest and optionally uploads it next to the segments
+#
+def save_file_manifest(file_id, segments_info, upload_to_cloud=False):
+    """
+    Records the order, sizes, plaintext offsets, hashes and locations of a
+    file's segments, so they can be found from one small read.
     
-    return file_id, encrypted_segments, master_key
+    Args:
+        file_id (str): ID of the file
+        segments_info (list): Entry of every stored segment ("encrypted_path",
+            "metadata_path", "segment_index")
+        upload_to_cloud (bool): Also upload the manifest to Dropbox
+        
+    Returns:
+        dict: The manifest, or None if it could not be written
+    """
+    path = segment_store.manifest_path(file_id)
+    try:
+        cursor = db.cursor()
+        cursor.execute(
+            "SELECT original_filename, segment_count, generation FROM master_files WHERE file_id = ?",
+            (file_id,)
+        )
+        file_row = cursor.fetchone()
+        if not file_row:
+            print(f"No file found with ID: {file_id}")
+            return None
+        
+        cursor.execute("""
+            SELECT c.segment_id, c.cloud_service, c.remote_id
+            FROM segment_cloud_locations c
+            JOIN segment_keys_info s ON c.segment_id = s.segment_id
+            WHERE s.file_id = ?
+        """, (file_id,))
+        cloud_locations = {}
+        for row in cursor.fetchall():
+            cloud_locations.setdefault(row["segment_id"], []).append({
+                "service": row["cloud_service"],
+                "remote_id": row["remote_id"]
+            })
+        
+        entries = []
+        offset = 0
+        for segment_info in sorted(segments_info, key=lambda x: x["segment_index"]):
+            segment_index = segment_info["segment_index"]
+            segment_id = f"{file_id}_{segment_index}"
+            size, (metadata, data_path, data_offset) = segment_plaintext_size(
+                segment_info["encrypted_path"], segment_info.get("metadata_path")
+            )
+            entry = {
+                "segment_index": segment_index,
+                "segment_id": segment_id,
+                "name": os.path.basename(segment_info["encrypted_path"]),
+                "offset": offset,
+                "size": size,
+                "stored_size": os.path.getsize(data_path) - data_offset,
+                "segment_hash": metadata.get("segment_hash"),
+                "locations": cloud_locations.get(segment_id, [])
+            }
+            if segment_info.get("metadata_path"):
+                entry["metadata_name"] = os.path.basename(segment_info["metadata_path"])
+            if "content_id" in metadata:
+                entry["content_id"] = metadata["content_id"]
+            entries.append(entry)
+            offset += size
+        
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "file_id": file_id,
+            "original_filename": file_row["original_filename"],
+            "generation": file_row["generation"],
+            "segment_count": file_row["segment_count"],
+            "file_size": offset,
+            "segments": entries
+        }
+        
+        # Replace the old manifest in one step so readers never see half of it
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Error writing manifest for file ID {file_id}: {e}")
+        return None
+    
+    if upload_to_cloud:
+        upload_result = upload_file(path)
+        if upload_result["success"]:
+            print(f"✅ Uploaded manifest: {path} -> {upload_result['remote_path']}")
+    return manifest
+
+#
+#   Reads a file's manifest
+#
+def load_file_manifest(file_id):
+    """
+    Returns:
+        dict: The manifest written by save_file_manifest, or None if the file
+            has none (e.g. it was uploaded before manifests existed)
+    """
+    path = segment_store.manifest_path(file_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading manifest {path}: {e}")
+        return None
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("file_id") != file_id:
+        print(f"Ignoring manifest {path}: unsupported version or wrong file")
+        return None
+    return manifest
+
+#
+#   Segment entries of a manifest, in the form get_file_segments returns
+#
+def manifest_segments(manifest):
+    file_id = manifest["file_id"]
+    segments = []
+    for entry in manifest["segments"]:
+        segment_info = {
+            "encrypted_path": segment_store.file_path(file_id, entry["name"]),
+            "metadata_path": segment_store.file_path(file_id, entry["metadata_name"])
+                             if "metadata_name" in entry else None,
+            "segment_index": entry["segment_index"],
+            "segment_id": entry["segment_id"],
+            "offset": entry["offset"],
+            "size": entry["size"],
+            "cloud_locations": entry["locations"]
+        }
+        if "content_id" in entry:
+            segment_info["content_id"] = entry["content_id"]
+        segments.append(segment_info)
+    return segments
 
 #
 #   Get all segments for a file from the database
@@ -497,9 +1793,7 @@ def get_file_segments(file_id):
         list: List of segment info dictionaries sorted by index
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Get the file info
         cursor.execute("SELECT * FROM master_files WHERE file_id = ?", (file_id,))
@@ -507,7 +1801,6 @@ def get_file_segments(file_id):
         
         if not file_info:
             print(f"No file found with ID: {file_id}")
-            conn.close()
             return None, None
         
         # Get all segments for this file from the segment_keys_info table
@@ -518,86 +1811,36 @@ def get_file_segments(file_id):
         """, (file_id,))
         
         segment_rows = cursor.fetchall()
-        conn.close()
         
         if not segment_rows:
             print(f"No segments found for file ID: {file_id}")
             return None, file_info
         
-        # Look for segment files using file_id as part of the filename
-        output_dir = "output"
-        segments = []
+        segment_count = file_info["segment_count"]
         
-        # First try to find segments by their filename pattern with file_id
-        file_id_prefix = file_id[:8]  # Use first 8 chars of file_id as prefix
-        segment_count = int(file_info['segment_count']) if file_info and 'segment_count' in file_info else 0
+        # Local copies recorded in the segment index
+        local_segments = indexed_local_segments(file_id)
+        if len(local_segments) == segment_count:
+            print(f"Found all {segment_count} segments for file ID: {file_id}")
+            return [local_segments[idx] for idx in sorted(local_segments)], file_info
         
-        print(f"Looking for segments with prefix '{file_id_prefix}' for file ID: {file_id}")
+        # The manifest of the current version lists every segment. Entries
+        # whose files are gone are still returned so they can be fetched from
+        # their cloud locations, even if no segment is stored locally.
+        manifest = load_file_manifest(file_id)
+        if manifest and manifest["generation"] == file_info["generation"] and \
+           len(manifest["segments"]) == segment_count:
+            segments = manifest_segments(manifest)
+            if any(segment_files_exist(segment) or segment["cloud_locations"] for segment in segments):
+                print(f"Found {len(segments)} segments in the manifest of file ID: {file_id}")
+                return segments, file_info
         
-        # Look for files with the file_id prefix
-        if os.path.exists(output_dir):
-            for filename in os.listdir(output_dir):
-                if filename.startswith(file_id_prefix) and filename.endswith(".enc"):
-                    enc_path = os.path.join(output_dir, filename)
-                    meta_path = enc_path.replace(".enc", ".meta")
-                    
-                    if os.path.exists(meta_path):
-                        # Get the segment index from the filename
-                        try:
-                            # Extract segment index from filename
-                            segment_index = int(filename.split("_")[-1].replace(".enc", ""))
-                            
-                            segments.append({
-                                "encrypted_path": enc_path,
-                                "metadata_path": meta_path,
-                                "segment_index": segment_index
-                            })
-                            print(f"Found segment {segment_index} file: {filename}")
-                        except (ValueError, IndexError):
-                            print(f"Couldn't determine segment index from filename: {filename}")
-        
-        # If we found enough segments, return them
-        if len(segments) == segment_count:
-            print(f"Found all {segment_count} segments for file ID: {file_id}")
-            segments.sort(key=lambda x: x["segment_index"])
-            return segments, file_info
+        if local_segments:
+            print(f"Found {len(local_segments)} of {segment_count} segments for file ID: {file_id}")
+            return [local_segments[idx] for idx in sorted(local_segments)], file_info
         
-        # If not all segments were found, try reading metadata from all files
-        if len(segments) < segment_count:
-            print(f"Only found {len(segments)} out of {segment_count} segments. Trying metadata search...")
-            
-            # Clear the segments list to avoid duplicates
-            segments = []
-            
-            for filename in os.listdir(output_dir):
-                if filename.endswith(".meta"):
-                    meta_path = os.path.join(output_dir, filename)
-                    enc_path = meta_path.replace(".meta", ".enc")
-                    
-                    if os.path.exists(enc_path):
-                        try:
-                            with open(meta_path, "r") as f:
-                                metadata = json.loads(f.read())
-                                if metadata.get("file_id") == file_id:
-                                    segment_index = metadata.get("segment_index", 0)
-                                    segments.append({
-                                        "encrypted_path": enc_path,
-                                        "metadata_path": meta_path,
-                                        "segment_index": segment_index
-                                    })
-                                    print(f"Found segment {segment_index} via metadata")
-                        except Exception as e:
-                            print(f"Error reading metadata from {meta_path}: {e}")
-        
-        # Sort by segment index to ensure correct order
-        segments.sort(key=lambda x: x["segment_index"])
-        
-        if segments:
-            print(f"Found {len(segments)} segments for file ID: {file_id}")
-            return segments, file_info
-        else:
-            print(f"Could not find any segments for file ID: {file_id}")
-            return None, file_info
+        print(f"Could not find any segments for file ID: {file_id}")
+        return None, file_info
     
     except Exception as e:
         print(f"Error retrieving segments: {e}")
@@ -617,9 +1860,7 @@ def list_encrypted_files():
         list: List of file info dictionaries
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         cursor.execute("""
             SELECT file_id, original_filename, segment_count, creation_date 
@@ -628,7 +1869,6 @@ def list_encrypted_files():
         """)
         
         all_files = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         
         # If there are no files, return empty list
         if not all_files:
@@ -659,13 +1899,25 @@ def list_encrypted_files():
 # 
 #   Download all segments from dropbox
 #
-from dropbox_helper import list_files, download_and_delete_file
-
 def download_all_segments_from_dropbox(file_id):
     """
     Pulls all encrypted segments and metadata files from Dropbox for a given file_id.
+    
+    The file's manifest names every object to fetch. Files uploaded before
+    manifests existed are found by listing Dropbox instead.
     """
     print(f"🔄 Attempting to download segments for File ID: {file_id} from Dropbox...")
+    
+    # Everything of the file goes to its directory in the segment store
+    os.makedirs(segment_store.shard_dir(file_id), exist_ok=True)
+    
+    local_manifest = segment_store.manifest_path(file_id)
+    print(f"⏳ Downloading {os.path.basename(local_manifest)}...")
+    # The manifest stays in Dropbox so later restores can find the segments
+    download_file(os.path.basename(local_manifest), local_manifest)
+    manifest = load_file_manifest(file_id)
+    if manifest:
+        return record_downloaded_segments(file_id, download_manifest_segments(manifest))
 
     # Get list of all files currently in Dropbox
     dropbox_files = list_files()
@@ -681,7 +1933,10 @@ def download_all_segments_from_dropbox(file_id):
     # Match files that contain the prefix in their name
     files_to_download = []
     for file in dropbox_files:
-        if file_id_prefix in file.name and file.name.endswith('.enc'):
+        if file_id_prefix in file.name and file.name.endswith('.seg'):
+            files_to_download.append(file.name)
+            print(f"Found matching segment: {file.name}")
+        elif file_id_prefix in file.name and file.name.endswith('.enc'):
             files_to_download.append(file.name)
             print(f"Found matching file: {file.name}")
             
@@ -691,6 +1946,13 @@ def download_all_segments_from_dropbox(file_id):
                 if meta_file.name == meta_filename:
                     files_to_download.append(meta_filename)
                     print(f"Found matching metadata: {meta_filename}")
+    
+    # Deduplicated segments only have their metadata under this file's name
+    for file in dropbox_files:
+        if file_id_prefix in file.name and file.name.endswith('.meta') and \
+           file.name not in files_to_download:
+            files_to_download.append(file.name)
+            print(f"Found matching metadata: {file.name}")
 
     if not files_to_download:
         print(f"❌ No matching segments found for File ID: {file_id}.")
@@ -698,15 +1960,11 @@ def download_all_segments_from_dropbox(file_id):
 
     print(f"📥 Found {len(files_to_download)} files to download. Downloading...")
 
-    # Ensure output directory exists
-    output_dir = "output"
-    os.makedirs(output_dir, exist_ok=True)
-
     # Download each file
     segment_files = []
     metadata_files = []
     for file_name in files_to_download:
-        local_path = os.path.join(output_dir, file_name)
+        local_path = segment_store.file_path(file_id, file_name)
         print(f"⏳ Downloading {file_name}...")
 
         try:
@@ -717,7 +1975,7 @@ def download_all_segments_from_dropbox(file_id):
                 print(f"✅ Successfully downloaded {file_name}")
                 
                 # Track which files we downloaded
-                if file_name.endswith('.enc'):
+                if file_name.endswith(('.seg', '.enc')):
                     segment_files.append(local_path)
                 elif file_name.endswith('.meta'):
                     metadata_files.append(local_path)
@@ -726,47 +1984,474 @@ def download_all_segments_from_dropbox(file_id):
         except Exception as e:
             print(f"❌ Error downloading {file_name}: {e}")
 
-    # Verify we have the required files
-    downloaded_enc_files = [f for f in os.listdir(output_dir) if f.endswith('.enc') and file_id_prefix in f]
-    if downloaded_enc_files:
-        print(f"✅ Successfully downloaded {len(downloaded_enc_files)} encrypted segments.")
+    # Fetch the shared blob of each deduplicated segment. Other files may
+    # still use it, so it stays in Dropbox.
+    for segment_path in segment_files:
+        if not segment_path.endswith('.seg'):
+            continue
+        try:
+            metadata, data_path, _ = load_segment(segment_path)
+        except Exception as e:
+            print(f"❌ Error reading {segment_path}: {e}")
+            continue
+        if "content_id" in metadata and not os.path.exists(data_path):
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            download_file(f"{metadata['content_id']}.enc", data_path)
+    
+    # Legacy deduplicated segments are a .meta file naming the blob
+    for meta_path in metadata_files:
+        enc_path = meta_path.replace('.meta', '.enc')
+        if os.path.exists(enc_path):
+            continue
+        try:
+            with open(meta_path, "r") as f:
+                content_id = json.load(f).get("content_id")
+        except Exception as e:
+            print(f"❌ Error reading {meta_path}: {e}")
+            continue
+        if content_id:
+            download_file(f"{content_id}.enc", enc_path)
+            if os.path.exists(enc_path):
+                segment_files.append(enc_path)
+
+    return record_downloaded_segments(file_id, segment_files)
+
+#
+#   Downloads the objects a manifest lists from Dropbox
+#
+def download_manifest_segments(manifest):
+    """
+    Pulls each segment named in a manifest, plus the shared blobs of
+    deduplicated segments (which stay in Dropbox for other files).
+    
+    Returns:
+        list: Local paths of the segments now present
+    """
+    file_id = manifest["file_id"]
+    segment_files = []
+    for entry in manifest["segments"]:
+        local_path = segment_store.file_path(file_id, entry["name"])
+        names = [entry["name"]] + ([entry["metadata_name"]] if "metadata_name" in entry else [])
+        for name in names:
+            if not os.path.exists(segment_store.file_path(file_id, name)):
+                print(f"⏳ Downloading {name}...")
+                download_and_delete_file(name, segment_store.file_path(file_id, name))
         
-        # Now update the database with the downloaded files
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        content_id = entry.get("content_id")
+        if content_id and "metadata_name" in entry:
+            # A legacy deduplicated segment's .enc file is a copy of the blob
+            if not os.path.exists(local_path):
+                download_file(f"{content_id}.enc", local_path)
+        elif content_id and not os.path.exists(dedup_blob_path(content_id)):
+            os.makedirs(os.path.dirname(dedup_blob_path(content_id)), exist_ok=True)
+            download_file(f"{content_id}.enc", dedup_blob_path(content_id))
         
-        for segment_file in segment_files:
-            try:
-                # Extract segment index from filename
-                # Assuming filename format like: 9a015cee_split_0_henhacks.png_0.enc
-                segment_index = int(os.path.basename(segment_file).split('_')[-1].replace('.enc', ''))
-                segment_id = f"{file_id}_{segment_index}"
-                
-                # Check if this segment exists in segment_keys_info
-                cursor.execute("SELECT 1 FROM segment_keys_info WHERE segment_id = ?", (segment_id,))
-                if cursor.fetchone() is None:
-                    # If not, create an entry
-                    cursor.execute(
-                        """
-                        INSERT INTO segment_keys_info (
-                            segment_id, file_id, segment_index
-                        ) VALUES (?, ?, ?)
-                        """,
-                        (segment_id, file_id, segment_index)
-                    )
-                
-                # Update the local path in the database
-                print(f"🔄 Updating database to record downloaded segment {segment_index}")
-            except Exception as e:
-                print(f"⚠️ Warning: Could not update database for {segment_file}: {e}")
+        if os.path.exists(local_path):
+            segment_files.append(local_path)
+        else:
+            print(f"❌ Failed to download segment {entry['segment_index']}.")
+    return segment_files
+
+#
+#   Records segments pulled from Dropbox in the catalog
+#
+def record_downloaded_segments(file_id, segment_files):
+    """
+    Makes sure every downloaded segment has a segment_keys_info row.
+    
+    Args:
+        file_id (str): ID of the file the segments belong to
+        segment_files (list): Local paths of the downloaded segments
+        
+    Returns:
+        bool: True if any segment was downloaded
+    """
+    if segment_files:
+        print(f"✅ Successfully downloaded {len(segment_files)} encrypted segments.")
+        
+        # Now update the database with the downloaded files
+        downloaded_segments = []
+        with db.transaction() as cursor:
+            for segment_file in segment_files:
+                try:
+                    # Extract segment index from filename
+                    # Assuming filename format like: 9a015cee_split_0_henhacks.png_0.seg
+                    segment_index = int(os.path.splitext(os.path.basename(segment_file))[0].split('_')[-1])
+                    segment_id = f"{file_id}_{segment_index}"
+                    
+                    # Check if this segment exists in segment_keys_info
+                    cursor.execute("SELECT 1 FROM segment_keys_info WHERE segment_id = ?", (segment_id,))
+                    if cursor.fetchone() is None:
+                        # If not, create an entry
+                        cursor.execute(
+                            """
+                            INSERT INTO segment_keys_info (
+                                segment_id, file_id, segment_index
+                            ) VALUES (?, ?, ?)
+                            """,
+                            (segment_id, file_id, segment_index)
+                        )
+                    
+                    # Update the local path in the database
+                    print(f"🔄 Updating database to record downloaded segment {segment_index}")
+                    meta_path = os.path.splitext(segment_file)[0] + ".meta"
+                    downloaded_segments.append({
+                        "encrypted_path": segment_file,
+                        "metadata_path": meta_path if segment_file.endswith(".enc") else None,
+                        "segment_index": segment_index
+                    })
+                except Exception as e:
+                    print(f"⚠️ Warning: Could not update database for {segment_file}: {e}")
+            
+            record_local_segments(file_id, downloaded_segments)
         
-        conn.commit()
-        conn.close()
         return True
     else:
         print("❌ Failed to download any encrypted segments.")
         return False
 
+#
+#   Downloads one segment from its cloud locations into output/temp
+#
+def fetch_segment_from_cloud(file_id, segment_info, cloud_services):
+    """
+    Downloads a segment's encrypted data from the first cloud location that has it.
+    
+    Args:
+        file_id (str): ID of the file the segment belongs to
+        segment_info (dict): Segment entry from get_file_segments
+        cloud_services (dict): Connectors keyed by service name
+        
+    Returns:
+        tuple: (encrypted_path, metadata_path) of temporary files, or None.
+            metadata_path is None when the download is a segment container.
+    """
+    segment_index = segment_info["segment_index"]
+    cursor = db.cursor()
+    
+    # Generate segment_id that matches what's in segment_keys_info
+    segment_id = segment_info.get("segment_id", f"{file_id}_{segment_index}")
+    
+    # Try direct cloud info from segment_info if available
+    if "cloud_service" in segment_info and "remote_id" in segment_info:
+        cloud_locations = [{
+            "cloud_service": segment_info["cloud_service"],
+            "remote_id": segment_info["remote_id"]
+        }]
+    elif segment_info.get("cloud_locations"):
+        # Locations recorded in the file's manifest
+        cloud_locations = [
+            {"cloud_service": location["service"], "remote_id": location["remote_id"]}
+            for location in segment_info["cloud_locations"]
+        ]
+    else:
+        # Otherwise query the database
+        cursor.execute(
+            "SELECT * FROM segment_cloud_locations WHERE segment_id = ?",
+            (segment_id,)
+        )
+        cloud_locations = cursor.fetchall()
+    
+    # Get metadata for this segment from database
+    cursor.execute(
+        "SELECT * FROM segment_keys_info WHERE segment_id = ?",
+        (segment_id,)
+    )
+    db_segment_info = cursor.fetchone()
+    
+    for location in cloud_locations:
+        service_name = location["cloud_service"]
+        remote_id = location["remote_id"]
+        
+        if service_name not in cloud_services:
+            continue
+        
+        print(f"Downloading segment {segment_index} from {service_name}...")
+        encrypted_data = cloud_services[service_name].download_segment(remote_id)
+        if not encrypted_data:
+            continue
+        
+        # Save to temporary file
+        temp_dir = DOWNLOAD_TEMP_DIR
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir)
+        
+        # Containers carry their own metadata
+        if segment_encryptor.container.is_container(encrypted_data):
+            temp_container_path = os.path.join(temp_dir, f"temp_{segment_id}.seg")
+            with open(temp_container_path, "wb") as f:
+                f.write(encrypted_data)
+            return temp_container_path, None
+        
+        temp_encrypted_path = os.path.join(temp_dir, f"temp_{segment_id}.enc")
+        with open(temp_encrypted_path, "wb") as f:
+            f.write(encrypted_data)
+        
+        # Create temporary metadata file if needed
+        if segment_info.get("metadata_path") and os.path.exists(segment_info["metadata_path"]):
+            return temp_encrypted_path, segment_info["metadata_path"]
+        
+        if not db_segment_info:
+            print(f"Cannot create metadata for segment {segment_index}")
+            os.remove(temp_encrypted_path)
+            continue
+        
+        # Rebuild the metadata from the segment_keys_info row
+        temp_metadata_path = temp_encrypted_path.replace(".enc", ".meta")
+        metadata = {
+            "segment_id": segment_id,
+            "file_id": file_id,
+            "segment_index": segment_index,
+            "algorithm": db_segment_info["encryption_algorithm"],
+            "nonce": base64.b64encode(db_segment_info["nonce"]).decode('utf-8'),
+            "tag": base64.b64encode(db_segment_info["tag"]).decode('utf-8')
+        }
+        if db_segment_info["compression"]:
+            metadata["compression"] = db_segment_info["compression"]
+        if db_segment_info["content_id"]:
+            metadata["content_id"] = db_segment_info["content_id"]
+            metadata["wrapped_key"] = base64.b64encode(db_segment_info["wrapped_key"]).decode('utf-8')
+            blob_info = segment_encryptor.key_manager.get_dedup_blob(db_segment_info["content_id"])
+            if blob_info:
+                metadata["plaintext_size"] = blob_info["plaintext_size"]
+                if blob_info["chunk_size"]:
+                    metadata["chunk_size"] = blob_info["chunk_size"]
+                else:
+                    metadata["sealed"] = True
+        with open(temp_metadata_path, "w") as f:
+            f.write(json.dumps(metadata))
+        return temp_encrypted_path, temp_metadata_path
+    
+    return None
+
+#
+#   Files of a fetch_segment_from_cloud result that the download created
+#
+def downloaded_temp_files(fetched):
+    """
+    A fetched legacy segment can pair its download with the segment's own
+    .meta file, which must survive the restore. Only files in
+    DOWNLOAD_TEMP_DIR are temporary.
+    """
+    temp_dir = os.path.abspath(DOWNLOAD_TEMP_DIR)
+    return [
+        path for path in fetched
+        if path and os.path.dirname(os.path.abspath(path)) == temp_dir
+    ]
+
+#
+#   Writes data at a fixed offset of an open file descriptor
+#
+_write_lock = threading.Lock()
+
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    while len(view):
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            # No pwrite (Windows): serialise seek + write between workers
+            with _write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+class OffsetWriter:
+    """File-like writer that appends at an advancing offset of a shared descriptor"""
+    
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+    
+    def write(self, data):
+        write_at(self.fd, data, self.offset)
+        self.offset += len(data)
+        return len(data)
+
+#
+#   Reads the plaintext size of a segment from its metadata
+#
+def segment_plaintext_size(encrypted_path, metadata_path=None):
+    """
+    Reads a stored segment and works out how many bytes it decrypts to.
+    
+    Returns:
+        tuple: (plaintext_size, stored) with stored as returned by load_segment
+    """
+    stored = load_segment(encrypted_path, metadata_path)
+    metadata, data_path, data_offset = stored
+    
+    if "plaintext_size" in metadata:
+        return metadata["plaintext_size"], stored
+    if "ciphertext_size" in metadata:
+        # AEAD ciphertext (excluding tags) is the same length as the plaintext
+        return metadata["ciphertext_size"], stored
+    
+    # Minimal metadata rebuilt from the database: derive it from the file size
+    encrypted_size = os.path.getsize(data_path) - data_offset
+    return encrypted_size - (16 if metadata.get("sealed") else 0), stored
+
+#
+#   Decrypts one segment straight into its place in the output file
+#
+def restore_segment_at(fd, stored, offset, master_key):
+    """
+    Decrypts a segment and writes the plaintext at offset in the output file.
+    
+    Args:
+        fd (int): Descriptor of the output file
+        stored (tuple): (metadata, data_path, data_offset) from load_segment
+        offset (int): Position of the segment in the output file
+        master_key (bytes): Verified master key
+    
+    Returns:
+        int: Number of plaintext bytes written
+    """
+    metadata, data_path, data_offset = stored
+    
+    if "chunk_size" in metadata:
+        with open(data_path, "rb") as reader:
+            reader.seek(data_offset)
+            return segment_encryptor.decrypt_file_segment_stream(
+                reader, OffsetWriter(fd, offset), metadata, master_key=master_key
+            )
+    
+    try:
+        with open(data_path, "rb") as f:
+            f.seek(data_offset)
+            encrypted_data = f.read()
+    except OSError as e:
+        raise IOError(f"Could not read encrypted file {data_path}: {e}")
+    
+    decrypted_data = segment_encryptor.decrypt_file_segment(
+        encrypted_data, metadata, master_key=master_key
+    )
+    write_at(fd, decrypted_data, offset)
+    return len(decrypted_data)
+
+#
+#   Decrypts all located segments in parallel into the output file
+#
+def restore_segments(file_id, segments_info, sources, file_info, master_key, output_path,
+                     cloud_services, temp_paths, workers=None):
+    """
+    Decrypts segments on a worker pool, writing each at its offset in a
+    preallocated file that is only renamed to output_path once every segment
+    has authenticated.
+    
+    Args:
+        file_id (str): ID of the file to restore
+        segments_info (list): Segment entries from get_file_segments
+        sources (dict): segment_index -> (encrypted_path, metadata_path), with
+            metadata_path None for containers
+        file_info (dict): master_files row, if known
+        master_key (bytes): Verified master key
+        output_path (str): Final path of the restored file
+        cloud_services (dict): Connectors for retrying failed local segments
+        temp_paths (list): Downloaded files, extended with any new downloads
+        workers (int, optional): Decryption threads, RESTORE_WORKERS by default
+        
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    if not sources:
+        print("Failed to decrypt any segments. Check the password.")
+        return False
+    
+    # Every segment is needed to rebuild the file
+    segment_count = file_info["segment_count"] if file_info else len(segments_info)
+    missing = [idx for idx in range(segment_count) if idx not in sources]
+    if missing:
+        print(f"Cannot restore file: missing segments {missing}")
+        return False
+    
+    # Lay the segments out back to back using their recorded sizes
+    plan = []
+    offset = 0
+    try:
+        for idx in range(segment_count):
+            encrypted_path, metadata_path = sources[idx]
+            size, stored = segment_plaintext_size(encrypted_path, metadata_path)
+            plan.append((idx, encrypted_path, stored, offset, size))
+            offset += size
+    except Exception as e:
+        print(f"Error reading segment metadata: {e}")
+        return False
+    
+    partial_path = f"{output_path}.part"
+    budget = MemoryBudget(RESTORE_MEMORY_BUDGET)
+    
+    def restore_with_budget(fd, idx, stored, offset, size, reserved):
+        try:
+            written = restore_segment_at(fd, stored, offset, master_key)
+            if written != size:
+                raise ValueError(f"expected {size} bytes, decrypted {written}")
+            return True
+        except Exception as e:
+            print(f"Error processing segment {idx}: {str(e) or type(e).__name__}")
+            return False
+        finally:
+            budget.release(reserved)
+    
+    fd = os.open(partial_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        # Preallocate the output so every worker can write at its offset
+        os.ftruncate(fd, offset)
+        
+        with ThreadPoolExecutor(max_workers=workers or RESTORE_WORKERS) as executor:
+            futures = []
+            for idx, _, stored, segment_offset, size in plan:
+                _, data_path, data_offset = stored
+                try:
+                    encrypted_size = os.path.getsize(data_path) - data_offset
+                except OSError:
+                    encrypted_size = 0
+                reserved = budget.acquire(segment_memory_cost(encrypted_size))
+                futures.append(executor.submit(
+                    restore_with_budget, fd, idx, stored, segment_offset, size, reserved
+                ))
+            results = [future.result() for future in futures]
+        
+        # Retry failed local segments from the cloud
+        for idx, encrypted_path, _, segment_offset, size in plan:
+            if results[idx] or not cloud_services or encrypted_path in temp_paths:
+                continue
+            segment_info = next(info for info in segments_info if info["segment_index"] == idx)
+            segment_info = {k: v for k, v in segment_info.items() if k != "metadata_path"}
+            fetched = fetch_segment_from_cloud(file_id, segment_info, cloud_services)
+            if not fetched:
+                continue
+            temp_paths.extend(downloaded_temp_files(fetched))
+            retry_size, stored = segment_plaintext_size(*fetched)
+            if retry_size == size:
+                results[idx] = restore_with_budget(fd, idx, stored, segment_offset, size, 0)
+        
+        success = all(results)
+        if success:
+            os.fsync(fd)
+        else:
+            failed = [idx for idx, ok in enumerate(results) if not ok]
+            print(f"Failed to decrypt segments {failed}. Check the password.")
+    except Exception as e:
+        print(f"Error reassembling file: {e}")
+        import traceback
+        traceback.print_exc()
+        success = False
+    finally:
+        os.close(fd)
+    
+    # Never leave a partially restored file behind
+    if not success:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        return False
+    
+    # Every segment authenticated: move the file into place
+    os.replace(partial_path, output_path)
+    print(f"File reassembled successfully: {output_path}")
+    return True
+
 #   Process of decrypting all segments of a file
 #
 def decrypt_file_segments(file_id, password, output_path=None, download_from_cloud=True):
@@ -782,14 +2467,28 @@ def decrypt_file_segments(file_id, password, output_path=None, download_from_clo
     Returns:
         bool: True if successful, False otherwise
     """
+    # Unlock the master key in the background while local segments are
+    # located. This is the only KDF run for the restore: a wrong password is
+    # reported here, before any segment data is read or downloaded.
+    unlock_future = segment_encryptor.unlock_master_key_async(file_id, password)
+    
     # Get segments for this file
     segments_info, file_info = get_file_segments(file_id)
+    
+    try:
+        master_key = unlock_future.result()
+    except ValueError as e:
+        print(f"Decryption error: {e}")
+        print("Aborting restore before reading or downloading any segments.")
+        return False
 
     #####
     # Add this at the beginning of the decrypt_file_segments function, right after getting segments_info
 # This should be the very first check after getting segments_info
 
-    if not segments_info and download_from_cloud:
+    # Pull the file from Dropbox when none of its segments is stored locally,
+    # even if the manifest already listed their cloud locations
+    if download_from_cloud and not any(segment_files_exist(segment) for segment in segments_info or []):
         print(f"No local segments found for file ID: {file_id}")
         print(f"Attempting to download segments from Dropbox...")
         
@@ -829,38 +2528,13 @@ def decrypt_file_segments(file_id, password, output_path=None, download_from_clo
             
             # If still no segments, try a direct search in the output directory as a fallback
             if not segments_info:
-                output_dir = "output"
-                if os.path.exists(output_dir):
-                    print("Searching for segments in output directory...")
-                    
-                    # Create a list to hold found segments
-                    segments = []
-                    segment_pattern = file_id.split('-')[0]  # Use part of the file_id as a pattern
+                shard_dir = segment_store.shard_dir(file_id)
+                if os.path.exists(shard_dir):
+                    print("Searching for segments in the file's store directory...")
                     
-                    # Look for any files that might be segments
-                    for filename in os.listdir(output_dir):
-                        if filename.endswith(".enc"):
-                            enc_path = os.path.join(output_dir, filename)
-                            meta_path = enc_path.replace(".enc", ".meta")
-                            
-                            if os.path.exists(meta_path):
-                                # Try to read the metadata
-                                try:
-                                    with open(meta_path, "r") as f:
-                                        metadata_str = f.read()
-                                        metadata = json.loads(metadata_str)
-                                        
-                                        # If this segment belongs to our file_id or we don't have a good way to check
-                                        if "file_id" in metadata and metadata["file_id"] == file_id:
-                                            segment_index = metadata.get("segment_index", 0)
-                                            segments.append({
-                                                "encrypted_path": enc_path,
-                                                "metadata_path": meta_path,
-                                                "segment_index": segment_index
-                                            })
-                                            print(f"Found segment {segment_index} for file {file_id}")
-                                except Exception as e:
-                                    print(f"Error reading metadata from {meta_path}: {e}")
+                    segments = find_segments_by_metadata(file_id, shard_dir)
+                    for segment in segments:
+                        print(f"Found segment {segment['segment_index']} for file {file_id}")
                     
                     if segments:
                         print(f"Found {len(segments)} segments directly from files")
@@ -870,9 +2544,7 @@ def decrypt_file_segments(file_id, password, output_path=None, download_from_clo
         
         if not segments_info and download_from_cloud:
             # Try to check for cloud-stored segments
-            conn = sqlite3.connect(DB_PATH)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            cursor = db.cursor()
             
             # Check if any segments exist in the cloud locations table
             cursor.execute("""
@@ -884,7 +2556,6 @@ def decrypt_file_segments(file_id, password, output_path=None, download_from_clo
             """, (file_id,))
             
             cloud_segments = cursor.fetchall()
-            conn.close()
             
             if cloud_segments:
                 print(f"Found {len(cloud_segments)} segments in cloud storage.")
@@ -917,159 +2588,34 @@ def decrypt_file_segments(file_id, password, output_path=None, download_from_clo
     elif not output_path:
         output_path = f"restored_file_{file_id}"
     
-    # Decrypt each segment
-    decrypted_segments = []
-    
-    for segment_info in segments_info:
-        try:
-            segment_index = segment_info["segment_index"]
-            # Check if local files exist
-            if "encrypted_path" in segment_info and "metadata_path" in segment_info and \
-               os.path.exists(segment_info["encrypted_path"]) and \
-               os.path.exists(segment_info["metadata_path"]):
-                # Decrypt from local file
-                decrypted_path = decrypt_segment(
-                    segment_info["encrypted_path"],
-                    segment_info["metadata_path"],
-                    password=password
-                )
-                if decrypted_path:
-                    decrypted_segments.append((segment_index, decrypted_path))
-                    continue  # Skip cloud download if local decrypt succeeded
-            
-            # If we reach here, either local files don't exist or decryption failed
-            if download_from_cloud and cloud_services:
-                # Get cloud locations for this segment
-                conn = sqlite3.connect(DB_PATH)
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                # Generate segment_id that matches what's in segment_keys_info
-                segment_id = segment_info.get("segment_id", f"{file_id}_{segment_index}")
-                
-                # Try direct cloud info from segment_info if available
-                if "cloud_service" in segment_info and "remote_id" in segment_info:
-                    cloud_locations = [{
-                        "cloud_service": segment_info["cloud_service"],
-                        "remote_id": segment_info["remote_id"]
-                    }]
-                else:
-                    # Otherwise query the database
-                    cursor.execute(
-                        "SELECT * FROM segment_cloud_locations WHERE segment_id = ?",
-                        (segment_id,)
-                    )
-                    cloud_locations = cursor.fetchall()
-                
-                # Get metadata for this segment from database
-                cursor.execute(
-                    "SELECT * FROM segment_keys_info WHERE segment_id = ?",
-                    (segment_id,)
-                )
-                db_segment_info = cursor.fetchone()
-                
-                conn.close()
-                
-                if cloud_locations:
-                    # Try each cloud location
-                    for location in cloud_locations:
-                        service_name = location["cloud_service"]
-                        remote_id = location["remote_id"]
-                        
-                        if service_name in cloud_services:
-                            print(f"Downloading segment {segment_index} from {service_name}...")
-                            service = cloud_services[service_name]
-                            
-                            # Download the segment
-                            encrypted_data = service.download_segment(remote_id)
-                            
-                            if encrypted_data:
-                                # Save to temporary file
-                                temp_dir = os.path.join("output", "temp")
-                                if not os.path.exists(temp_dir):
-                                    os.makedirs(temp_dir)
-                                    
-                                temp_encrypted_path = os.path.join(temp_dir, f"temp_{segment_id}.enc")
-                                with open(temp_encrypted_path, "wb") as f:
-                                    f.write(encrypted_data)
-                                
-                                # Create temporary metadata file if needed
-                                if not "metadata_path" in segment_info or not os.path.exists(segment_info["metadata_path"]):
-                                    temp_metadata_path = temp_encrypted_path.replace(".enc", ".meta")
-                                    if db_segment_info:
-                                        # Generate minimal metadata for decryption
-                                        metadata = {
-                                            "segment_id": segment_id,
-                                            "file_id": file_id,
-                                            "segment_index": segment_index
-                                            # Other fields will be retrieved from database during decryption
-                                        }
-                                        with open(temp_metadata_path, "w") as f:
-                                            f.write(json.dumps(metadata))
-                                    else:
-                                        print(f"Cannot create metadata for segment {segment_index}")
-                                        continue
-                                else:
-                                    temp_metadata_path = segment_info["metadata_path"]
-                                
-                                # Try to decrypt
-                                decrypted_path = decrypt_segment(
-                                    temp_encrypted_path,
-                                    temp_metadata_path,
-                                    password=password
-                                )
-                                
-                                if decrypted_path:
-                                    decrypted_segments.append((segment_index, decrypted_path))
-                                    # Clean up temp files
-                                    if temp_encrypted_path.startswith(os.path.join("output", "temp")):
-                                        os.remove(temp_encrypted_path)
-                                        if temp_metadata_path.startswith(os.path.join("output", "temp")):
-                                            os.remove(temp_metadata_path)
-                                    break  # Successfully downloaded and decrypted
-                                else:
-                                    # Clean up temp files on failure
-                                    if temp_encrypted_path.startswith(os.path.join("output", "temp")):
-                                        os.remove(temp_encrypted_path)
-                                        if temp_metadata_path.startswith(os.path.join("output", "temp")):
-                                            os.remove(temp_metadata_path)
-                        
-                if segment_index not in [idx for idx, _ in decrypted_segments]:
-                    print(f"Failed to get segment {segment_index} from any source")
-            else:
-                print(f"Segment {segment_index} not found locally and cloud download disabled")
-        except Exception as e:
-            print(f"Error processing segment {segment_info['segment_index']}: {e}")
-            import traceback
-            traceback.print_exc()
-    
-    if not decrypted_segments:
-        print("Failed to decrypt any segments. Check the password.")
-        return False
+    # Locate every segment: local files first, otherwise a cloud download
+    sources = {}
+    temp_paths = []
+    for segment_info in segments_info:
+        segment_index = segment_info["segment_index"]
+        if segment_files_exist(segment_info):
+            sources[segment_index] = (segment_info["encrypted_path"], segment_info.get("metadata_path"))
+        elif download_from_cloud and cloud_services:
+            fetched = fetch_segment_from_cloud(file_id, segment_info, cloud_services)
+            if fetched:
+                sources[segment_index] = fetched
+                temp_paths.extend(downloaded_temp_files(fetched))
+            else:
+                print(f"Failed to get segment {segment_index} from any source")
+        else:
+            print(f"Segment {segment_index} not found locally and cloud download disabled")
     
-    # Reassemble the file
     try:
-        # Sort by segment index to ensure correct order
-        decrypted_segments.sort(key=lambda x: x[0])
-        
-        with open(output_path, "wb") as output_file:
-            for _, segment_path in decrypted_segments:
-                with open(segment_path, "rb") as segment_file:
-                    output_file.write(segment_file.read())
-        
-        print(f"File reassembled successfully: {output_path}")
-        
-        # Clean up decrypted segments
-        for _, path in decrypted_segments:
+        return restore_segments(
+            file_id, segments_info, sources, file_info, master_key, output_path,
+            cloud_services if download_from_cloud else {}, temp_paths
+        )
+    finally:
+        # Clean up downloaded segments
+        for path in temp_paths:
             if os.path.exists(path):
                 os.remove(path)
-                
-        return True
-    except Exception as e:
-        print(f"Error reassembling file: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+
 #
 #   Delete encrypted file and all its segments
 #
@@ -1092,7 +2638,22 @@ def delete_encrypted_file(file_id):
     
     deleted_count = 0
     
-    # Delete segment files from disk if they exist
+    # Deduplicated segments still used by another file keep their shared
+    # blob and cloud copies; only this file's references are dropped
+    cursor = db.cursor()
+    cursor.execute(
+        "SELECT content_id FROM segment_keys_info WHERE file_id = ? AND content_id IS NOT NULL",
+        (file_id,)
+    )
+    content_refs = [row[0] for row in cursor.fetchall()]
+    shared_content = set()
+    for content_id in set(content_refs):
+        blob_info = segment_encryptor.key_manager.get_dedup_blob(content_id)
+        if blob_info and blob_info["refcount"] > content_refs.count(content_id):
+            shared_content.add(content_id)
+    
+    # Delete segment files from disk if they exist (for dedup segments these
+    # only hold the header, the shared blob is removed below once unreferenced)
     if segments_info:
         for segment_info in segments_info:
             try:
@@ -1100,11 +2661,14 @@ def delete_encrypted_file(file_id):
                     os.remove(segment_info["encrypted_path"])
                     deleted_count += 1
                 
-                if os.path.exists(segment_info["metadata_path"]):
+                if segment_info["metadata_path"] and os.path.exists(segment_info["metadata_path"]):
                     os.remove(segment_info["metadata_path"])
             except Exception as e:
                 print(f"Error deleting segment {segment_info['segment_index']}: {e}")
     
+    if os.path.exists(segment_store.manifest_path(file_id)):
+        os.remove(segment_store.manifest_path(file_id))
+    
     # Delete cloud-stored segments if possible
     try:
         # Initialize cloud services 
@@ -1119,27 +2683,32 @@ def delete_encrypted_file(file_id):
         
         if cloud_services:
             # Get cloud segment info from database
-            conn = sqlite3.connect(DB_PATH)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            cursor = db.cursor()
             
             # Find all cloud segments for this file
             cursor.execute("""
-                SELECT c.* 
+                SELECT c.*, s.content_id
                 FROM segment_cloud_locations c
                 JOIN segment_keys_info s ON c.segment_id = s.segment_id
                 WHERE s.file_id = ?
             """, (file_id,))
             
             cloud_segments = cursor.fetchall()
-            conn.close()
             
             # Delete each cloud segment
             cloud_deleted = 0
+            deleted_remote = set()
             for segment in cloud_segments:
                 service_name = segment["cloud_service"]
                 remote_id = segment["remote_id"]
                 
+                # Shared with another file, or already deleted for an earlier
+                # segment of this file with the same content
+                if segment["content_id"] in shared_content or \
+                   (service_name, remote_id) in deleted_remote:
+                    continue
+                deleted_remote.add((service_name, remote_id))
+                
                 if service_name in cloud_services:
                     service = cloud_services[service_name]
                     if service.delete_segment(remote_id):
@@ -1148,33 +2717,43 @@ def delete_encrypted_file(file_id):
             
             if cloud_deleted > 0:
                 print(f"Deleted {cloud_deleted} segments from cloud storage")
+            
+            # The manifest is uploaded to the Dropbox root under its own name
+            if "Dropbox" in cloud_services:
+                cloud_services["Dropbox"].delete_segment("/" + os.path.basename(segment_store.manifest_path(file_id)))
     except Exception as e:
         print(f"Error deleting cloud segments: {e}")
     
     # Remove database records
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Get all segment IDs for this file
-        cursor.execute("SELECT segment_id FROM segment_keys_info WHERE file_id = ?", (file_id,))
-        segment_ids = [row[0] for row in cursor.fetchall()]
-        
-        # Delete cloud location records
-        for segment_id in segment_ids:
-            cursor.execute("DELETE FROM segment_cloud_locations WHERE segment_id = ?", (segment_id,))
-        
-        # Delete segment records
-        cursor.execute("DELETE FROM segment_keys_info WHERE file_id = ?", (file_id,))
-        
-        # Delete master key record
-        cursor.execute("DELETE FROM master_keys WHERE file_id = ?", (file_id,))
-        
-        # Delete file record
-        cursor.execute("DELETE FROM master_files WHERE file_id = ?", (file_id,))
+        with db.transaction() as cursor:
+            # Get all segment IDs for this file
+            cursor.execute("SELECT segment_id FROM segment_keys_info WHERE file_id = ?", (file_id,))
+            segment_ids = [row[0] for row in cursor.fetchall()]
+            
+            # Delete cloud location records
+            for segment_id in segment_ids:
+                cursor.execute("DELETE FROM segment_cloud_locations WHERE segment_id = ?", (segment_id,))
+            
+            # Delete local path records
+            cursor.execute("DELETE FROM segment_local_paths WHERE file_id = ?", (file_id,))
+            
+            # Drop this file's references to dedup blobs
+            released = segment_encryptor.key_manager.release_dedup_blobs(content_refs)
+            
+            # Delete segment records
+            cursor.execute("DELETE FROM segment_keys_info WHERE file_id = ?", (file_id,))
+            
+            # Delete master key record
+            cursor.execute("DELETE FROM master_keys WHERE file_id = ?", (file_id,))
+            
+            # Delete file record
+            cursor.execute("DELETE FROM master_files WHERE file_id = ?", (file_id,))
         
-        conn.commit()
-        conn.close()
+        # Remove shared blobs nothing refers to anymore
+        remove_released_blobs(released)
+        if shared_content:
+            print(f"Kept {len(shared_content)} deduplicated segments still used by other files")
         
         print(f"Deleted {deleted_count} segments and database records for file ID: {file_id}")
         return True
@@ -1196,9 +2775,7 @@ def verify_file_availability(file_id):
         dict: Status of file segments
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Get file info
         cursor.execute(
@@ -1220,34 +2797,31 @@ def verify_file_availability(file_id):
         segment_status = []
         missing_segments = []
         
+        # Local copies from the segment index
+        local_segments = indexed_local_segments(file_id)
+        
+        # Cloud locations of all segments in one query
+        cursor.execute("""
+            SELECT c.* FROM segment_cloud_locations c
+            JOIN segment_keys_info s ON c.segment_id = s.segment_id
+            WHERE s.file_id = ?
+        """, (file_id,))
+        cloud_locations = {}
+        for location in cursor.fetchall():
+            cloud_locations.setdefault(location["segment_id"], []).append(location)
+        
         for segment in segments:
             segment_id = segment["segment_id"]
             segment_index = segment["segment_index"]
             
-            # Get expected file paths
-            expected_enc_path = os.path.join("output", f"{file_id[:8]}_split_{segment_index}_{file_info['original_filename']}_{segment_index}.enc")
-            local_available = os.path.exists(expected_enc_path)
-            
-            # Also check for any files matching the pattern with this segment index
-            if not local_available:
-                # Try the more general pattern match
-                for filename in os.listdir("output"):
-                    if filename.endswith(f"_{segment_index}.enc") and filename.startswith(file_id[:8]):
-                        local_available = True
-                        expected_enc_path = os.path.join("output", filename)
-                        break
-            
-            # Check cloud locations
-            cursor.execute(
-                "SELECT * FROM segment_cloud_locations WHERE segment_id = ?",
-                (segment_id,)
-            )
-            cloud_locs = cursor.fetchall()
+            local_segment = local_segments.get(segment_index)
+            local_available = local_segment is not None
+            cloud_locs = cloud_locations.get(segment_id, [])
             
             segment_info = {
                 "segment_index": segment_index,
                 "local_available": local_available,
-                "local_path": expected_enc_path if local_available else None,
+                "local_path": local_segment["encrypted_path"] if local_available else None,
                 "cloud_available": len(cloud_locs) > 0,
                 "cloud_services": [loc["cloud_service"] for loc in cloud_locs]
             }
@@ -1257,8 +2831,6 @@ def verify_file_availability(file_id):
             
             segment_status.append(segment_info)
         
-        conn.close()
-        
         if missing_segments:
             return {
                 "status": "incomplete",
@@ -1290,9 +2862,7 @@ def get_segment_locations(segment_id):
         dict: Information about segment locations
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Get local file info
         cursor.execute(
@@ -1308,40 +2878,15 @@ def get_segment_locations(segment_id):
         )
         cloud_locations = cursor.fetchall()
         
-        conn.close()
-        
         if not segment_info:
             return None
         
-        # Determine local file paths based on naming convention
         file_id = segment_info["file_id"]
         segment_index = segment_info["segment_index"]
         
-        # Get file info for the original filename
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT original_filename FROM master_files WHERE file_id = ?", (file_id,))
-        file_info = cursor.fetchone()
-        conn.close()
-        
-        original_filename = file_info["original_filename"] if file_info else ""
-        
-        # Try to find the actual file
-        expected_enc_path = None
-        for filename in os.listdir("output"):
-            if filename.endswith(f"_{segment_index}.enc") and filename.startswith(file_id[:8]):
-                expected_enc_path = os.path.join("output", filename)
-                expected_meta_path = expected_enc_path.replace(".enc", ".meta")
-                break
-        
-        # If not found, use a default pattern
-        if not expected_enc_path:
-            expected_enc_path = os.path.join("output", f"{file_id[:8]}_split_{segment_index}_{original_filename}_{segment_index}.enc")
-            expected_meta_path = expected_enc_path.replace(".enc", ".meta")
-        
-        # Check if local files exist
-        local_exists = os.path.exists(expected_enc_path) and os.path.exists(expected_meta_path)
+        # Local files from the segment index
+        local_segment = indexed_local_segments(segment_id=segment_id).get(segment_index)
+        local_exists = local_segment is not None
         
         # Compile result
         result = {
@@ -1349,8 +2894,8 @@ def get_segment_locations(segment_id):
             "file_id": file_id,
             "segment_index": segment_index,
             "local_available": local_exists,
-            "local_path": expected_enc_path if local_exists else None,
-            "metadata_path": expected_meta_path if local_exists else None,
+            "local_path": local_segment["encrypted_path"] if local_exists else None,
+            "metadata_path": local_segment["metadata_path"] if local_exists else None,
             "cloud_locations": [dict(loc) for loc in cloud_locations]
         }
         
@@ -1386,7 +2931,7 @@ def test_encryption():
     
     # Split the file
     if file_info["type"] == "text":
-        segments = split_text_file(test_file, test_file, num_splits, file_info["lines"])
+        segments = split_text_file(test_file, test_file, num_splits)
     else:
         segments = split_binary_file(test_file, num_splits)
         
@@ -1407,7 +2952,7 @@ def test_encryption():
             metadata_path = segment["metadata_path"]
             segment_index = segment["segment_index"]
             
-            if os.path.exists(encrypted_path) and os.path.exists(metadata_path):
+            if segment_files_exist(segment):
                 segments_info.append({
                     "encrypted_path": encrypted_path,
                     "metadata_path": metadata_path,
@@ -1476,7 +3021,7 @@ def test_encryption():
                 os.remove(segment_info["encrypted_path"])
             except:
                 pass
-        if os.path.exists(segment_info["metadata_path"]):
+        if segment_info["metadata_path"] and os.path.exists(segment_info["metadata_path"]):
             try:
                 os.remove(segment_info["metadata_path"])
             except:
@@ -1694,11 +3239,149 @@ class OneDriveConnector(CloudServiceConnector):
             print(f"Error deleting from OneDrive: {e}")
             return False
 
+#
+#   Splits a file for upload: fixed parts, or content-defined chunks
+#
+def split_file(file_path, file_info, number_of_splits, chunking="fixed", chunk_sizes=None):
+    """
+    Splits a file into segments. Nothing is copied; each segment is a byte
+    range that is read from the original file when it is encrypted.
+    
+    Args:
+        file_path (str): Path to the file
+        file_info (dict): Result of get_file_info for the file
+        number_of_splits (int): Number of parts for "fixed" chunking
+        chunking (str): "fixed" or "cdc"
+        chunk_sizes (tuple, optional): (min, avg, max) chunk sizes in bytes for "cdc"
+        
+    Returns:
+        list: SegmentRange of each segment, in order
+    """
+    file_name = os.path.basename(file_path)
+    
+    if chunking == "cdc":
+        splits = split_cdc_file(file_path, chunk_sizes)
+        print(f"File split into {len(splits)} content-defined chunks.")
+    elif file_info["type"] == "text":
+        splits = split_text_file(file_name, file_path, number_of_splits)
+        print(f"File split into {len(splits)} text parts.")
+    else:
+        splits = split_binary_file(file_path, number_of_splits)
+        print(f"Binary file split into {len(splits)} parts.")
+    
+    return splits
+
+#
+#   Drops the requested compression for files that won't compress
+#
+def choose_compression(file_info, compression):
+    """
+    Reports the file analysis and decides whether to compress its segments.
+    
+    Args:
+        file_info (dict): Result of get_file_info
+        compression (str): Requested codec, or None
+        
+    Returns:
+        str: The codec to use, or None
+    """
+    print(f"Analyzed {file_info['type']} file: {file_info['size']} bytes, "
+          f"{file_info['newlines']} lines, entropy {file_info['entropy']:.2f} bits/byte")
+    
+    if compression and file_info["entropy"] > INCOMPRESSIBLE_ENTROPY:
+        print("File looks already compressed; segments will not be compressed.")
+        return None
+    return compression
+
+#
+#   Uploads segment containers (and shared dedup blobs) to Dropbox
+#
+def upload_segments_to_dropbox(file_id, encrypted_segments):
+    """
+    Uploads segments to Dropbox and records their locations in one transaction.
+    
+    Args:
+        file_id (str): ID of the file the segments belong to
+        encrypted_segments (list): Segment info dicts as returned by encrypt_file_segments
+    """
+    print("\n📤 Uploading ALL encrypted segments to Dropbox...")
+    
+    # Cloud locations are recorded for all segments in one transaction below
+    uploaded_locations = []
+    
+    # Dropbox paths of dedup blobs uploaded in this loop
+    uploaded_blobs = {}
+    
+    for segment in encrypted_segments:
+        segment_path = segment.get("encrypted_path") 
+        segment_index = segment.get("segment_index")
+        content_id = segment.get("content_id")
+        segment_id = f"{file_id}_{segment_index}"
+        
+        if not segment_path:
+            print(f"❌ Error: Missing file path for segment: {segment}")
+            continue
+        
+        if not os.path.exists(segment_path):
+            print(f"❌ Error: Encrypted file not found: {segment_path}")
+            continue
+        
+        # Deduplicated segments already in Dropbox are only referenced
+        reused_path = None
+        if content_id:
+            reused_path = uploaded_blobs.get(content_id) or next(
+                (remote_id for service_name, remote_id in find_dedup_cloud_locations(content_id)
+                 if service_name == "Dropbox"),
+                None
+            )
+        
+        if reused_path:
+            uploaded_locations.append((segment_id, "Dropbox", reused_path))
+            print(f"♻️ Segment {segment_index} already in Dropbox: {reused_path}")
+        else:
+            # Upload the segment container, or the shared blob of a dedup segment
+            upload_result = upload_file(dedup_blob_path(content_id) if content_id else segment_path)
+            
+            if upload_result["success"]:
+                # Add to database - IMPORTANT: This is what was missing
+                uploaded_locations.append((segment_id, "Dropbox", upload_result["remote_path"]))
+                if content_id:
+                    uploaded_blobs[content_id] = upload_result["remote_path"]
+                
+                print(f"✅ Uploaded encrypted segment: {segment_path} -> {upload_result['remote_path']}")
+
+        # A dedup segment's container only holds the header naming its blob
+        if content_id:
+            header_upload_result = upload_file(segment_path)
+            if header_upload_result["success"]:
+                print(f"✅ Uploaded segment header: {segment_path} -> {header_upload_result['remote_path']}")
+    
+    with db.transaction() as cursor:
+        # Check that every uploaded segment_id exists in segment_keys_info
+        cursor.execute("SELECT segment_id FROM segment_keys_info WHERE file_id = ?", (file_id,))
+        known_segment_ids = {row[0] for row in cursor.fetchall()}
+        for segment_id, _, _ in uploaded_locations:
+            if segment_id not in known_segment_ids:
+                print(f"⚠️ Warning: Segment ID {segment_id} not found in segment_keys_info table.")
+        
+        # Replace any existing cloud location for these segments (to avoid duplicates)
+        cursor.executemany(
+            """
+            INSERT OR REPLACE INTO segment_cloud_locations (
+                segment_id, cloud_service, remote_id, upload_date
+            ) VALUES (?, ?, ?, datetime('now'))
+            """, 
+            uploaded_locations
+        )
+    
+    print(f"✅ Recorded cloud locations in database for {len(uploaded_locations)} segments.")
+
 #
 #   Handles the file upload process (splitting, encrypting, etc.)
 #
 
-def upload(file_path, number_of_splits, file_pass, upload_to_cloud=False):
+def upload(file_path, number_of_splits, file_pass, upload_to_cloud=False, vault=None,
+           workers=None, compression=None, chunking="fixed", chunk_sizes=None, dedup=False):
     """
     Handles the complete file upload process: splitting, encrypting, and preparing for upload.
     
@@ -1707,6 +3390,15 @@ def upload(file_path, number_of_splits, file_pass, upload_to_cloud=False):
         number_of_splits (int): Number of segments to split into
         file_pass (str): Password for encryption
         upload_to_cloud (bool): Whether to upload to cloud services
+        vault (str, optional): Keyring to store the file's key in. file_pass is
+            then the vault password and is only run through the KDF once per session.
+        workers (int, optional): Number of segments to encrypt in parallel
+        compression (str, optional): Codec to compress segments with before encryption
+        chunking (str): "fixed" to split into number_of_splits parts, or "cdc" for
+            content-defined chunks (number_of_splits is then ignored)
+        chunk_sizes (tuple, optional): (min, avg, max) chunk sizes in bytes for "cdc"
+        dedup (bool): Store and upload segments that match a segment of an
+            earlier upload only once
     """
     print(f"Current working directory: {os.getcwd()}")
 
@@ -1735,80 +3427,38 @@ def upload(file_path, number_of_splits, file_pass, upload_to_cloud=False):
     ensure_output_dir()
     file_name = os.path.basename(file_path)
 
-    file_info = get_file_info(file_path)
-    if not file_info:
-        print("Error: Could not analyze the file.")
-        return None, None
+    # Start deriving the master key now so the KDF runs while the file is
+    # analysed and split; encrypt_file_segments joins it before encrypting
+    key_future = segment_encryptor.setup_encryption_async(file_pass, vault_id=vault)
 
-    if file_info["type"] == "text":
-        splits = split_text_file(file_name, file_path, number_of_splits, file_info["lines"])
-        print(f"File split into {len(splits)} text parts.")
-    else:
-        splits = split_binary_file(file_path, number_of_splits)
-        print(f"Binary file split into {len(splits)} parts.")
+    try:
+        file_info = get_file_info(file_path)
+        if not file_info:
+            print("Error: Could not analyze the file.")
+            return None, None
 
-    # Encrypt segments
-    file_id, encrypted_segments, master_key = encrypt_file_segments(
-        splits, file_pass, file_name
-    )
+        compression = choose_compression(file_info, compression)
+        splits = split_file(file_path, file_info, number_of_splits, chunking, chunk_sizes)
+
+        # Encrypt segments
+        file_id, encrypted_segments, master_key = encrypt_file_segments(
+            splits, file_pass, file_name, key_future=key_future, workers=workers,
+            compression=compression, dedup=dedup
+        )
+        if file_id is None:
+            return None, None
+    except Exception as e:
+        print(f"Error: Upload failed: {e}")
+        return None, None
+    finally:
+        # Drop the key profile created in the background so it isn't orphaned
+        discard_unregistered_key(key_future)
 
     
     if upload_to_cloud:
-        print("\n📤 Uploading ALL encrypted segments to Dropbox...")
-        
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        for segment in encrypted_segments:
-            segment_path = segment.get("encrypted_path") 
-            segment_index = segment.get("segment_index")
-            
-            if not segment_path:
-                print(f"❌ Error: Missing file path for segment: {segment}")
-                continue
-            
-            if not os.path.exists(segment_path):
-                print(f"❌ Error: Encrypted file not found: {segment_path}")
-                continue
-            
-            # Upload the encrypted segment
-            upload_result = upload_file(segment_path)
-            
-            if upload_result["success"]:
-                # Add to database - IMPORTANT: This is what was missing
-                segment_id = f"{file_id}_{segment_index}"
-                
-                # Check if the segment_id exists in segment_keys_info
-                cursor.execute("SELECT 1 FROM segment_keys_info WHERE segment_id = ?", (segment_id,))
-                if cursor.fetchone() is None:
-                    print(f"⚠️ Warning: Segment ID {segment_id} not found in segment_keys_info table.")
-                    # You might want to insert it here if missing
-                
-                # Delete any existing cloud location for this segment (to avoid duplicates)
-                cursor.execute("DELETE FROM segment_cloud_locations WHERE segment_id = ?", (segment_id,))
-                
-                # Insert the new cloud location
-                cursor.execute(
-                    """
-                    INSERT INTO segment_cloud_locations (
-                        segment_id, cloud_service, remote_id, upload_date
-                    ) VALUES (?, ?, ?, datetime('now'))
-                    """, 
-                    (segment_id, "Dropbox", upload_result["remote_path"])
-                )
-                
-                conn.commit()
-                print(f"✅ Recorded cloud location in database for segment {segment_index}.")
-                print(f"✅ Uploaded encrypted segment: {segment_path} -> {upload_result['remote_path']}")
-
-            # Upload metadata file if it exists
-            meta_file = segment_path.replace(".enc", ".meta")
-            if os.path.exists(meta_file):
-                meta_upload_result = upload_file(meta_file)
-                if meta_upload_result["success"]:
-                    print(f"✅ Uploaded metadata: {meta_file} -> {meta_upload_result['remote_path']}")
-        
-        conn.close()
+        upload_segments_to_dropbox(file_id, encrypted_segments)
+        # Rewritten with the Dropbox locations and uploaded next to the segments
+        save_file_manifest(file_id, encrypted_segments, upload_to_cloud=True)
 ###
 
 
@@ -1825,6 +3475,324 @@ def upload(file_path, number_of_splits, file_pass, upload_to_cloud=False):
 
     return file_id, encrypted_segments
 
+#
+#   Re-uploads a changed file under its existing catalog entry
+#
+def update(file_id, file_path, file_pass, number_of_splits=None, upload_to_cloud=False,
+           workers=None, compression=None, chunking="fixed", chunk_sizes=None, dedup=False):
+    """
+    Replaces the contents of an uploaded file, re-encrypting only what changed.
+    
+    The new version is split like an upload and the keyed hash of each segment
+    is compared with the hashes stored for the current version. A segment that
+    is unchanged at the same index keeps its files, key info row and cloud
+    locations. A deduplicated segment that moved to another index is
+    re-referenced without being encrypted or uploaded again. Everything else
+    is encrypted into a staging directory, and the catalog switches to the new
+    segments in one transaction that also bumps the file's generation.
+    
+    Segments stored before segment hashes were recorded never match, so the
+    first update of such a file re-encrypts all of it.
+    
+    Args:
+        file_id (str): ID of the catalog entry to update
+        file_path (str): Path to the new version of the file
+        file_pass (str): Password of the file
+        number_of_splits (int, optional): Parts for "fixed" chunking, by default
+            the current segment count so that unchanged parts line up
+        upload_to_cloud (bool): Upload the new segments to Dropbox. Always done
+            for a file that already has cloud copies.
+        workers (int, optional): Number of segments to encrypt in parallel
+        compression (str, optional): Codec to compress new segments with
+        chunking (str): "fixed" or "cdc", as for upload
+        chunk_sizes (tuple, optional): (min, avg, max) chunk sizes in bytes for "cdc"
+        dedup (bool): Store new segments through the dedup store
+        
+    Returns:
+        dict: Number of "kept", "relinked" and "encrypted" segments and the new
+            "generation", or None if the update failed
+    """
+    cursor = db.cursor()
+    cursor.execute("SELECT * FROM master_files WHERE file_id = ?", (file_id,))
+    file_row = cursor.fetchone()
+    if not file_row:
+        print(f"No file found with ID: {file_id}")
+        return None
+    
+    if not os.path.exists(file_path):
+        print(f"Error: File not found at {file_path}")
+        return None
+    
+    ensure_output_dir()
+    
+    # Unlock the key while the new version is analysed
+    unlock_future = segment_encryptor.unlock_master_key_async(file_id, file_pass)
+    file_info = get_file_info(file_path)
+    
+    try:
+        master_key = unlock_future.result()
+    except ValueError as e:
+        print(f"Decryption error: {e}")
+        return None
+    
+    if not file_info:
+        print("Error: Could not analyze the file.")
+        return None
+    
+    # A file with cloud copies keeps them current: its dropped segments are
+    # deleted from the cloud below, so the new ones and the manifest must follow
+    cursor.execute("""
+        SELECT 1 FROM segment_cloud_locations c
+        JOIN segment_keys_info s ON c.segment_id = s.segment_id
+        WHERE s.file_id = ? LIMIT 1
+    """, (file_id,))
+    if cursor.fetchone() is not None and not upload_to_cloud:
+        print("The file has cloud copies; the new version is uploaded as well.")
+        upload_to_cloud = True
+    
+    staging_dir = os.path.join("output", f".update_{file_id[:8]}")
+    dedup_pins = []
+    generation = None
+    
+    try:
+        compression = choose_compression(file_info, compression)
+        splits = split_file(
+            file_path, file_info, number_of_splits or file_row["segment_count"], chunking, chunk_sizes
+        )
+        digests = [hash_segment(segment) for segment in splits]
+        segment_hashes = [segment_encryptor.dedup_content_id(digest) for digest in digests]
+        
+        cursor.execute(
+            "SELECT segment_id, segment_index, segment_hash, content_id FROM segment_keys_info WHERE file_id = ?",
+            (file_id,)
+        )
+        old_rows = cursor.fetchall()
+        old_by_index = {row["segment_index"]: row for row in old_rows}
+        old_by_content = {row["content_id"]: row for row in old_rows if row["content_id"]}
+        old_segments, _ = get_file_segments(file_id)
+        
+        # Sort the new segments into kept, moved dedup segments and changed ones
+        kept = set()
+        relinked = {}
+        changed = []
+        for idx, segment_hash in enumerate(segment_hashes):
+            old_row = old_by_index.get(idx)
+            if old_row and old_row["segment_hash"] == segment_hash:
+                kept.add(idx)
+            elif segment_hash in old_by_content and os.path.exists(dedup_blob_path(segment_hash)):
+                relinked[idx] = old_by_content[segment_hash]
+            else:
+                changed.append(idx)
+        print(f"{len(kept)} segments unchanged, {len(relinked)} moved, {len(changed)} to encrypt.")
+        
+        os.makedirs(staging_dir, exist_ok=True)
+        pending_key_info = []
+        segment_encryptor.prepare_segment_keys(file_id, master_key, changed + list(relinked))
+        
+        results = encrypt_segments_parallel(
+            [(splits[idx], idx) for idx in changed], file_id, master_key, pending_key_info,
+            workers, None, compression, dedup, staging_dir
+        )
+        dedup_pins = [metadata["content_id"] for metadata in pending_key_info if "content_id" in metadata]
+        if any(encrypted_path is None for encrypted_path in results):
+            print("Error: Not all segments could be encrypted. The stored version is unchanged.")
+            return None
+        staged = dict(zip(changed, results))
+        
+        for idx, old_row in relinked.items():
+            blob_info = segment_encryptor.key_manager.get_dedup_blob(old_row["content_id"])
+            metadata, _ = segment_encryptor.reference_dedup_blob(
+                file_id, master_key, idx, digests[idx], blob_info, store_key_info=False
+            )
+            encrypted_path = segment_output_path(file_id, idx, staging_dir)
+            write_segment_container(encrypted_path, metadata)
+            pending_key_info.append(metadata)
+            staged[idx] = encrypted_path
+        
+        pending_key_info.sort(key=lambda metadata: metadata["segment_index"])
+        dropped = [row for row in old_rows if row["segment_index"] not in kept]
+        
+        # Switch the catalog over to the new segments in one commit
+        with db.transaction() as cursor:
+            # Moved segments keep the cloud copies of the segment they came from
+            relinked_locations = []
+            for idx, old_row in relinked.items():
+                cursor.execute(
+                    "SELECT cloud_service, remote_id FROM segment_cloud_locations WHERE segment_id = ?",
+                    (old_row["segment_id"],)
+                )
+                relinked_locations.extend(
+                    (f"{file_id}_{idx}", row["cloud_service"], row["remote_id"])
+                    for row in cursor.fetchall()
+                )
+            
+            dropped_locations = set()
+            for row in dropped:
+                cursor.execute(
+                    "SELECT cloud_service, remote_id FROM segment_cloud_locations WHERE segment_id = ?",
+                    (row["segment_id"],)
+                )
+                dropped_locations.update(
+                    (location["cloud_service"], location["remote_id"]) for location in cursor.fetchall()
+                )
+                cursor.execute("DELETE FROM segment_cloud_locations WHERE segment_id = ?", (row["segment_id"],))
+                cursor.execute("DELETE FROM segment_local_paths WHERE segment_id = ?", (row["segment_id"],))
+                cursor.execute("DELETE FROM segment_keys_info WHERE segment_id = ?", (row["segment_id"],))
+            
+            segment_encryptor.record_segment_key_infos(pending_key_info)
+            cursor.executemany(
+                """
+                INSERT INTO segment_cloud_locations (
+                    segment_id, cloud_service, remote_id, upload_date
+                ) VALUES (?, ?, ?, datetime('now'))
+                """,
+                relinked_locations
+            )
+            
+            # The new references are taken first, so blobs that only moved survive
+            released = segment_encryptor.key_manager.release_dedup_blobs(
+                dedup_pins + [row["content_id"] for row in dropped if row["content_id"]]
+            )
+            
+            cursor.execute(
+                "UPDATE master_files SET segment_count = ?, generation = generation + 1 WHERE file_id = ?",
+                (len(splits), file_id)
+            )
+            cursor.execute("SELECT generation FROM master_files WHERE file_id = ?", (file_id,))
+            generation = cursor.fetchone()[0]
+            
+            # Cloud objects no segment refers to anymore
+            obsolete_locations = []
+            for service_name, remote_id in dropped_locations:
+                cursor.execute(
+                    "SELECT 1 FROM segment_cloud_locations WHERE cloud_service = ? AND remote_id = ?",
+                    (service_name, remote_id)
+                )
+                if cursor.fetchone() is None:
+                    obsolete_locations.append((service_name, remote_id))
+        dedup_pins = []
+        
+        # Replace the dropped segment files with the staged ones
+        for segment in old_segments or []:
+            if segment["segment_index"] not in kept:
+                for path in (segment["encrypted_path"], segment["metadata_path"]):
+                    if path and os.path.exists(path):
+                        os.remove(path)
+        
+        new_segments = []
+        for idx, encrypted_path in sorted(staged.items()):
+            final_path = segment_store.put(encrypted_path, segment_store.segment_path(file_id, idx))
+            segment_info = {"encrypted_path": final_path, "metadata_path": None, "segment_index": idx}
+            if idx in relinked:
+                segment_info["content_id"] = relinked[idx]["content_id"]
+            elif dedup:
+                segment_info["content_id"] = segment_hashes[idx]
+            new_segments.append(segment_info)
+        record_local_segments(file_id, new_segments)
+        
+        remove_released_blobs(released)
+        
+        # Delete cloud copies of the dropped segments
+        if obsolete_locations:
+            settings = load_settings()
+            cloud_services = {}
+            if settings["GoogleDrive"] != "000":
+                cloud_services["GoogleDrive"] = GoogleDriveConnector(settings["GoogleDrive"])
+            if settings["Dropbox"] != "000":
+                cloud_services["Dropbox"] = DropboxConnector(settings["Dropbox"])
+            if settings["OneDrive"] != "000":
+                cloud_services["OneDrive"] = OneDriveConnector(settings["OneDrive"])
+            
+            for service_name, remote_id in obsolete_locations:
+                if service_name in cloud_services:
+                    cloud_services[service_name].delete_segment(remote_id)
+        
+        if upload_to_cloud and new_segments:
+            upload_segments_to_dropbox(file_id, new_segments)
+        
+        # Describe the new version: kept segments plus the staged ones
+        save_file_manifest(
+            file_id,
+            [segment for segment in old_segments or [] if segment["segment_index"] in kept] + new_segments,
+            upload_to_cloud
+        )
+    except Exception as e:
+        print(f"Error: Update failed: {e}")
+        # The generation only moves on in the catalog transaction
+        if generation is None:
+            print("The stored version is unchanged.")
+        else:
+            print(f"Generation {generation} is registered but its segments may be incomplete.")
+        return None
+    finally:
+        # Drop the blob references of segments that were never registered
+        release_dedup_pins(dedup_pins)
+        # Clean up anything left in staging
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    print("\n=== Update Summary ===")
+    print(f"File ID: {file_id}")
+    print(f"Generation: {generation}")
+    print(f"Segments kept: {len(kept)}, re-referenced: {len(relinked)}, re-encrypted: {len(changed)}")
+    
+    return {
+        "kept": len(kept),
+        "relinked": len(relinked),
+        "encrypted": len(changed),
+        "generation": generation
+    }
+
+#
+#   Moves an old flat output/ layout into the segment store (--migrate-store)
+#
+def migrate_local_segments(legacy_dir="output"):
+    """
+    Indexes the segment files already on disk and moves those of the flat
+    legacy_dir layout into the sharded segment store.
+    
+    Catalogs created before the local path index and the store need this once;
+    until then their segments are only found through manifests and scans.
+    
+    Args:
+        legacy_dir (str): Directory of the flat layout
+        
+    Returns:
+        int: Number of files moved
+    """
+    index_existing_segments(legacy_dir)
+    return segment_store.migrate(legacy_dir)
+
+#
+#   Benchmarks the KDF on this host and stores the chosen cost parameters
+#
+def calibrate_kdf(target_ms=500):
+    """
+    Calibrates master-key derivation and the segment cipher choice for this host.
+    
+    The chosen parameters are used for files encrypted from now on and are
+    stored with each file, so existing files keep decrypting with the
+    parameters they were created with.
+    
+    Args:
+        target_ms (float): Desired unlock time per file in milliseconds
+        
+    Returns:
+        dict: The stored KDF profile
+    """
+    print(f"Calibrating key derivation for a {target_ms:.0f} ms unlock target...")
+    profile = segment_encryptor.key_manager.calibrate_kdf(target_ms=target_ms)
+    
+    print(f"KDF: {profile['kdf_type']}")
+    for name, value in profile["kdf_params"].items():
+        print(f"  {name}: {value}")
+    print(f"Measured unlock time: {profile['measured_ms']} ms")
+    
+    # Re-run the cipher benchmark too, in case the hardware changed
+    engine = segment_encryptor.encryption_engine
+    engine.default_algorithm = engine.select_algorithm(refresh=True)
+    print(f"Segment cipher for new files: {engine.default_algorithm}")
+    return profile
+
 #
 #   Validates user input to ensure it is a valid, non-negative integer
 #
@@ -1847,9 +3815,7 @@ def verify_upload_to_dropbox(file_id):
     and recorded in the database.
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Get the file info
         cursor.execute("SELECT * FROM master_files WHERE file_id = ?", (file_id,))
@@ -1857,7 +3823,6 @@ def verify_upload_to_dropbox(file_id):
         
         if not file_info:
             print(f"❌ No file found with ID: {file_id}")
-            conn.close()
             return False
             
         # Get all segments for this file
@@ -1870,7 +3835,6 @@ def verify_upload_to_dropbox(file_id):
         segments = cursor.fetchall()
         if not segments:
             print(f"❌ No segments found for file ID: {file_id}")
-            conn.close()
             return False
             
         # Check for cloud locations
@@ -1893,8 +3857,6 @@ def verify_upload_to_dropbox(file_id):
                 print(f"❌ Segment {segment_index} has no cloud location recorded")
                 segment_statuses.append(False)
         
-        conn.close()
-        
         # Return True only if all segments have cloud locations
         if all(segment_statuses):
             print(f"✅ All {len(segment_statuses)} segments have cloud locations recorded")
@@ -1927,6 +3889,7 @@ def menu():
         print("9. Run Encryption Test")
         print("10. Create Test File")
         print("11. List all files from dropbox")
+        print("12. Calibrate Key Derivation")
         print("99. Exit")
 
         choice = input("Select an option >> ").strip()
@@ -2145,6 +4108,9 @@ def menu():
             except ValueError:
                 print("Please enter a valid number.")
 
+        elif choice == "12":
+            target_ms = get_valid_input("Enter target unlock time in ms (e.g. 500) >> ", min_value=50)
+            calibrate_kdf(target_ms)
                 
         elif choice == "99":
             print("\nExiting program.")
@@ -2174,16 +4140,30 @@ def main():
     # Setup argparse
     parser = argparse.ArgumentParser(description="File encryption and upload utility.")
     parser.add_argument("-f", "--file", type=str, help="Path to the file you want to encrypt and upload.")
-    parser.add_argument("-ns", "--num_splits", type=int, help="Number of splits for the file.", default=3)
+    parser.add_argument("-ns", "--num_splits", type=int, help="Number of splits for the file (default: 3, or the current count with --update).")
     parser.add_argument("-fp", "--file_password", type=str, help="Password for file encryption")
     parser.add_argument("-c", "--cloud", action="store_true", help="Upload segments to cloud services.")
     parser.add_argument("-i", "--interface", action="store_true", help="Use the interactive menu instead of command-line input.")
     parser.add_argument("-t", "--test", action="store_true", help="Run the encryption/decryption test.")
+    parser.add_argument("--calibrate", action="store_true", help="Benchmark the KDF and store cost parameters for this host.")
+    parser.add_argument("--target-ms", type=int, help="Target unlock time in ms for --calibrate.", default=500)
+    parser.add_argument("--migrate-store", action="store_true", help="Move segments of the old flat output/ layout into the sharded store and index them.")
+    parser.add_argument("-w", "--workers", type=int, help="Number of segments to encrypt in parallel (default: CPU count).")
+    parser.add_argument("--compress", choices=segment_encryptor.compressor.available_codecs(), help="Compress segments before encryption (skipped for incompressible data).")
+    parser.add_argument("--cdc", action="store_true", help="Split at content-defined boundaries instead of into --num_splits parts.")
+    parser.add_argument("--cdc-sizes", type=str, help="Min,avg,max chunk sizes in KiB for --cdc (default: 1024,4096,16384).")
+    parser.add_argument("--vault", type=str, help="Keyring name: wrap the file key under one vault password instead of deriving it per file.")
+    parser.add_argument("--dedup", action="store_true", help="Store and upload segments identical to ones of earlier uploads only once.")
+    parser.add_argument("--update", type=str, metavar="FILE_ID", help="Replace an uploaded file with a new version of it, re-encrypting only changed segments.")
     
     args = parser.parse_args()
 
     if args.test:
         test_encryption()
+    elif args.calibrate:
+        calibrate_kdf(args.target_ms)
+    elif args.migrate_store:
+        migrate_local_segments()
     elif args.interface or (len(sys.argv) == 1):  # Default to interface if no args
         menu() 
     else:
@@ -2193,7 +4173,22 @@ def main():
             file_pass = args.file_password
             if not file_pass:
                 file_pass = input("Enter password for file encryption: ")
-            upload(file_path, number_of_splits, file_pass, upload_to_cloud=args.cloud)
+            chunk_sizes = None
+            if args.cdc_sizes:
+                chunk_sizes = tuple(int(size) * 1024 for size in args.cdc_sizes.split(","))
+                if len(chunk_sizes) != 3:
+                    print("Error: --cdc-sizes takes three values: min,avg,max")
+                    return
+            if args.update:
+                update(args.update, file_path, file_pass, number_of_splits=number_of_splits,
+                       upload_to_cloud=args.cloud, workers=args.workers, compression=args.compress,
+                       chunking="cdc" if args.cdc else "fixed", chunk_sizes=chunk_sizes,
+                       dedup=args.dedup)
+                return
+            upload(file_path, number_of_splits or 3, file_pass, upload_to_cloud=args.cloud, vault=args.vault,
+                   workers=args.workers, compression=args.compress,
+                   chunking="cdc" if args.cdc else "fixed", chunk_sizes=chunk_sizes,
+                   dedup=args.dedup)
         else:
             print("Error: You must specify a file with -f/--file.")
 
@@ -562,10 +562,9 @@ class CloudStatusWindow:
         # This is a stub - in a real implementation you would query 
         # the database to count segments per service
         try:
-            # Connect to the database
-            import sqlite3
-            conn = sqlite3.connect("keys.db")
-            cursor = conn.cursor()
+            # Use the shared connection pool from main.py
+            from main import db
+            cursor = db.cursor()
             
             # Check if the segment_cloud_locations table exists
             cursor.execute("""
@@ -584,7 +583,6 @@ class CloudStatusWindow:
             """)
             
             results = cursor.fetchall()
-            conn.close()
             
             return {service: count for service, count in results}
         except Exception as e:
@@ -0,0 +1,731 @@
+"""
+Tests for the segment pipeline in main.py
+
+main.py needs the packages from requirements.txt (dropbox, pyfiglet) and
+keeps keys.db, settings.json and output/ in the working directory, so the
+tests run in a scratch directory.
+"""
+
+import os
+import sys
+import json
+import base64
+import contextlib
+import hashlib
+import io
+import math
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+from unittest import mock
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+main = None
+_work_dir = None
+_previous_dir = None
+
+
+def setUpModule():
+    global main, _work_dir, _previous_dir
+    _previous_dir = os.getcwd()
+    _work_dir = tempfile.mkdtemp()
+    os.chdir(_work_dir)
+    with open("settings.json", "w") as f:
+        json.dump({"GoogleDrive": "000", "Dropbox": "test-token", "OneDrive": "000"}, f)
+
+    sys.path.insert(0, SRC_DIR)
+    try:
+        import main as main_module
+    except ImportError as e:
+        os.chdir(_previous_dir)
+        shutil.rmtree(_work_dir, ignore_errors=True)
+        raise unittest.SkipTest(f"main.py dependencies not installed: {e}")
+    main = main_module
+
+
+def tearDownModule():
+    main.db.close_all()
+    os.chdir(_previous_dir)
+    shutil.rmtree(_work_dir, ignore_errors=True)
+
+
+class MemoryCloudConnector:
+    """Cloud connector serving segments from a dict"""
+
+    service_name = "Dropbox"
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def download_segment(self, remote_id):
+        return self.objects.get(remote_id)
+
+
+class TestRestore(unittest.TestCase):
+    """Test cases for restoring files from local and cloud segments"""
+
+    def test_cloud_restore_keeps_legacy_meta(self):
+        """Test that restoring a legacy segment from the cloud leaves its .meta file in place"""
+        data = os.urandom(200000)
+        with open("legacy.bin", "wb") as f:
+            f.write(data)
+        file_id, segments = main.upload("legacy.bin", 2, "password-legacy")
+
+        # Turn segment 0 into a legacy .enc/.meta pair whose .enc is only in the cloud
+        container = main.segment_encryptor.container
+        container_path = segments[0]["encrypted_path"]
+        with open(container_path, "rb") as f:
+            raw = f.read()
+        metadata, _ = container.unpack_header(raw)
+        for field in ("nonce", "tag"):
+            metadata[field] = base64.b64encode(metadata[field]).decode("utf-8")
+        meta_path = container_path[:-len(".seg")] + ".meta"
+        enc_path = container_path[:-len(".seg")] + ".enc"
+        with open(meta_path, "w") as f:
+            json.dump(metadata, f)
+        with open(enc_path, "wb") as f:
+            f.write(raw[container.HEADER_SIZE:])
+        os.remove(container_path)
+
+        with main.db.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO segment_cloud_locations (segment_id, cloud_service, remote_id, upload_date) "
+                "VALUES (?, 'Dropbox', 'remote-0', datetime('now'))",
+                (f"{file_id}_0",)
+            )
+        segments[0] = {"encrypted_path": enc_path, "metadata_path": meta_path, "segment_index": 0}
+        main.save_file_manifest(file_id, segments)
+        os.remove(enc_path)
+
+        cloud = MemoryCloudConnector({"remote-0": raw[container.HEADER_SIZE:]})
+        with mock.patch.object(main, "DropboxConnector", lambda api_key: cloud):
+            self.assertTrue(main.decrypt_file_segments(file_id, "password-legacy", "legacy.out"))
+
+        with open("legacy.out", "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertTrue(os.path.exists(meta_path))
+        self.assertEqual(os.listdir(main.DOWNLOAD_TEMP_DIR), [])
+
+    def test_tampered_segment_error_names_exception(self):
+        """Test that a segment failing authentication is reported with its exception type"""
+        with open("tampered.bin", "wb") as f:
+            f.write(os.urandom(100000))
+        file_id, segments = main.upload("tampered.bin", 1, "password-tampered")
+        path = segments[0]["encrypted_path"]
+        with open(path, "r+b") as f:
+            f.seek(main.segment_encryptor.container.HEADER_SIZE + 10)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 1]))
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertFalse(main.decrypt_file_segments(
+                file_id, "password-tampered", "tampered.out", download_from_cloud=False
+            ))
+        self.assertIn("Error processing segment 0: InvalidTag", output.getvalue())
+
+    def test_manifest_locations_without_local_segments(self):
+        """Test that the manifest's cloud locations are used when no segment is stored locally"""
+        data = os.urandom(200000)
+        with open("cloud-only.bin", "wb") as f:
+            f.write(data)
+        file_id, segments = main.upload("cloud-only.bin", 2, "password-cloud")
+
+        objects = {}
+        with main.db.transaction() as cursor:
+            for segment in segments:
+                remote_id = f"remote-{file_id}-{segment['segment_index']}"
+                with open(segment["encrypted_path"], "rb") as f:
+                    objects[remote_id] = f.read()
+                segment["cloud_locations"] = [{"service": "Dropbox", "remote_id": remote_id}]
+                cursor.execute(
+                    "INSERT INTO segment_cloud_locations (segment_id, cloud_service, remote_id, upload_date) "
+                    "VALUES (?, 'Dropbox', ?, datetime('now'))",
+                    (f"{file_id}_{segment['segment_index']}", remote_id)
+                )
+        main.save_file_manifest(file_id, segments)
+        for segment in segments:
+            os.remove(segment["encrypted_path"])
+
+        found, _ = main.get_file_segments(file_id)
+        self.assertEqual(
+            [segment["cloud_locations"][0]["remote_id"] for segment in found],
+            [f"remote-{file_id}-0", f"remote-{file_id}-1"]
+        )
+
+        # The Dropbox pull finds nothing, so the manifest's locations are used
+        cloud = MemoryCloudConnector(objects)
+        with mock.patch.object(main, "DropboxConnector", lambda api_key: cloud), \
+             mock.patch.object(main, "download_all_segments_from_dropbox", return_value=False):
+            self.assertTrue(main.decrypt_file_segments(file_id, "password-cloud", "cloud-only.out"))
+        with open("cloud-only.out", "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_wrong_password_reads_nothing(self):
+        """Test that a wrong password aborts the restore before any segment is decrypted or downloaded"""
+        with open("wrong-password.bin", "wb") as f:
+            f.write(os.urandom(100000))
+        file_id, segments = main.upload("wrong-password.bin", 2, "password-right")
+        # Without local segments the restore would otherwise go to Dropbox
+        for segment in segments:
+            os.remove(segment["encrypted_path"])
+
+        with mock.patch.object(main, "decrypt_segment") as decrypt_segment, \
+             mock.patch.object(main, "download_all_segments_from_dropbox") as download_all, \
+             mock.patch.object(main, "download_file") as download_file, \
+             mock.patch.object(main, "download_and_delete_file") as download_and_delete_file, \
+             mock.patch.object(main, "DropboxConnector") as connector, \
+             contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(main.decrypt_file_segments(file_id, "password-wrong", "wrong-password.out"))
+
+        for patched in (decrypt_segment, download_all, download_file, download_and_delete_file, connector):
+            patched.assert_not_called()
+        self.assertFalse(os.path.exists("wrong-password.out"))
+
+    def test_dropbox_pull_keeps_manifest(self):
+        """Test that pulling a file from Dropbox leaves its manifest in Dropbox"""
+        with open("pulled.bin", "wb") as f:
+            f.write(os.urandom(100000))
+        file_id, segments = main.upload("pulled.bin", 2, "password-pull")
+
+        remote = {}
+        paths = [segment["encrypted_path"] for segment in segments] + [main.segment_store.manifest_path(file_id)]
+        for path in paths:
+            with open(path, "rb") as f:
+                remote[os.path.basename(path)] = f.read()
+            os.remove(path)
+
+        def download_file(name, local_path):
+            with open(local_path, "wb") as f:
+                f.write(remote[name])
+
+        def download_and_delete_file(name, local_path):
+            download_file(name, local_path)
+            del remote[name]
+
+        with mock.patch.object(main, "download_file", download_file), \
+             mock.patch.object(main, "download_and_delete_file", download_and_delete_file), \
+             contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(main.download_all_segments_from_dropbox(file_id))
+
+        self.assertEqual(list(remote), [f"{file_id}.manifest"])
+        self.assertTrue(all(os.path.exists(segment["encrypted_path"]) for segment in segments))
+
+
+class TestLocalIndex(unittest.TestCase):
+    """Test cases for the stat checks of the local segment index"""
+
+    def stale_index(self, name):
+        """Uploads a file and points the index of segment 1 at a copy outside the store"""
+        data = os.urandom(150000)
+        with open(name, "wb") as f:
+            f.write(data)
+        file_id, segments = main.upload(name, 3, "password-index")
+        copy_path = os.path.join("output", os.path.basename(segments[1]["encrypted_path"]))
+        shutil.copyfile(segments[1]["encrypted_path"], copy_path)
+        main.record_local_segments(file_id, [dict(segments[1], encrypted_path=copy_path)])
+        self.assertEqual(main.indexed_local_segments(file_id)[1]["encrypted_path"], copy_path)
+        return data, file_id, segments, copy_path
+
+    def assert_falls_back(self, data, file_id, segments, name):
+        with contextlib.redirect_stdout(io.StringIO()):
+            found, _ = main.get_file_segments(file_id)
+        self.assertEqual(
+            [segment["encrypted_path"] for segment in found],
+            [segment["encrypted_path"] for segment in segments]
+        )
+        cursor = main.db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM segment_local_paths WHERE segment_id = ?", (f"{file_id}_1",))
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(main.decrypt_file_segments(file_id, "password-index", name + ".out",
+                                                       download_from_cloud=False))
+        with open(name + ".out", "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_deleted_segment_not_served(self):
+        """Test that an indexed segment file that was deleted is replaced by the manifest's copy"""
+        data, file_id, segments, copy_path = self.stale_index("index-deleted.bin")
+        os.remove(copy_path)
+        self.assert_falls_back(data, file_id, segments, "index-deleted.bin")
+
+    def test_resized_segment_not_served(self):
+        """Test that an indexed segment file overwritten with other data is not used"""
+        data, file_id, segments, copy_path = self.stale_index("index-resized.bin")
+        with open(copy_path, "wb") as f:
+            f.write(os.urandom(1000))
+        self.assert_falls_back(data, file_id, segments, "index-resized.bin")
+
+
+class TestDedup(unittest.TestCase):
+    """Test cases for segments shared between files"""
+
+    def test_lost_blob_recreated_for_earlier_file(self):
+        """Test that a blob re-encrypted after its file was lost still decrypts earlier files"""
+        data = os.urandom(200000)
+        with open("shared.bin", "wb") as f:
+            f.write(data)
+        file_a, segments_a = main.upload("shared.bin", 2, "password-a", dedup=True)
+
+        # Lose the store: the blobs and file A's containers
+        containers = {}
+        for segment in segments_a:
+            with open(segment["encrypted_path"], "rb") as f:
+                containers[segment["encrypted_path"]] = f.read()
+            os.remove(segment["encrypted_path"])
+            os.remove(main.dedup_blob_path(segment["content_id"]))
+
+        file_b, _ = main.upload("shared.bin", 2, "password-b", dedup=True)
+        for path, raw in containers.items():
+            with open(path, "wb") as f:
+                f.write(raw)
+
+        self.assertTrue(main.decrypt_file_segments(file_a, "password-a", "shared-a.out", download_from_cloud=False))
+        self.assertTrue(main.decrypt_file_segments(file_b, "password-b", "shared-b.out", download_from_cloud=False))
+        for path in ("shared-a.out", "shared-b.out"):
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    def test_delete_keeps_blob_picked_by_pending_upload(self):
+        """Test that deleting a file keeps a blob an unfinished upload has picked for reuse"""
+        data = os.urandom(50000)
+        with open("picked.bin", "wb") as f:
+            f.write(data)
+        file_a, segments_a = main.upload("picked.bin", 1, "password-a", dedup=True)
+        content_id = segments_a[0]["content_id"]
+
+        # A second upload has encrypted the segment but not registered it yet
+        file_b, master_key = main.segment_encryptor.setup_encryption("password-b")
+        pending_key_info = []
+        segment = main.SegmentRange("picked.bin", 0, len(data), "picked.bin")
+        self.assertIsNotNone(main.encrypt_segment(
+            segment, file_b, master_key, 0, pending_key_info, dedup=True
+        ))
+
+        self.assertTrue(main.delete_encrypted_file(file_a))
+        self.assertTrue(os.path.exists(main.dedup_blob_path(content_id)))
+        self.assertEqual(main.segment_encryptor.key_manager.get_dedup_blob(content_id)["refcount"], 1)
+
+        # Abandoning the second upload frees the blob
+        main.release_dedup_pins([content_id])
+        self.assertIsNone(main.segment_encryptor.key_manager.get_dedup_blob(content_id))
+        self.assertFalse(os.path.exists(main.dedup_blob_path(content_id)))
+
+
+def store_files():
+    """Every file under the segment store"""
+    return {
+        os.path.join(directory, name)
+        for directory, _, names in os.walk(main.STORE_DIR) for name in names
+    }
+
+
+def catalog_counts():
+    """Row counts of the catalog tables an upload writes"""
+    cursor = main.db.cursor()
+    counts = {}
+    for table in ("master_files", "master_keys", "segment_keys_info", "segment_local_paths", "dedup_blobs"):
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        counts[table] = cursor.fetchone()[0]
+    return counts
+
+
+class TestUploadFailure(unittest.TestCase):
+    """Test cases for uploads that fail part of the way through"""
+
+    def test_failed_segment_rolls_back_upload(self):
+        """Test that a segment failing to encrypt leaves no file, key or containers behind"""
+        with open("partial.bin", "wb") as f:
+            f.write(os.urandom(300000))
+        # Make sure the store and catalog exist before taking the snapshot
+        main.upload("partial.bin", 2, "password-partial")
+        files_before = store_files()
+        counts_before = catalog_counts()
+
+        encrypt_segment = main.encrypt_segment
+
+        def fail_second_segment(segment, file_id, master_key, segment_index, *args):
+            if segment_index == 1:
+                return None
+            return encrypt_segment(segment, file_id, master_key, segment_index, *args)
+
+        with mock.patch.object(main, "encrypt_segment", fail_second_segment):
+            self.assertEqual(main.upload("partial.bin", 3, "password-partial"), (None, None))
+            # With dedup the first segment's new blob is released again
+            self.assertEqual(main.upload("partial.bin", 3, "password-partial", dedup=True), (None, None))
+
+        self.assertEqual(catalog_counts(), counts_before)
+        self.assertEqual(store_files(), files_before)
+
+    def test_failed_split_drops_background_key(self):
+        """Test that an error after the key setup started leaves no orphaned key profile"""
+        with open("unsplittable.bin", "wb") as f:
+            f.write(os.urandom(1000))
+        main.upload("unsplittable.bin", 1, "password-split")
+        counts_before = catalog_counts()
+
+        with mock.patch.object(main, "split_file", side_effect=OSError("read failed")):
+            self.assertEqual(main.upload("unsplittable.bin", 1, "password-split"), (None, None))
+
+        self.assertEqual(catalog_counts(), counts_before)
+
+
+class TestUpdate(unittest.TestCase):
+    """Test cases for updating an uploaded file"""
+
+    def write(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def generation(self, file_id):
+        cursor = main.db.cursor()
+        cursor.execute("SELECT generation FROM master_files WHERE file_id = ?", (file_id,))
+        return cursor.fetchone()[0]
+
+    def test_update_keeps_cloud_copy_current(self):
+        """Test that updating a file with cloud copies uploads the new segments and manifest"""
+        data = os.urandom(200000)
+        self.write("cloud-update.bin", data)
+        file_id, segments = main.upload("cloud-update.bin", 2, "password-update")
+        with main.db.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO segment_cloud_locations (segment_id, cloud_service, remote_id, upload_date) "
+                "VALUES (?, 'Dropbox', '/old-1.seg', datetime('now'))",
+                (f"{file_id}_1",)
+            )
+
+        self.write("cloud-update.bin", data[:100000] + os.urandom(100000))
+        with mock.patch.object(main, "upload_segments_to_dropbox") as upload_segments, \
+             mock.patch.object(main, "save_file_manifest") as save_manifest:
+            result = main.update(file_id, "cloud-update.bin", "password-update")
+
+        self.assertEqual(result["encrypted"], 1)
+        uploaded = upload_segments.call_args[0][1]
+        self.assertEqual([segment["segment_index"] for segment in uploaded], [1])
+        self.assertTrue(save_manifest.call_args[0][2])
+
+    def test_failed_update_leaves_version_unchanged(self):
+        """Test that an error while splitting the new version leaves the stored one in place"""
+        data = os.urandom(100000)
+        self.write("failed-update.bin", data)
+        file_id, _ = main.upload("failed-update.bin", 2, "password-update")
+        generation = self.generation(file_id)
+
+        self.write("failed-update.bin", os.urandom(100000))
+        with mock.patch.object(main, "split_file", side_effect=OSError("read failed")):
+            self.assertIsNone(main.update(file_id, "failed-update.bin", "password-update"))
+
+        self.assertEqual(self.generation(file_id), generation)
+        self.assertFalse(os.path.exists(os.path.join("output", f".update_{file_id[:8]}")))
+        self.assertTrue(main.decrypt_file_segments(
+            file_id, "password-update", "failed-update.out", download_from_cloud=False
+        ))
+        with open("failed-update.out", "rb") as f:
+            self.assertEqual(f.read(), data)
+
+
+class TestMigrateStore(unittest.TestCase):
+    """Test cases for moving the flat output/ layout into the segment store"""
+
+    def flatten(self, file_id):
+        """Moves a file's segments and manifest back into output/"""
+        shard = main.segment_store.shard_dir(file_id)
+        for name in os.listdir(shard):
+            if name.startswith(file_id):
+                os.replace(os.path.join(shard, name), os.path.join("output", name))
+
+    def test_migrate_moves_known_segments(self):
+        """Test that migration moves known segments into shards and leaves unknown ones in output/"""
+        data = os.urandom(150000)
+        with open("flat.bin", "wb") as f:
+            f.write(data)
+        file_id, _ = main.upload("flat.bin", 3, "password-migrate")
+        with open("unknown.bin", "wb") as f:
+            f.write(os.urandom(50000))
+        unknown_id, _ = main.upload("unknown.bin", 1, "password-migrate")
+
+        self.flatten(file_id)
+        self.flatten(unknown_id)
+        with main.db.transaction() as cursor:
+            cursor.execute("DELETE FROM segment_local_paths WHERE file_id IN (?, ?)", (file_id, unknown_id))
+            cursor.execute("DELETE FROM segment_keys_info WHERE segment_id LIKE ?", (f"{unknown_id}_%",))
+            cursor.execute("DELETE FROM master_files WHERE file_id = ?", (unknown_id,))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.migrate_local_segments()
+
+        shard = main.segment_store.shard_dir(file_id)
+        self.assertEqual(
+            sorted(name for name in os.listdir(shard) if name.startswith(file_id)),
+            sorted([f"{file_id}_{index}.seg" for index in range(3)] + [f"{file_id}.manifest"])
+        )
+        self.assertFalse([name for name in os.listdir("output") if name.startswith(file_id)])
+        self.assertIn(f"{unknown_id}_0.seg", os.listdir("output"))
+        self.assertIn(f"{unknown_id}.manifest", os.listdir("output"))
+
+        cursor = main.db.cursor()
+        cursor.execute("SELECT encrypted_path FROM segment_local_paths WHERE file_id = ?", (file_id,))
+        self.assertTrue(all(row[0].startswith(shard) for row in cursor.fetchall()))
+        cursor.execute("SELECT COUNT(*) FROM segment_local_paths WHERE file_id = ?", (unknown_id,))
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+        self.assertTrue(main.decrypt_file_segments(
+            file_id, "password-migrate", "flat.out", download_from_cloud=False
+        ))
+        with open("flat.out", "rb") as f:
+            self.assertEqual(f.read(), data)
+
+
+class TestFileInfo(unittest.TestCase):
+    """Test cases for get_file_info"""
+
+    def expected_info(self, path, block_size, sample_size):
+        """The values computed separately, one pass each"""
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            data.decode("utf-8")
+            is_text = True
+        except UnicodeDecodeError:
+            is_text = False
+        sample = Counter()
+        for start in range(0, len(data), block_size):
+            sample.update(data[start:start + sample_size])
+        total = sum(sample.values())
+        return {
+            "type": "text" if is_text else "binary",
+            "size": os.path.getsize(path),
+            "newlines": data.count(b"\n"),
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "entropy": -sum(count / total * math.log2(count / total) for count in sample.values())
+        }
+
+    def test_matches_separate_passes(self):
+        """Test that the one-pass analysis gives the values of separate passes over the file"""
+        text = "".join(random.Random(4).choice(["line\n", "ümlaut ", "日本語\n", "x"]) for _ in range(5000))
+        with open("info-text", "wb") as f:
+            f.write(text.encode("utf-8"))
+        with open("info-binary", "wb") as f:
+            f.write(text.encode("utf-8") + b"\xff" + os.urandom(10000))
+
+        # Small blocks so multi-byte characters straddle block boundaries
+        with mock.patch.object(main, "ANALYSIS_BLOCK_SIZE", 1001), \
+             mock.patch.object(main, "ENTROPY_SAMPLE_SIZE", 300):
+            for path in ("info-text", "info-binary"):
+                info = main.get_file_info(path)
+                expected = self.expected_info(path, 1001, 300)
+                self.assertAlmostEqual(info.pop("entropy"), expected.pop("entropy"))
+                self.assertEqual(info, expected)
+        self.assertEqual(main.get_file_info("info-text")["type"], "text")
+        self.assertEqual(main.get_file_info("info-binary")["type"], "binary")
+
+    def test_cache_follows_changes(self):
+        """Test that an unchanged file is served from the cache and a modified one is read again"""
+        with open("info-cached", "wb") as f:
+            f.write(b"a" * 1000)
+        first = main.get_file_info("info-cached")
+        with mock.patch.object(main, "open", create=True, side_effect=AssertionError("file read again")):
+            self.assertEqual(main.get_file_info("info-cached"), first)
+
+        # Same size, new mtime
+        stat = os.stat("info-cached")
+        with open("info-cached", "wb") as f:
+            f.write(b"b" * 1000)
+        os.utime("info-cached", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        second = main.get_file_info("info-cached")
+        self.assertEqual(second["sha256"], hashlib.sha256(b"b" * 1000).hexdigest())
+
+        # Same mtime, new size
+        stat = os.stat("info-cached")
+        with open("info-cached", "ab") as f:
+            f.write(b"\n")
+        os.utime("info-cached", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        third = main.get_file_info("info-cached")
+        self.assertEqual((third["size"], third["newlines"]), (1001, 1))
+
+
+class TestSplitTextFile(unittest.TestCase):
+    """Test cases for split_text_file"""
+
+    def split(self, data, num_files):
+        with open("text.txt", "wb") as f:
+            f.write(data)
+        with contextlib.redirect_stdout(io.StringIO()):
+            splits = main.split_text_file("text.txt", "text.txt", num_files)
+        self.assertEqual(len(splits), num_files)
+        return [split.read() for split in splits]
+
+    def test_parts_end_on_newlines(self):
+        """Test that every part but the last ends with a complete line"""
+        rng = random.Random(2)
+        data = b"".join(b"x" * rng.randint(0, 300) + b"\n" for _ in range(500))
+        parts = self.split(data, 7)
+        for part in parts:
+            self.assertTrue(part.endswith(b"\n"))
+        self.assertEqual(b"".join(parts), data)
+
+    def test_no_trailing_newline(self):
+        """Test that a last line without a newline is kept whole"""
+        data = b"first line\nsecond line\nthird line without newline"
+        for num_files in (2, 3, 4):
+            parts = [part for part in self.split(data, num_files) if part]
+            for part in parts[:-1]:
+                self.assertTrue(part.endswith(b"\n"))
+            self.assertEqual(parts[-1].split(b"\n")[-1], b"third line without newline")
+            self.assertEqual(b"".join(parts), data)
+
+    def test_crlf_lines_stay_whole(self):
+        """Test that a cut never separates the CR from the LF of a line ending"""
+        data = b"".join(b"line %d with some text\r\n" % number for number in range(200))
+        for num_files in (2, 5, 13):
+            parts = self.split(data, num_files)
+            for part in parts:
+                self.assertTrue(part.endswith(b"\r\n"))
+            self.assertEqual(b"".join(parts), data)
+
+    def test_more_parts_than_lines(self):
+        """Test that extra parts are empty and every line still appears once"""
+        data = b"one\ntwo\nthree\n"
+        parts = self.split(data, 10)
+        self.assertEqual([part for part in parts if part], [b"one\n", b"two\n", b"three\n"])
+
+    def test_round_trip(self):
+        """Test that the parts join back into the original bytes"""
+        rng = random.Random(3)
+        lines = ["ascii", "ümlaut", "日本語", "", "\ttabbed", "x" * 5000]
+        data = "\n".join(rng.choice(lines) for _ in range(2000)).encode("utf-8")
+        for num_files in (1, 2, 3, 8, 64):
+            self.assertEqual(b"".join(self.split(data, num_files)), data)
+
+
+class TestContentDefinedChunking(unittest.TestCase):
+    """Test cases for find_cdc_cut and split_cdc_file"""
+
+    def split_lengths(self, data, chunk_sizes):
+        with open("cdc.bin", "wb") as f:
+            f.write(data)
+        return [split.length for split in main.split_cdc_file("cdc.bin", chunk_sizes)]
+
+    def test_numpy_and_python_cuts_match(self):
+        """Test that the numpy and pure Python gear hashes find the same cut points"""
+        if not main.NUMPY_AVAILABLE:
+            self.skipTest("numpy not installed")
+        rng = random.Random(1)
+        for trial in range(200):
+            length = rng.randint(1, 5000)
+            if trial % 3:
+                data = bytearray(rng.getrandbits(8) for _ in range(length))
+            else:
+                data = bytearray(rng.choice(b"ab") for _ in range(length))
+            min_size = rng.randint(1, 200)
+            avg_size = rng.randint(min_size, 800)
+            max_size = rng.randint(avg_size, 3000)
+
+            with mock.patch.object(main, "CDC_SCAN_BLOCK_SIZE", rng.choice([7, 64, 1000])):
+                fast = main.find_cdc_cut(data, length, min_size, avg_size, max_size)
+            with mock.patch.object(main, "NUMPY_AVAILABLE", False):
+                slow = main.find_cdc_cut(data, length, min_size, avg_size, max_size)
+            self.assertEqual(fast, slow)
+
+    def test_boundaries_survive_insertion(self):
+        """Test that an insertion only changes the chunks around it"""
+        chunk_sizes = (4096, 16384, 65536)
+        data = os.urandom(1024 * 1024)
+        edited = data[:300000] + b"inserted bytes" + data[300000:]
+
+        before = self.split_lengths(data, chunk_sizes)
+        after = self.split_lengths(edited, chunk_sizes)
+
+        self.assertEqual(sum(after), len(edited))
+        for length in after:
+            self.assertLessEqual(length, chunk_sizes[2])
+        # Chunks well past the insertion are identical
+        self.assertGreater(len(before), 10)
+        self.assertEqual(before[-5:], after[-5:])
+        # So are the ones before it
+        prefix = 0
+        for count, length in enumerate(before):
+            if prefix + length > 300000:
+                break
+            prefix += length
+        self.assertEqual(before[:count], after[:count])
+
+    def test_chunk_sizes_within_bounds(self):
+        """Test that chunks respect the minimum and maximum size and average near the target"""
+        min_size, avg_size, max_size = chunk_sizes = (4096, 16384, 65536)
+        data = os.urandom(4 * 1024 * 1024)
+        lengths = self.split_lengths(data, chunk_sizes)
+
+        self.assertEqual(sum(lengths), len(data))
+        for length in lengths[:-1]:
+            self.assertGreaterEqual(length, min_size)
+            self.assertLessEqual(length, max_size)
+        self.assertLessEqual(lengths[-1], max_size)
+        average = len(data) / len(lengths)
+        self.assertGreater(average, avg_size / 2)
+        self.assertLess(average, avg_size * 2)
+
+
+class TestSegmentRange(unittest.TestCase):
+    """Test cases for SegmentRange and RangeReader"""
+
+    def setUp(self):
+        self.data = os.urandom(10000)
+        with open("ranges.bin", "wb") as f:
+            f.write(self.data)
+
+    def test_reads_stay_inside_range(self):
+        """Test that reads never return bytes of the neighbouring ranges"""
+        with main.RangeReader("ranges.bin", 1000, 3000) as reader:
+            self.assertEqual(reader.read(500), self.data[1000:1500])
+            # A buffer larger than the rest of the range is only partly filled
+            buffer = bytearray(5000)
+            self.assertEqual(reader.readinto(buffer), 2500)
+            self.assertEqual(bytes(buffer[:2500]), self.data[1500:4000])
+            self.assertEqual(reader.read(100), b"")
+
+            reader.seek(-10, os.SEEK_END)
+            self.assertEqual(reader.tell(), 2990)
+            self.assertEqual(reader.read(), self.data[3990:4000])
+            reader.seek(2990)
+            self.assertEqual(reader.read(100), self.data[3990:4000])
+
+        ranges = main.split_binary_file("ranges.bin", 3)
+        self.assertEqual(b"".join(split.read() for split in ranges), self.data)
+
+    def test_short_read_at_end_of_file(self):
+        """Test that a range reaching past the end of the file returns what exists"""
+        with main.RangeReader("ranges.bin", 9000, 5000) as reader:
+            self.assertEqual(reader.read(), self.data[9000:])
+            self.assertEqual(reader.read(), b"")
+        with main.RangeReader("ranges.bin", 9500, 5000) as reader:
+            self.assertEqual(reader.read(400), self.data[9500:9900])
+            self.assertEqual(reader.read(400), self.data[9900:])
+            self.assertEqual(reader.read(400), b"")
+        with main.RangeReader("ranges.bin", 20000, 100) as reader:
+            self.assertEqual(reader.read(), b"")
+
+    def test_upload_creates_no_temp_files(self):
+        """Test that uploading reads segments from the source file without copying them"""
+        def files():
+            return {
+                os.path.join(directory, name)
+                for directory, _, names in os.walk(".") for name in names
+                if not name.startswith(main.DB_PATH)
+            }
+
+        before = files()
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.upload("ranges.bin", 4, "password-ranges")
+        created = files() - before
+        self.assertTrue(created)
+        store = os.path.join(".", main.STORE_DIR) + os.sep
+        self.assertEqual([path for path in created if not path.startswith(store)], [])
+
+
+if __name__ == "__main__":
+    unittest.main()